@@ -0,0 +1,531 @@
+#!/usr/bin/env python
+
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures wall time, throughput and peak RSS of dt-awslayertool commands.
+
+Generated layer zips are served by a local HTTP server that also stands in
+for the Lambda API, so no AWS account or network is needed. Each command runs
+in its own process (which points its boto3 clients to the stand-in), so that
+its peak RSS can be measured. Results can be saved as baseline and compared
+against later runs to flag regressions.
+
+Needs a Unix system, as peak RSS is taken from os.wait4.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from os import path
+from typing import NamedTuple
+from urllib.parse import parse_qs, unquote, urlsplit
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
+
+from dtawslayertool.cache import format_size, parse_size
+
+LAMBDA_API_PREFIX = "/2018-10-31/layers"
+CONTENT_PREFIX = "/content/"
+ACCOUNT_ID = "123456789012"
+REGION = "us-east-1"
+
+DEFAULT_LAYERS = ("many-files:16M:4000", "large:64M:16")
+COMMANDS = {
+    "info": ("info", "{arn}"),
+    "pull": ("pull", "-o", "{arn}"),
+    "pull-x": ("pull", "-o", "-x", "extracted", "{arn}"),
+    "clone": ("clone", "-o", "--force-publish", "{arn}"),
+}
+# Commands whose throughput is meaningful (they transfer the whole layer)
+TRANSFER_COMMANDS = ("pull", "pull-x", "clone")
+DEFAULT_TOLERANCE = 0.15
+
+
+class LayerSpec(NamedTuple):
+    name: str
+    size: int
+    files: int
+
+    @classmethod
+    def parse(cls, raw: str) -> "LayerSpec":
+        parts = raw.split(":")
+        if len(parts) != 3 or not re.fullmatch(r"[\w.-]+", parts[0]):
+            raise ValueError("Expected <name>:<size>:<file count>, got " + raw)
+        return cls(parts[0], parse_size(parts[1]), int(parts[2]))
+
+    def __str__(self):
+        return "{}:{}:{}".format(self.name, format_size(self.size), self.files)
+
+
+def generate_layer(spec: LayerSpec, filename: str):
+    """Writes a deterministic layer zip of roughly spec.size bytes (uncompressed).
+
+    Half of each file is random, the other half repetitive text, which
+    compresses about like the libraries in real layers. Some files are
+    executable, to exercise the permission handling.
+    """
+    rnd = random.Random(spec.name)
+    filesize = max(1, spec.size // max(1, spec.files))
+    filler = b"module.exports = require('./lib/index.js');\n"
+    with ZipFile(filename + ".tmp", "w", ZIP_DEFLATED) as zipf:
+        for index in range(spec.files):
+            size = max(1, int(filesize * rnd.uniform(0.5, 1.5)))
+            randomsize = size // 2
+            data = rnd.getrandbits(randomsize * 8).to_bytes(randomsize, "little")
+            data += (filler * (size // len(filler) + 1))[: size - randomsize]
+            info = ZipInfo(
+                "{}/lib/pkg{:03}/file{:05}.js".format(spec.name, index % 100, index),
+                (2021, 5, 6, 11, 4, 40),
+            )
+            info.compress_type = ZIP_DEFLATED
+            info.create_system = 3  # Unix, so that the mode is used
+            info.external_attr = (0o100755 if index % 10 == 0 else 0o100644) << 16
+            zipf.writestr(info, data)
+    os.replace(filename + ".tmp", filename)
+
+
+def code_sha256(filename: str) -> str:
+    hasher = hashlib.sha256()
+    with open(filename, "rb") as infile:
+        for block in iter(lambda: infile.read(1024 * 1024), b""):
+            hasher.update(block)
+    return base64.b64encode(hasher.digest()).decode("ascii")
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is not available before Python 3.7
+    daemon_threads = True
+
+
+class StandInServer:
+    """Serves layer contents like S3 and answers the Lambda API calls that
+    dt-awslayertool makes (get, list and publish layer versions)."""
+
+    def __init__(self):
+        # Layer version ARN -> (layer info, zip file name)
+        self.layers = {}  # type: typing.Dict[str, typing.Tuple[dict, str]]
+        self.published = 0
+        self.lock = threading.Lock()
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), _StandInHandler)
+        self._server.standin = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+
+    @property
+    def base_url(self) -> str:
+        return "http://{}:{}".format(*self._server.server_address)
+
+    def add_layer(self, name: str, filename: str) -> str:
+        """Registers filename as version 1 of layer name and returns its ARN."""
+        layer_arn = "arn:aws:lambda:{}:{}:layer:{}".format(REGION, ACCOUNT_ID, name)
+        arn = layer_arn + ":1"
+        info = {
+            "Content": {
+                "Location": self.base_url + CONTENT_PREFIX + name,
+                "CodeSha256": code_sha256(filename),
+                "CodeSize": path.getsize(filename),
+            },
+            "LayerArn": layer_arn,
+            "LayerVersionArn": arn,
+            "Description": "Benchmark layer " + name,
+            "CreatedDate": "2021-05-06T11:04:40.607+0000",
+            "Version": 1,
+            "CompatibleRuntimes": ["nodejs12.x"],
+            "LicenseInfo": "Apache-2.0",
+        }
+        self.layers[arn] = (info, filename)
+        return arn
+
+    def content_file(self, name: str) -> typing.Optional[str]:
+        for info, filename in self.layers.values():
+            if info["Content"]["Location"].endswith(CONTENT_PREFIX + name):
+                return filename
+        return None
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint:disable=redefined-builtin
+        pass
+
+    @property
+    def standin(self) -> StandInServer:
+        return self.server.standin
+
+    def do_GET(self):  # pylint:disable=invalid-name
+        url = urlsplit(self.path)
+        if url.path.startswith(CONTENT_PREFIX):
+            self._send_content(url.path[len(CONTENT_PREFIX) :])
+        elif url.path == LAMBDA_API_PREFIX:
+            arn = parse_qs(url.query).get("Arn", [""])[0]
+            layer = self.standin.layers.get(arn)
+            if layer:
+                self._send_json(200, layer[0])
+            else:
+                self._send_not_found("Layer version not found: " + arn)
+        elif url.path.startswith(LAMBDA_API_PREFIX + "/"):
+            # Only the source layer exists, published versions are not kept.
+            layername = unquote(url.path.split("/")[3])
+            self._send_json(
+                200,
+                {
+                    "LayerVersions": [
+                        {"LayerVersionArn": arn, "Version": info["Version"]}
+                        for arn, (info, _) in self.standin.layers.items()
+                        if layername
+                        in (info["LayerArn"], info["LayerArn"].split(":")[-1])
+                    ]
+                },
+            )
+        else:
+            self._send_not_found("Unknown path " + url.path)
+
+    def do_POST(self):  # pylint:disable=invalid-name
+        url = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not url.path.startswith(LAMBDA_API_PREFIX + "/"):
+            self._send_not_found("Unknown path " + url.path)
+            return
+        layername = unquote(url.path.split("/")[3])
+        request = json.loads(body.decode("utf-8"))
+        zipfile = base64.b64decode(request["Content"]["ZipFile"])
+        with self.standin.lock:
+            self.standin.published += 1
+            version = self.standin.published + 1
+        layer_arn = "arn:aws:lambda:{}:{}:layer:{}".format(
+            REGION, ACCOUNT_ID, layername
+        )
+        self._send_json(
+            201,
+            {
+                "Content": {
+                    "CodeSha256": base64.b64encode(
+                        hashlib.sha256(zipfile).digest()
+                    ).decode("ascii"),
+                    "CodeSize": len(zipfile),
+                },
+                "LayerArn": layer_arn,
+                "LayerVersionArn": "{}:{}".format(layer_arn, version),
+                "Version": version,
+            },
+        )
+
+    def _send_content(self, name: str):
+        filename = self.standin.content_file(name)
+        if not filename:
+            self._send_not_found("No content " + name)
+            return
+        size = path.getsize(filename)
+        start, end = 0, size - 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), size - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        with open(filename, "rb") as infile:
+            infile.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = infile.read(min(remaining, 1024 * 1024))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
+
+    def _send_json(self, status: int, value: dict):
+        body = json.dumps(value).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_not_found(self, message: str):
+        body = json.dumps(dict(Type="User", Message=message)).encode("utf-8")
+        self.send_response(404)
+        self.send_header("x-amzn-ErrorType", "ResourceNotFoundException")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def exec_tool(endpoint_url: str, toolargs: typing.List[str]):
+    """Runs dt-awslayertool in this process with all AWS clients pointed to
+    endpoint_url (older botocore versions have no environment variable for it)."""
+    import boto3  # pylint:disable=import-outside-toplevel
+
+    from dtawslayertool import app  # pylint:disable=import-outside-toplevel
+
+    original_client = boto3.Session.client
+
+    def client(self, service_name, *args, **kwargs):
+        kwargs.setdefault("endpoint_url", endpoint_url)
+        return original_client(self, service_name, *args, **kwargs)
+
+    boto3.Session.client = client
+    app.main(toolargs)
+
+
+class Measurement(NamedTuple):
+    seconds: float
+    peak_rss: int  # bytes
+
+
+def run_tool(
+    endpoint_url: str, toolargs: typing.List[str], workdir: str, logfilename: str
+) -> Measurement:
+    env = dict(
+        os.environ,
+        AWS_ACCESS_KEY_ID="benchmark",
+        AWS_SECRET_ACCESS_KEY="benchmark",
+        AWS_DEFAULT_REGION=REGION,
+        AWS_CONFIG_FILE=os.devnull,
+        AWS_SHARED_CREDENTIALS_FILE=os.devnull,
+    )
+    env.pop("AWS_PROFILE", None)
+    cmdline = [sys.executable, path.abspath(__file__), "--exec-tool", endpoint_url]
+    with open(logfilename, "wb") as logfile:
+        start = time.monotonic()
+        proc = subprocess.Popen(
+            cmdline + ["--"] + toolargs,
+            cwd=workdir,
+            env=env,
+            stdout=logfile,
+            stderr=subprocess.STDOUT,
+        )
+        _pid, status, rusage = os.wait4(proc.pid, 0)
+        seconds = time.monotonic() - start
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if proc.returncode != 0:
+        with open(logfilename, encoding="utf-8", errors="replace") as logfile:
+            sys.exit(
+                "dt-awslayertool {} failed:\n{}".format(
+                    " ".join(toolargs), logfile.read()[-4000:]
+                )
+            )
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+    scale = 1 if platform.system() == "Darwin" else 1024
+    return Measurement(seconds, rusage.ru_maxrss * scale)
+
+
+class Result(NamedTuple):
+    seconds: float  # Median of the runs
+    throughput: typing.Optional[float]  # Layer bytes per second
+    peak_rss: int  # Maximum of the runs, bytes
+
+
+def clean_dir(dirname: str):
+    for name in os.listdir(dirname):
+        fullname = path.join(dirname, name)
+        if path.isdir(fullname) and not path.islink(fullname):
+            shutil.rmtree(fullname)
+        else:
+            os.remove(fullname)
+
+
+def run_benchmarks(args) -> typing.Dict[str, Result]:
+    layerdir = path.join(args.workdir, "layers")
+    rundir = path.join(args.workdir, "run")
+    os.makedirs(layerdir, exist_ok=True)
+    os.makedirs(rundir, exist_ok=True)
+    server = StandInServer()
+    server.start()
+    results = {}
+    try:
+        for spec in args.layer:
+            filename = path.join(layerdir, "{}-{}-{}.zip".format(*spec))
+            if not path.exists(filename):
+                print("generating layer", spec, file=sys.stderr, flush=True)
+                generate_layer(spec, filename)
+            arn = server.add_layer(spec.name, filename)
+            zipsize = path.getsize(filename)
+            for command in args.command:
+                toolargs = ["--no-cache"] + [
+                    arg.format(arn=arn) for arg in COMMANDS[command]
+                ]
+                measurements = []
+                for _ in range(args.repeat):
+                    clean_dir(rundir)
+                    measurements.append(
+                        run_tool(
+                            server.base_url,
+                            toolargs,
+                            rundir,
+                            path.join(args.workdir, "last-run.log"),
+                        )
+                    )
+                seconds = statistics.median(m.seconds for m in measurements)
+                key = "{}/{}".format(spec.name, command)
+                results[key] = Result(
+                    seconds,
+                    zipsize / seconds if command in TRANSFER_COMMANDS else None,
+                    max(m.peak_rss for m in measurements),
+                )
+                print(
+                    "{:28} {}".format(key, format_result(results[key])),
+                    file=sys.stderr,
+                    flush=True,
+                )
+    finally:
+        server.stop()
+    return results
+
+
+def format_result(result: Result) -> str:
+    return "{:8.2f} {:>12} {:>9}".format(
+        result.seconds,
+        format_size(int(result.throughput)) + "/s" if result.throughput else "-",
+        format_size(result.peak_rss),
+    )
+
+
+def compare(
+    result: Result, baseline: typing.Optional[dict], tolerance: float
+) -> typing.Tuple[str, bool]:
+    """Returns the change against the baseline and whether it is a regression."""
+    if not baseline:
+        return "new", False
+    timechange = result.seconds / baseline["seconds"] - 1
+    rsschange = result.peak_rss / baseline["peak_rss"] - 1
+    flags = []
+    if timechange > tolerance:
+        flags.append("SLOWER")
+    if rsschange > tolerance:
+        flags.append("MORE MEMORY")
+    return (
+        "{:+.0%} time, {:+.0%} rss{}".format(
+            timechange, rsschange, "  " + ", ".join(flags) if flags else ""
+        ),
+        bool(flags),
+    )
+
+
+def make_arg_parser() -> ArgumentParser:
+    parser = ArgumentParser(
+        description="Benchmark dt-awslayertool against a local Lambda/S3 stand-in."
+    )
+    parser.add_argument(
+        "--layer",
+        action="append",
+        type=LayerSpec.parse,
+        help="""layer to generate, as <name>:<uncompressed size>:<file count>.
+            Can be given multiple times (default: {})""".format(
+            " ".join(DEFAULT_LAYERS)
+        ),
+    )
+    parser.add_argument(
+        "--command",
+        action="append",
+        choices=sorted(COMMANDS),
+        help="command to measure. Can be given multiple times (default: all)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="runs per command and layer; the median time is reported (default: 3)",
+    )
+    parser.add_argument(
+        "--workdir",
+        help="""directory for generated layers and command output. Generated
+            layers are reused. Defaults to a temporary directory""",
+    )
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the results with this JSON file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help="""relative increase of time or peak RSS that is flagged as
+            regression (default: %(default)s)""",
+    )
+    return parser
+
+
+def main():
+    if len(sys.argv) > 3 and sys.argv[1] == "--exec-tool" and sys.argv[3] == "--":
+        exec_tool(sys.argv[2], sys.argv[4:])
+        return
+    args = make_arg_parser().parse_args()
+    args.layer = args.layer or [LayerSpec.parse(raw) for raw in DEFAULT_LAYERS]
+    args.command = args.command or list(COMMANDS)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as infile:
+            baseline = json.load(infile)["results"]
+
+    with tempfile.TemporaryDirectory(prefix="dt-benchmark-") as tmpdir:
+        args.workdir = args.workdir or tmpdir
+        results = run_benchmarks(args)
+
+    regressions = []
+    rowformat = "{:28} {:>8} {:>12} {:>9}  {}"
+    print(rowformat.format("BENCHMARK", "SECONDS", "THROUGHPUT", "PEAK RSS", "CHANGE"))
+    for key, result in results.items():
+        change, regressed = compare(result, baseline.get(key), args.tolerance)
+        if regressed:
+            regressions.append(key)
+        print("{:28} {}  {}".format(key, format_result(result), change))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as outfile:
+            json.dump(
+                dict(
+                    python=platform.python_version(),
+                    platform=platform.platform(),
+                    results={key: result._asdict() for key, result in results.items()},
+                ),
+                outfile,
+                indent=2,
+            )
+            outfile.write("\n")
+    if regressions:
+        sys.exit("regressions in: " + ", ".join(regressions))
+
+
+if __name__ == "__main__":
+    main()
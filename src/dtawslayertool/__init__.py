@@ -0,0 +1,68 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Download, inspect and clone AWS Lambda layers.
+
+See dtawslayertool.api for the Python API and dtawslayertool.aio for its
+asyncio variant (not imported here, to keep the command line startup fast).
+"""
+
+from dtawslayertool.api import (
+    CloneError,
+    CloneResult,
+    DiscoveredVersion,
+    DiscoverError,
+    DownloadError,
+    DownloadResult,
+    LayerBuildError,
+    LayerClient,
+    LayerExtractError,
+    LayerToolError,
+    LayerVersion,
+    OperationCancelled,
+    PublishResult,
+    PullResult,
+    SyncError,
+    TargetExistsError,
+)
+from dtawslayertool.clients import ClientConfig, ClientRegistry
+from dtawslayertool.diff import DiffResult
+from dtawslayertool.optimize import OptimizeResult
+from dtawslayertool.sync import SyncRecord
+from dtawslayertool.verify import VerifyResult
+
+__all__ = [
+    "ClientConfig",
+    "ClientRegistry",
+    "CloneError",
+    "CloneResult",
+    "DiffResult",
+    "DiscoverError",
+    "DiscoveredVersion",
+    "DownloadError",
+    "DownloadResult",
+    "LayerBuildError",
+    "LayerClient",
+    "LayerExtractError",
+    "LayerToolError",
+    "LayerVersion",
+    "OperationCancelled",
+    "OptimizeResult",
+    "PublishResult",
+    "PullResult",
+    "SyncError",
+    "SyncRecord",
+    "TargetExistsError",
+    "VerifyResult",
+]
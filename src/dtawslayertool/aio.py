@@ -0,0 +1,401 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""asyncio variant of the Python API.
+
+botocore and the downloads block, so AsyncLayerClient runs them (including
+hashing and extraction) in its own thread pool and never on the event loop.
+Operations on the same region share a semaphore, which caps the concurrent
+operations per region; a clone takes the slots of its source and target
+regions one step at a time.
+
+Cancelling an operation stops it at the next progress callback and removes
+its partial download before the CancelledError is raised. Publishing a layer
+version cannot be interrupted, it completes (or fails) first.
+"""
+
+import asyncio
+import copy
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from dtawslayertool.api import (
+    DEFAULT_DISCOVER_PARALLELISM,
+    DEFAULT_SYNC_PARALLELISM,
+    Arn,
+    CloneResult,
+    DiffResult,
+    DiscoveredVersion,
+    DownloadResult,
+    LayerClient,
+    LayerResourceName,
+    LayerVersion,
+    OperationCancelled,
+    OptimizeResult,
+    PublishResult,
+    PullResult,
+    SyncRecord,
+    VerifyResult,
+    check_staging_bucket,
+    checked_clone_results,
+    clone_to_region,
+    resolve_target_regions,
+)
+from dtawslayertool.build import DEFAULT_COMPRESS_LEVEL
+from dtawslayertool.staging import DEFAULT_PREFIX
+from dtawslayertool.verify import DEFAULT_HASH_CONCURRENCY
+
+DEFAULT_REGION_CONCURRENCY = 4
+
+T = typing.TypeVar("T")
+
+
+class AsyncLayerClient:
+    """Async wrapper of a LayerClient (by default, one with default settings).
+
+    region_concurrency: maximum number of concurrent operations per region.
+    max_workers: size of the thread pool (default: as ThreadPoolExecutor).
+
+    The callbacks of the LayerClient are called from the worker threads.
+    Use as async context manager, or call close(), to shut the pool down.
+    """
+
+    def __init__(
+        self,
+        layerclient: typing.Optional[LayerClient] = None,
+        region_concurrency: int = DEFAULT_REGION_CONCURRENCY,
+        max_workers: typing.Optional[int] = None,
+    ):
+        self.layerclient = layerclient or LayerClient()
+        self.region_concurrency = region_concurrency
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix="aio")
+        self._semaphores = {}  # type: typing.Dict[str, asyncio.Semaphore]
+
+    async def __aenter__(self) -> "AsyncLayerClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Waits for running operations to finish and shuts the pool down."""
+        await asyncio.get_event_loop().run_in_executor(None, self._executor.shutdown)
+
+    def _semaphore(self, region: str) -> asyncio.Semaphore:
+        # Created on first use, so that it belongs to the running loop.
+        if region not in self._semaphores:
+            self._semaphores[region] = asyncio.Semaphore(self.region_concurrency)
+        return self._semaphores[region]
+
+    def _cancellable(self, cancelled: threading.Event) -> LayerClient:
+        """Returns a copy of the LayerClient whose callbacks raise
+        OperationCancelled once cancelled is set."""
+        base = self.layerclient
+
+        def check():
+            if cancelled.is_set():
+                raise OperationCancelled("operation cancelled")
+
+        def on_message(text: str):
+            check()
+            base.on_message(text)
+
+        def on_transfer(block_count: int, block_size: int, total_size: int):
+            check()
+            if base.on_transfer:
+                base.on_transfer(block_count, block_size, total_size)
+
+        layerclient = copy.copy(base)
+        layerclient.on_message = on_message
+        layerclient.on_transfer = on_transfer
+        return layerclient
+
+    async def _run(self, region: str, func: typing.Callable[[LayerClient], T]) -> T:
+        """Calls func with a cancellable LayerClient in the thread pool, holding
+        a slot of region."""
+        cancelled = threading.Event()
+        layerclient = self._cancellable(cancelled)
+        loop = asyncio.get_event_loop()
+        async with self._semaphore(region):
+            future = loop.run_in_executor(self._executor, func, layerclient)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                cancelled.set()
+                # Let the thread stop and clean up before reporting the
+                # cancellation, so that no partial files are left behind.
+                await asyncio.wait([future])
+                raise
+
+    async def info(self, layer_arn: str) -> LayerVersion:
+        return await self._run(
+            Arn.parse(layer_arn).region,
+            lambda layerclient: layerclient.info(layer_arn),
+        )
+
+    async def download(
+        self,
+        layer_arn: str,
+        overwrite: bool = False,
+        outdir: typing.Optional[str] = None,
+    ) -> DownloadResult:
+        return await self._run(
+            Arn.parse(layer_arn).region,
+            lambda layerclient: layerclient.download(layer_arn, overwrite, outdir),
+        )
+
+    async def pull(
+        self,
+        layer_arn: str,
+        extract: typing.Optional[str] = None,
+        overwrite: bool = False,
+        incremental: bool = False,
+        include: typing.Optional[typing.Sequence[str]] = None,
+        exclude: typing.Optional[typing.Sequence[str]] = None,
+        outdir: typing.Optional[str] = None,
+    ) -> PullResult:
+        """See LayerClient.pull."""
+        return await self._run(
+            Arn.parse(layer_arn).region,
+            lambda layerclient: layerclient.pull(
+                layer_arn, extract, overwrite, incremental, include, exclude, outdir
+            ),
+        )
+
+    async def verify(
+        self,
+        layer_arn: str,
+        target: str,
+        include: typing.Optional[typing.Sequence[str]] = None,
+        exclude: typing.Optional[typing.Sequence[str]] = None,
+        index_file: typing.Optional[str] = None,
+        use_index: bool = True,
+        concurrency: int = DEFAULT_HASH_CONCURRENCY,
+    ) -> VerifyResult:
+        """See LayerClient.verify."""
+        return await self._run(
+            Arn.parse(layer_arn).region,
+            lambda layerclient: layerclient.verify(
+                layer_arn, target, include, exclude, index_file, use_index, concurrency
+            ),
+        )
+
+    async def diff(
+        self,
+        old: str,
+        new: str,
+        include: typing.Optional[typing.Sequence[str]] = None,
+        exclude: typing.Optional[typing.Sequence[str]] = None,
+        content: typing.Optional[typing.Sequence[str]] = None,
+    ) -> DiffResult:
+        """See LayerClient.diff. Takes a slot of the region of the first ARN
+        (of no region for two local zip files)."""
+        arns = [ref for ref in (old, new) if ref.startswith("arn:")]
+        return await self._run(
+            Arn.parse(arns[0]).region if arns else "",
+            lambda layerclient: layerclient.diff(old, new, include, exclude, content),
+        )
+
+    async def optimize(
+        self,
+        zipfilename: str,
+        output: typing.Optional[str] = None,
+        prune: typing.Optional[typing.Sequence[str]] = None,
+        overwrite: bool = False,
+        compress_concurrency: typing.Optional[int] = None,
+        compress_level: int = DEFAULT_COMPRESS_LEVEL,
+    ) -> OptimizeResult:
+        """See LayerClient.optimize. Local only, so it takes a slot of no
+        region."""
+        return await self._run(
+            "",
+            lambda layerclient: layerclient.optimize(
+                zipfilename,
+                output,
+                prune,
+                overwrite,
+                compress_concurrency,
+                compress_level,
+            ),
+        )
+
+    async def clone(
+        self,
+        layer_arn: str,
+        target_regions: typing.Optional[typing.List[str]] = None,
+        overwrite: bool = False,
+        force_publish: bool = False,
+        s3_staging_bucket: typing.Optional[str] = None,
+        s3_staging_prefix: str = DEFAULT_PREFIX,
+        outdir: typing.Optional[str] = None,
+    ) -> typing.List[CloneResult]:
+        """See LayerClient.clone."""
+        arn = Arn.parse(layer_arn)
+        layername = LayerResourceName.from_arn(arn).layer_name
+        on_message = self.layerclient.on_message
+        # Might load the botocore region data
+        regions = await asyncio.get_event_loop().run_in_executor(
+            self._executor,
+            resolve_target_regions,
+            target_regions,
+            arn.region,
+            self.layerclient.clients,
+        )
+        check_staging_bucket(s3_staging_bucket, regions)
+
+        layerinfo = await self._run(
+            arn.region, lambda layerclient: layerclient.query_layerinfo(layer_arn)
+        )
+        results = []  # type: typing.List[CloneResult]
+        if not force_publish:
+            on_message("looking for identical layer versions in " + ", ".join(regions))
+            found = await asyncio.gather(
+                *(
+                    self._run(
+                        region,
+                        lambda layerclient, region=region: (
+                            layerclient.find_existing_in_region(
+                                region, layername, layerinfo
+                            )
+                        ),
+                    )
+                    for region in regions
+                )
+            )
+            results = [result for result in found if result]
+            for result in results:
+                on_message("found existing " + result.layer_version_arn)
+            existing = {result.region for result in results}
+            regions = [region for region in regions if region not in existing]
+
+        if regions:
+            _layer, outfilename = await self._run(
+                arn.region,
+                lambda layerclient: layerclient.download(
+                    layer_arn, overwrite, outdir, layerinfo=layerinfo
+                ),
+            )
+            stagers = await self._run(
+                arn.region,
+                lambda layerclient: layerclient.stagers_for(
+                    regions,
+                    layername,
+                    layerinfo,
+                    outfilename,
+                    s3_staging_bucket,
+                    s3_staging_prefix,
+                ),
+            )
+            on_message("cloning layer to " + ", ".join(regions))
+
+            async def publish(region: str) -> CloneResult:
+                result = await self._run(
+                    region,
+                    lambda layerclient: clone_to_region(
+                        layerclient.clients.client("lambda", region),
+                        region,
+                        layername,
+                        layerinfo,
+                        stagers[region],
+                    ),
+                )
+                self.layerclient.remember_published(layername, layerinfo, result)
+                if result.error:
+                    on_message(
+                        "failed cloning to {}: {}".format(result.region, result.error)
+                    )
+                else:
+                    on_message("created " + result.layer_version_arn)
+                return result
+
+            results.extend(
+                await asyncio.gather(*(publish(region) for region in regions))
+            )
+        return checked_clone_results(results)
+
+    async def publish(
+        self,
+        layer_arn: str,
+        folder: str,
+        target_regions: typing.Optional[typing.List[str]] = None,
+        layer_name: typing.Optional[str] = None,
+        output: typing.Optional[str] = None,
+        overwrite: bool = False,
+        force_publish: bool = False,
+        s3_staging_bucket: typing.Optional[str] = None,
+        s3_staging_prefix: str = DEFAULT_PREFIX,
+        compress_concurrency: typing.Optional[int] = None,
+        compress_level: int = DEFAULT_COMPRESS_LEVEL,
+    ) -> PublishResult:
+        """See LayerClient.publish. Runs as one operation, which only takes a
+        slot of the region of layer_arn."""
+        return await self._run(
+            Arn.parse(layer_arn).region,
+            lambda layerclient: layerclient.publish(
+                layer_arn,
+                folder,
+                target_regions,
+                layer_name,
+                output,
+                overwrite,
+                force_publish,
+                s3_staging_bucket,
+                s3_staging_prefix,
+                compress_concurrency,
+                compress_level,
+            ),
+        )
+
+    async def sync(
+        self,
+        layer_arn: str,
+        target_regions: typing.Optional[typing.List[str]] = None,
+        state_file: typing.Optional[str] = None,
+        parallelism: int = DEFAULT_SYNC_PARALLELISM,
+        s3_staging_bucket: typing.Optional[str] = None,
+        s3_staging_prefix: str = DEFAULT_PREFIX,
+    ) -> typing.List[SyncRecord]:
+        """See LayerClient.sync. Runs as one operation, which only takes a slot
+        of the region of layer_arn."""
+        return await self._run(
+            Arn.parse(layer_arn).region,
+            lambda layerclient: layerclient.sync(
+                layer_arn,
+                target_regions,
+                state_file,
+                parallelism,
+                s3_staging_bucket,
+                s3_staging_prefix,
+            ),
+        )
+
+    async def discover(
+        self,
+        layers: typing.Sequence[str] = (),
+        regions: typing.Optional[typing.List[str]] = None,
+        profiles: typing.Optional[typing.Sequence[typing.Optional[str]]] = None,
+        names: typing.Optional[typing.Sequence[str]] = None,
+        runtimes: typing.Optional[typing.Sequence[str]] = None,
+        all_versions: bool = False,
+        parallelism: int = DEFAULT_DISCOVER_PARALLELISM,
+    ) -> typing.List[DiscoveredVersion]:
+        """See LayerClient.discover. Runs as one operation, which takes a slot
+        of no region."""
+        return await self._run(
+            "",
+            lambda layerclient: layerclient.discover(
+                layers, regions, profiles, names, runtimes, all_versions, parallelism
+            ),
+        )
@@ -0,0 +1,1818 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Python API for inspecting, downloading and cloning AWS Lambda layers.
+
+LayerClient returns typed results and raises LayerToolError subclasses
+instead of exiting; progress is reported through callbacks. A LayerClient
+reuses its boto3 sessions and clients, so a long-running process can use one
+instance for any number of operations (also from multiple threads)::
+
+    from dtawslayertool import LayerClient
+
+    layerclient = LayerClient()
+    result = layerclient.pull(layer_arn, extract="layer", overwrite=True)
+
+The command line interface (dtawslayertool.app) is a thin wrapper around it.
+"""
+
+import contextlib
+import fnmatch
+import functools
+import glob
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from os import path
+from typing import NamedTuple
+from zipfile import BadZipFile, ZipInfo
+
+from dtawslayertool.build import (
+    DEFAULT_COMPRESS_LEVEL,
+    BuildError,
+    BuildResult,
+    build_zip,
+    plan_repack,
+    write_zip,
+)
+from dtawslayertool.cache import (
+    LayerCache,
+    MetadataCache,
+    code_sha256,
+    default_cache_dir,
+)
+from dtawslayertool.clients import ClientRegistry
+from dtawslayertool.diff import DiffResult, content_diff, diff_entries
+from dtawslayertool.extract import (
+    DEFAULT_EXTRACT_CONCURRENCY,
+    ExtractError,
+    ExtractSummary,
+    ZipSource,
+    extract_all,
+    extract_incremental,
+    open_zipfile,
+)
+from dtawslayertool.optimize import OptimizeResult, zip_stats
+from dtawslayertool.remotezip import RangesNotSupported, RemoteZip, select_entries
+from dtawslayertool.staging import (
+    DEFAULT_PREFIX,
+    REGION_PLACEHOLDER,
+    S3Staging,
+    inline_content,
+)
+from dtawslayertool.sync import (
+    SyncRecord,
+    SyncState,
+    default_state_file,
+    layer_version_number,
+    plan_sync,
+)
+from dtawslayertool.timings import phase
+from dtawslayertool.transfer import (
+    ReportHook,
+    TransferCancelled,
+    TransferConfig,
+    TransferError,
+    UrlSource,
+    download_verified,
+)
+from dtawslayertool.verify import (
+    DEFAULT_HASH_CONCURRENCY,
+    HashIndex,
+    VerifyResult,
+    compare_entries,
+    default_index_file,
+    verify_tree,
+    zip_matches,
+)
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_PUBLISH_CONCURRENCY = 4
+DEFAULT_SYNC_PARALLELISM = 2
+DEFAULT_DISCOVER_PARALLELISM = 8
+# Maximum get_layer_version_by_arn calls of one search for an identical layer
+# version; versions beyond are only compared if their hash is already known.
+MAX_HASH_QUERIES = 20
+
+# Layer version meta information that is copied when cloning
+PUBLISHED_METADATA = ("Description", "CompatibleRuntimes", "LicenseInfo")
+
+
+#
+# Errors #
+#
+
+
+class LayerToolError(Exception):
+    """Base class of the errors raised by LayerClient operations."""
+
+
+class TargetExistsError(LayerToolError):
+    """The output file or folder exists and overwriting was not requested."""
+
+    def __init__(self, target: str):
+        super().__init__(target + " already exists")
+        self.target = target
+
+
+class DownloadError(LayerToolError):
+    """Downloading or reading the layer content failed."""
+
+
+class LayerExtractError(LayerToolError):
+    """Extracting the layer content failed."""
+
+
+class LayerBuildError(LayerToolError):
+    """Building a layer zip file from a folder failed."""
+
+
+class OperationCancelled(LayerToolError, TransferCancelled):
+    """Raised by an on_message or on_transfer callback to abort the running
+    operation. A partial download is removed."""
+
+
+class CloneError(LayerToolError):
+    """Publishing failed in at least one region. results holds the results
+    of all regions, including the successful ones."""
+
+    def __init__(self, message: str, results: typing.List["CloneResult"]):
+        super().__init__(message)
+        self.results = results
+
+
+class SyncError(LayerToolError):
+    """Mirroring failed for at least one layer version and region. records
+    holds the records of all versions and regions."""
+
+    def __init__(self, message: str, records: typing.List[SyncRecord]):
+        super().__init__(message)
+        self.records = records
+
+
+class DiscoverError(LayerToolError):
+    """Searching failed in all regions."""
+
+
+#
+# ARNs #
+#
+
+
+class Arn(NamedTuple):
+    partition: str
+    service: str
+    region: str
+    account_id: str
+    resource_type: str
+    resource_id: str
+
+    @classmethod
+    def parse(cls, raw: str) -> "Arn":
+        arn_prefix = "arn:"
+        if not raw.startswith(arn_prefix):
+            raise ValueError("Not an ARN (prefix missing): " + raw)
+        parts = raw[len(arn_prefix) :].split(":", 5)
+        if len(parts) == 5:
+            parts.insert(-2, None)  # resource-type is optional
+        if len(parts) != 6:
+            raise ValueError("ARN has too few parts: " + raw)
+        return cls._make(parts)
+
+    def __str__(self):
+        return "arn:" + ":".join(self)
+
+
+class LayerResourceName(NamedTuple):
+    layer_name: str
+    version: str
+
+    @classmethod
+    def parse(cls, raw: str) -> "LayerResourceName":
+        parts = raw.split(":", 2)
+        if len(parts) == 1:
+            return LayerResourceName(layer_name=parts[0], version=None)
+        if len(parts) > 2:
+            raise ValueError("Too many colons: " + raw)
+        return LayerResourceName._make(parts)
+
+    @classmethod
+    def from_arn(cls, arn: Arn) -> "LayerResourceName":
+        if arn.resource_type != "layer":
+            raise ValueError("Bad ARN type: " + arn.resource_type)
+        return cls.parse(arn.resource_id)
+
+    def __str__(self):
+        return ":".join(self)
+
+
+#
+# Results #
+#
+
+
+class LayerVersion(NamedTuple):
+    arn: str
+    version: int
+    code_sha256: str
+    code_size: int
+    description: typing.Optional[str]
+    compatible_runtimes: typing.List[str]
+    license_info: typing.Optional[str]
+    created_date: typing.Optional[str]
+    # The get_layer_version_by_arn response
+    layerinfo: dict
+
+    @classmethod
+    def from_layerinfo(cls, layerinfo: dict) -> "LayerVersion":
+        return cls(
+            arn=layerinfo["LayerVersionArn"],
+            version=layerinfo["Version"],
+            code_sha256=layerinfo["Content"]["CodeSha256"],
+            code_size=layerinfo["Content"]["CodeSize"],
+            description=layerinfo.get("Description"),
+            compatible_runtimes=layerinfo.get("CompatibleRuntimes", []),
+            license_info=layerinfo.get("LicenseInfo"),
+            created_date=layerinfo.get("CreatedDate"),
+            layerinfo=layerinfo,
+        )
+
+
+class DownloadResult(NamedTuple):
+    layer: LayerVersion
+    file: str
+
+
+class PullResult(NamedTuple):
+    layer: LayerVersion
+    # None if only the extracted entries were read remotely
+    file: typing.Optional[str]
+    extracted: typing.Optional[str]
+    # Only for incremental extraction
+    changes: typing.Optional[ExtractSummary] = None
+
+
+class CloneResult(NamedTuple):
+    region: str
+    layer_version_arn: typing.Optional[str]
+    seconds: float
+    hash_match: bool
+    error: typing.Optional[str]
+    existing: bool = False  # Found an identical version instead of publishing
+
+
+class DiscoveredVersion(NamedTuple):
+    profile: typing.Optional[str]
+    region: str
+    account_id: str
+    layer_name: str
+    version: int
+    arn: str
+    description: typing.Optional[str]
+    compatible_runtimes: typing.List[str]
+    compatible_architectures: typing.List[str]
+    license_info: typing.Optional[str]
+    created_date: typing.Optional[str]
+
+    @classmethod
+    def from_version(
+        cls, version: dict, profile: typing.Optional[str]
+    ) -> "DiscoveredVersion":
+        """Returns the result for a list_layers/list_layer_versions item."""
+        arn = Arn.parse(version["LayerVersionArn"])
+        resource_name = LayerResourceName.from_arn(arn)
+        return cls(
+            profile=profile,
+            region=arn.region,
+            account_id=arn.account_id,
+            layer_name=resource_name.layer_name,
+            version=int(resource_name.version),
+            arn=str(arn),
+            description=version.get("Description"),
+            compatible_runtimes=version.get("CompatibleRuntimes", []),
+            compatible_architectures=version.get("CompatibleArchitectures", []),
+            license_info=version.get("LicenseInfo"),
+            created_date=version.get("CreatedDate"),
+        )
+
+
+class PublishResult(NamedTuple):
+    build: BuildResult
+    # Sorted by region
+    results: typing.List[CloneResult]
+
+
+class LayerZip(NamedTuple):
+    layerinfo: dict
+    # The cached layer file or RemoteZip.open_zipfile
+    source: typing.Optional[ZipSource]
+    remote: typing.Optional[RemoteZip]
+
+    def infolist(self) -> typing.List[ZipInfo]:
+        with open_zipfile(self.source) as zipfile:
+            return zipfile.infolist()
+
+    def prefetch(self, entries: typing.List[ZipInfo]) -> int:
+        """Returns the number of bytes fetched, 0 for a cached layer."""
+        if self.remote:
+            return self.remote.prefetch(entries)
+        return 0
+
+
+#
+# Helpers without state #
+#
+
+
+def loglayerinfo(layerinfo, description: str):
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug("%s: %s", description, json.dumps(layerinfo, indent=2))
+
+
+def resolve_target_regions(
+    target_regions: typing.Optional[typing.List[str]],
+    source_region: str,
+    clients: ClientRegistry,
+    profile: typing.Optional[str] = None,
+) -> typing.List[str]:
+    if not target_regions:
+        return [source_region]
+    result = []
+    for region in target_regions:
+        if region == "all":
+            result.extend(clients.available_regions("lambda", profile))
+        else:
+            result.append(region)
+    return list(dict.fromkeys(result))  # Remove duplicates, keep order
+
+
+def check_staging_bucket(
+    s3_staging_bucket: typing.Optional[str], target_regions: typing.List[str]
+):
+    """Raises ValueError if the bucket name cannot be used for all regions."""
+    if s3_staging_bucket:
+        if len(target_regions) > 1 and REGION_PLACEHOLDER not in s3_staging_bucket:
+            raise ValueError(
+                "--s3-staging-bucket must contain {} when cloning to multiple"
+                " regions".format(REGION_PLACEHOLDER)
+            )
+
+
+def clone_to_region(
+    client,
+    region: str,
+    layername: str,
+    layerinfo,
+    stage: typing.Callable[[], typing.ContextManager[dict]],
+) -> CloneResult:
+    """Publishes the layer content and returns the result instead of raising.
+
+    stage provides the Content parameter for publish_layer_version.
+    """
+    start = time.monotonic()
+    codesize = layerinfo["Content"]["CodeSize"]
+    try:
+        with contextlib.ExitStack() as stack:
+            with phase("stage", region=region):
+                content = stack.enter_context(stage())
+            with phase("publish", codesize, region=region):
+                newlayerinfo = client.publish_layer_version(
+                    LayerName=layername,
+                    Content=content,
+                    **{
+                        key: layerinfo[key]
+                        for key in PUBLISHED_METADATA
+                        if layerinfo.get(key) is not None
+                    }
+                )
+    except Exception as exc:  # pylint:disable=broad-except
+        LOGGER.debug("Publishing to %s failed", region, exc_info=True)
+        return CloneResult(region, None, time.monotonic() - start, False, str(exc))
+    seconds = time.monotonic() - start
+    loglayerinfo(newlayerinfo, "new layer in " + region)
+    hash_match = (
+        newlayerinfo["Content"]["CodeSha256"] == layerinfo["Content"]["CodeSha256"]
+    )
+    return CloneResult(
+        region,
+        newlayerinfo["LayerVersionArn"],
+        seconds,
+        hash_match,
+        (
+            None
+            if hash_match
+            else "something went terribly wrong -"
+            " SHA256 fingerprint of source and cloned layer do not match."
+        ),
+    )
+
+
+def built_zip(zipfilename: str) -> BuildResult:
+    """Returns the BuildResult of an existing zip file."""
+    try:
+        with open_zipfile(zipfilename) as zipfile:
+            infolist = zipfile.infolist()
+    except BadZipFile as exc:
+        raise LayerBuildError("Cannot read {}: {}".format(zipfilename, exc)) from exc
+    return BuildResult(
+        zipfilename,
+        code_sha256(zipfilename),
+        path.getsize(zipfilename),
+        len(infolist),
+        sum(info.file_size for info in infolist),
+    )
+
+
+def list_layer_versions(client, layername: str) -> typing.List[str]:
+    """Returns the ARNs of all versions of the layer, newest first.
+
+    layername may also be the ARN of a layer (without version).
+    """
+    paginator = client.get_paginator("list_layer_versions")
+    return [
+        version["LayerVersionArn"]
+        for page in paginator.paginate(LayerName=layername)
+        for version in page["LayerVersions"]
+    ]
+
+
+class _HashIndex:
+    """The known versions of a layer in a region, by content hash."""
+
+    def __init__(self):
+        self.lock = threading.Lock()  # Held while searching
+        self.versions = set()  # type: typing.Set[str]
+        self.newest = {}  # type: typing.Dict[str, str]  # CodeSha256 -> ARN
+
+    def add(self, layer_version_arn: str, codesha256: str):
+        self.versions.add(layer_version_arn)
+        known = self.newest.get(codesha256)
+        if not known or layer_version_number(layer_version_arn) > (
+            layer_version_number(known)
+        ):
+            self.newest[codesha256] = layer_version_arn
+
+
+def unversioned_layer_arn(layer_arn: str) -> str:
+    """Returns the ARN of the layer of a layer (version) ARN."""
+    arn = Arn.parse(layer_arn)
+    layername = LayerResourceName.from_arn(arn).layer_name
+    return str(arn._replace(resource_id=layername))
+
+
+def matches_any(value: str, patterns: typing.Optional[typing.Sequence[str]]) -> bool:
+    return not patterns or any(
+        fnmatch.fnmatchcase(value, pattern) for pattern in patterns
+    )
+
+
+def layer_ids_in_region(layers: typing.Iterable[str], region: str) -> typing.List[str]:
+    """Returns the layer names and the ARNs (without version, moved to region)
+    of the layers given as name or ARN."""
+    result = []
+    for layer in layers:
+        if not layer.startswith("arn:"):
+            result.append(layer)
+            continue
+        arn = Arn.parse(layer)
+        layername = LayerResourceName.from_arn(arn).layer_name
+        result.append(str(arn._replace(region=region, resource_id=layername)))
+    return result
+
+
+def discover_in_region(
+    client,
+    profile: typing.Optional[str],
+    region: str,
+    layers: typing.Sequence[str] = (),
+    names: typing.Optional[typing.Sequence[str]] = None,
+    runtimes: typing.Optional[typing.Sequence[str]] = None,
+    all_versions: bool = False,
+) -> typing.List[DiscoveredVersion]:
+    """Returns the matching layer versions in region, see LayerClient.discover."""
+
+    def version_matches(version: dict) -> bool:
+        return not runtimes or any(
+            matches_any(runtime, runtimes)
+            for runtime in version.get("CompatibleRuntimes", [])
+        )
+
+    # The API filters by a single exact runtime only.
+    filterargs = {}
+    if runtimes and len(runtimes) == 1 and not glob.has_magic(runtimes[0]):
+        filterargs = dict(CompatibleRuntime=runtimes[0])
+
+    records = []
+    layer_ids = layer_ids_in_region(layers, region)
+    if not layers:
+        for page in client.get_paginator("list_layers").paginate(**filterargs):
+            for layer in page["Layers"]:
+                if not matches_any(layer["LayerName"], names):
+                    continue
+                latest = layer.get("LatestMatchingVersion")
+                if not all_versions and latest and version_matches(latest):
+                    records.append(DiscoveredVersion.from_version(latest, profile))
+                else:
+                    layer_ids.append(layer["LayerArn"])
+
+    for layer_id in layer_ids:
+        paginator = client.get_paginator("list_layer_versions")
+        try:
+            for page in paginator.paginate(LayerName=layer_id, **filterargs):
+                matching = [
+                    version
+                    for version in page["LayerVersions"]
+                    if version_matches(version)
+                ]
+                records.extend(
+                    DiscoveredVersion.from_version(version, profile)
+                    for version in (matching if all_versions else matching[:1])
+                )
+                if matching and not all_versions:
+                    break
+        except client.exceptions.ResourceNotFoundException:
+            LOGGER.debug("Layer %s not found in %s", layer_id, region)
+    return records
+
+
+def checked_clone_results(
+    results: typing.List[CloneResult],
+) -> typing.List[CloneResult]:
+    """Returns the results sorted by region, raises CloneError if any failed."""
+    results = sorted(results, key=lambda result: result.region)
+    failed = [result for result in results if result.error]
+    if len(results) == 1 and failed:
+        raise CloneError(failed[0].error, results)
+    if failed:
+        raise CloneError(
+            "cloning failed for {} of {} regions: {}".format(
+                len(failed),
+                len(results),
+                " ".join(result.region for result in failed),
+            ),
+            results,
+        )
+    return results
+
+
+def _no_message(_message: str):
+    pass
+
+
+#
+# The client #
+#
+
+
+class LayerClient:
+    """Layer operations with shared AWS clients and caches.
+
+    clients: the AWS clients to use. By default, a new ClientRegistry for the
+        default profile.
+    cache, metacache: the layer content and meta information caches, none
+        are used if None.
+    on_message: called with progress messages, e.g. "downloading ...".
+    on_transfer: called while downloading, with the signature of the
+        reporthook of urllib.request.urlretrieve.
+    Both callbacks may raise OperationCancelled to abort the operation.
+    """
+
+    def __init__(
+        self,
+        clients: typing.Optional[ClientRegistry] = None,
+        cache: typing.Optional[LayerCache] = None,
+        metacache: typing.Optional[MetadataCache] = None,
+        transferconfig: TransferConfig = TransferConfig(),
+        extract_concurrency: int = DEFAULT_EXTRACT_CONCURRENCY,
+        publish_concurrency: int = DEFAULT_PUBLISH_CONCURRENCY,
+        on_message: typing.Callable[[str], None] = _no_message,
+        on_transfer: typing.Optional[ReportHook] = None,
+    ):
+        self.clients = clients or ClientRegistry()
+        self.cache = cache
+        self.metacache = metacache
+        self.transferconfig = transferconfig
+        self.extract_concurrency = extract_concurrency
+        self.publish_concurrency = publish_concurrency
+        self.on_message = on_message
+        self.on_transfer = on_transfer
+        # Layer versions are immutable, so their content hashes are kept for
+        # the lifetime of the client, also without metadata cache.
+        self._code_sha256s = {}  # type: typing.Dict[str, str]
+        # (region, layer name) -> versions by content hash, for finding
+        # identical versions without querying all of them again
+        self._hash_indexes = {}  # type: typing.Dict[tuple, _HashIndex]
+        self._hash_indexes_lock = threading.Lock()
+
+    def lambda_client(self, layer_arn: str):
+        """Returns the Lambda client for the region of layer_arn."""
+        return self.clients.client("lambda", Arn.parse(layer_arn).region)
+
+    #
+    # Meta information
+    #
+
+    def query_layerinfo(
+        self,
+        layer_arn: str,
+        need_location: bool = True,
+        refresh: bool = False,
+        quiet: bool = False,
+    ) -> dict:
+        """Returns the layer version info, from the metadata cache if possible.
+
+        If need_location is false, the returned info may lack Content.Location.
+        With refresh, the info is always queried (and updated in the cache).
+        With quiet, no progress messages are reported.
+        """
+        on_message = _no_message if quiet else self.on_message
+        if self.metacache and not refresh:
+            result = self.metacache.lookup(layer_arn)
+            if result and (not need_location or "Location" in result["Content"]):
+                on_message(
+                    "using cached layer version meta information for " + layer_arn
+                )
+                loglayerinfo(result, "cached layer info for " + layer_arn)
+                return result
+        on_message("querying layer version meta information for " + layer_arn)
+        with phase("metadata", arn=layer_arn):
+            result = self.lambda_client(layer_arn).get_layer_version_by_arn(
+                Arn=layer_arn
+            )
+        loglayerinfo(result, "layer info for " + layer_arn)
+        if self.metacache:
+            self.metacache.store(layer_arn, result)
+        return result
+
+    def known_code_sha256(self, layer_arn: str) -> typing.Optional[str]:
+        """Returns the CodeSha256 of the layer version if it is known without
+        querying it, from this client or the metadata cache."""
+        codesha256 = self._code_sha256s.get(layer_arn)
+        if codesha256 is None and self.metacache:
+            info = self.metacache.lookup(layer_arn)
+            if info:
+                codesha256 = self._code_sha256s[layer_arn] = info["Content"][
+                    "CodeSha256"
+                ]
+        return codesha256
+
+    def code_sha256_of(self, layer_arn: str) -> str:
+        """Returns the CodeSha256 of the layer version, queried only once per
+        client (and not at all if it is in the metadata cache)."""
+        codesha256 = self.known_code_sha256(layer_arn)
+        if codesha256 is None:
+            info = self.query_layerinfo(layer_arn, need_location=False, quiet=True)
+            codesha256 = self._code_sha256s[layer_arn] = info["Content"]["CodeSha256"]
+        return codesha256
+
+    def info(self, layer_arn: str) -> LayerVersion:
+        """Returns the meta information of the layer version."""
+        return LayerVersion.from_layerinfo(
+            self.query_layerinfo(layer_arn, need_location=False)
+        )
+
+    def location_refresher(
+        self, layer_arn: str, expecthash: str
+    ) -> typing.Callable[[], str]:
+        def refresh_location() -> str:
+            # The presigned Location URL expires after a few minutes.
+            newlayerinfo = self.query_layerinfo(layer_arn, refresh=True)
+            if newlayerinfo["Content"]["CodeSha256"] != expecthash:
+                raise TransferError(
+                    "Layer content changed during download -- SHA256 is now {}".format(
+                        newlayerinfo["Content"]["CodeSha256"]
+                    )
+                )
+            return newlayerinfo["Content"]["Location"]
+
+        return refresh_location
+
+    #
+    # Download & pull
+    #
+
+    def download(
+        self,
+        layer_arn: str,
+        overwrite: bool = False,
+        outdir: typing.Optional[str] = None,
+        layerinfo: typing.Optional[dict] = None,
+    ) -> DownloadResult:
+        """Downloads the layer to <layer name>-v<version>.zip in outdir (default:
+        the working directory). layerinfo is queried unless given."""
+        layername = LayerResourceName.from_arn(Arn.parse(layer_arn))
+        outfilename = "{}-v{}.zip".format(*layername)
+        if outdir:
+            outfilename = path.join(outdir, outfilename)
+
+        if path.exists(outfilename) and not overwrite:
+            raise TargetExistsError(outfilename)
+
+        if not layerinfo:
+            layerinfo = self.query_layerinfo(layer_arn)
+        codesize = layerinfo["Content"]["CodeSize"]  # type: int
+        expecthash = layerinfo["Content"]["CodeSha256"]
+        result = DownloadResult(LayerVersion.from_layerinfo(layerinfo), outfilename)
+
+        # Never write through an existing file, it might be linked to a cache entry.
+        if path.lexists(outfilename):
+            os.remove(outfilename)
+
+        if self.cache:
+            with phase("cache", arn=layer_arn) as cachephase:
+                method = self.cache.materialize(expecthash, outfilename, size=codesize)
+                cachephase.nbytes = codesize if method else 0
+            if method:
+                self.on_message(
+                    "using cached layer content for {} ({})".format(layer_arn, method)
+                )
+                self.on_message("downloaded layer content to " + outfilename)
+                return result
+
+        self.on_message(
+            "downloading {} content [{} bytes] to {} ...".format(
+                layer_arn, codesize, outfilename
+            )
+        )
+        # Size & SHA256 are verified while downloading, so the file is never read back.
+        try:
+            with phase("download", codesize, arn=layer_arn):
+                httpheaders = download_verified(
+                    layerinfo["Content"]["Location"],
+                    outfilename,
+                    codesize,
+                    expecthash,
+                    reporthook=self.on_transfer,
+                    config=self.transferconfig,
+                    refresh_url=self.location_refresher(layer_arn, expecthash),
+                )
+        except TransferError as exc:
+            raise DownloadError(str(exc)) from exc
+        LOGGER.debug("Retrieved layer with HTTP response metadata:\n%s", httpheaders)
+
+        if self.cache:
+            with phase("cache-store", codesize, arn=layer_arn):
+                self.cache.store(outfilename, expecthash)
+        self.on_message("downloaded layer content to " + outfilename)
+        return result
+
+    def open_layer_zip(
+        self, layer_arn: str, layerinfo: typing.Optional[dict] = None
+    ) -> LayerZip:
+        """Opens the layer's zip file for random access, without downloading it.
+
+        Uses the cached layer if available, Range requests otherwise. If the
+        server does not support Range requests, the returned source is None.
+        layerinfo is queried unless given.
+        """
+        if not layerinfo:
+            layerinfo = self.query_layerinfo(layer_arn)
+        content = layerinfo["Content"]
+        if self.cache:
+            entry = self.cache.lookup(content["CodeSha256"], content["CodeSize"])
+            if entry:
+                self.on_message("using cached layer content for " + layer_arn)
+                return LayerZip(
+                    layerinfo, self.cache.entry_path(content["CodeSha256"]), None
+                )
+        self.on_message("reading central directory of " + layer_arn)
+        source = UrlSource(
+            content["Location"],
+            self.location_refresher(layer_arn, content["CodeSha256"]),
+            self.transferconfig.timeouts,
+        )
+        try:
+            remote = RemoteZip(
+                source, content["CodeSize"], self.transferconfig.concurrency
+            )
+        except RangesNotSupported as exc:
+            LOGGER.info("Cannot read %s remotely: %s", layer_arn, exc)
+            return LayerZip(layerinfo, None, None)
+        except (TransferError, BadZipFile) as exc:
+            raise DownloadError("Cannot read {}: {}".format(layer_arn, exc)) from exc
+        return LayerZip(layerinfo, remote.open_zipfile, remote)
+
+    def list_contents(
+        self,
+        layer_arn: str,
+        include: typing.Optional[typing.Sequence[str]] = None,
+        exclude: typing.Optional[typing.Sequence[str]] = None,
+    ) -> typing.List[ZipInfo]:
+        """Returns the (selected) entries of the layer's zip file, without
+        downloading the whole layer."""
+        layerzip = self.open_layer_zip(layer_arn)
+        if not layerzip.source:
+            raise DownloadError(
+                "Cannot list {}: the server does not support range requests,"
+                " pull the layer instead".format(layer_arn)
+            )
+        try:
+            return select_entries(layerzip.infolist(), include, exclude)
+        except (BadZipFile, TransferError) as exc:
+            raise DownloadError("Cannot read {}: {}".format(layer_arn, exc)) from exc
+
+    def pull(
+        self,
+        layer_arn: str,
+        extract: typing.Optional[str] = None,
+        overwrite: bool = False,
+        incremental: bool = False,
+        include: typing.Optional[typing.Sequence[str]] = None,
+        exclude: typing.Optional[typing.Sequence[str]] = None,
+        outdir: typing.Optional[str] = None,
+    ) -> PullResult:
+        """Downloads the layer and extracts it to the folder extract, if given.
+
+        With incremental, an existing extraction is updated in place. With
+        include/exclude, only the selected entries are extracted and, if the
+        server supports it, read without downloading the whole layer.
+        """
+        selective = include or exclude
+        if selective and not extract:
+            raise ValueError("--include and --exclude require --extract")
+        need_clean = False
+        update = False  # incremental, and there is something to update
+        if extract and path.exists(extract):
+            if not overwrite:
+                raise TargetExistsError(extract)
+            if incremental and path.isdir(extract):
+                update = True
+            else:
+                need_clean = True
+
+        layerzip = None
+        if selective:
+            with phase("list", arn=layer_arn):
+                layerzip = self.open_layer_zip(layer_arn)
+            if not layerzip.source:
+                self.on_message(
+                    "range requests not supported, downloading the whole layer"
+                )
+        if layerzip and layerzip.source:
+            source = layerzip.source  # type: ZipSource
+            layer = LayerVersion.from_layerinfo(layerzip.layerinfo)
+            outfilename = None
+        else:
+            layer, outfilename = self.download(
+                layer_arn,
+                overwrite,
+                outdir,
+                layerinfo=layerzip.layerinfo if layerzip else None,
+            )
+            source = outfilename
+        result = PullResult(layer, outfilename, extract)
+        if not extract:
+            return result
+
+        entries = None
+        if selective:
+            with open_zipfile(source) as zipfile:
+                allentries = zipfile.infolist()
+            entries = select_entries(allentries, include, exclude)
+            self.on_message(
+                "selected {} of {} entries".format(len(entries), len(allentries))
+            )
+            if layerzip:
+                with phase("fetch", arn=layer_arn) as fetchphase:
+                    fetchphase.nbytes = layerzip.prefetch(entries)
+        if need_clean:
+            if path.isdir(extract) and not path.islink(extract):
+                shutil.rmtree(extract)
+            else:
+                os.remove(extract)
+        self.on_message('extracting layer contents to "{}"'.format(extract))
+        try:
+            with phase("extract", arn=layer_arn) as extractphase:
+                if update:
+                    summary = extract_incremental(
+                        source, extract, self.extract_concurrency, entries
+                    )
+                    self.on_message("updated {}: {}".format(extract, summary))
+                    return result._replace(changes=summary)
+                extracted = extract_all(
+                    source, extract, self.extract_concurrency, entries
+                )
+                extractphase.nbytes = sum(entry.info.file_size for entry in extracted)
+        except (ExtractError, BadZipFile, TransferError) as exc:
+            raise LayerExtractError(
+                "Cannot extract {}: {}".format(outfilename or layer_arn, exc)
+            ) from exc
+        return result
+
+    #
+    # Verify
+    #
+
+    def published_entries(
+        self, layer_arn: str, layerinfo: typing.Optional[dict] = None
+    ) -> typing.List[ZipInfo]:
+        """Returns the entries of the layer's zip file, reading only its central
+        directory if the server supports it. layerinfo is queried unless given."""
+        layerzip = self.open_layer_zip(layer_arn, layerinfo)
+        if not layerzip.source:
+            self.on_message("range requests not supported, downloading the whole layer")
+            with tempfile.TemporaryDirectory() as tmpdir:
+                _layer, outfilename = self.download(
+                    layer_arn, outdir=tmpdir, layerinfo=layerzip.layerinfo
+                )
+                with open_zipfile(outfilename) as zipfile:
+                    return zipfile.infolist()
+        try:
+            return layerzip.infolist()
+        except (BadZipFile, TransferError) as exc:
+            raise DownloadError("Cannot read {}: {}".format(layer_arn, exc)) from exc
+
+    def verify(
+        self,
+        layer_arn: str,
+        target: str,
+        include: typing.Optional[typing.Sequence[str]] = None,
+        exclude: typing.Optional[typing.Sequence[str]] = None,
+        index_file: typing.Optional[str] = None,
+        use_index: bool = True,
+        concurrency: int = DEFAULT_HASH_CONCURRENCY,
+    ) -> VerifyResult:
+        """Checks a local zip file or extracted folder against the layer version.
+
+        A zip file must have the layer's CodeSha256; if it has not, its entries
+        are compared with the layer's to tell what differs. A folder must hold
+        the (selected) files of the layer with the same size and CRC32, and no
+        others. The hashes are recorded in index_file (default: the target
+        path plus .hashes.json) unless use_index is false.
+        """
+        if not path.exists(target):
+            raise ValueError("{} does not exist".format(target))
+        isdir = path.isdir(target)
+        if (include or exclude) and not isdir:
+            raise ValueError("--include and --exclude require an extracted folder")
+        index = HashIndex(
+            (index_file or default_index_file(target)) if use_index else None,
+            "crc32" if isdir else "sha256",
+        )
+        index.load()
+
+        if isdir:
+            with phase("list", arn=layer_arn):
+                entries = self.published_entries(layer_arn)
+            self.on_message("verifying {} against {}".format(target, layer_arn))
+            with phase("verify", arn=layer_arn) as verifyphase:
+                result = verify_tree(
+                    target, entries, index, concurrency, include, exclude
+                )
+                verifyphase.nbytes = index.hashed_bytes
+            return result
+
+        layerinfo = self.query_layerinfo(layer_arn)
+        layer = LayerVersion.from_layerinfo(layerinfo)
+        self.on_message("verifying {} against {}".format(target, layer_arn))
+        with phase("verify", arn=layer_arn) as verifyphase:
+            match = zip_matches(target, layer.code_sha256, layer.code_size, index)
+            verifyphase.nbytes = index.hashed_bytes
+        try:
+            with open_zipfile(target) as zipfile:
+                actual = zipfile.infolist()
+        except BadZipFile as exc:
+            self.on_message("{} is not a valid zip file: {}".format(target, exc))
+            return VerifyResult(target, False, [], [], [], 0, index.misses)
+        if match:
+            verified = sum(not info.is_dir() for info in actual)
+            return VerifyResult(target, True, [], [], [], verified, index.misses)
+
+        self.on_message(
+            "{} does not have CodeSha256 {}, comparing entries".format(
+                target, layer.code_sha256
+            )
+        )
+        with phase("list", arn=layer_arn):
+            missing, changed, extra, verified = compare_entries(
+                self.published_entries(layer_arn, layerinfo), actual
+            )
+        return VerifyResult(
+            target, False, missing, changed, extra, verified, index.misses
+        )
+
+    #
+    # Diff
+    #
+
+    def open_compared_zip(
+        self, ref: str, stack: contextlib.ExitStack
+    ) -> typing.Tuple[ZipSource, typing.Optional[LayerZip]]:
+        """Opens a local zip file or, for an ARN, the layer's zip file for
+        random access. If the server does not support Range requests, the layer
+        is downloaded to a temporary folder that lives as long as stack."""
+        if not ref.startswith("arn:"):
+            if not path.isfile(ref):
+                raise ValueError("{} is neither a zip file nor a layer ARN".format(ref))
+            return ref, None
+        layerzip = self.open_layer_zip(ref)
+        if layerzip.source:
+            return layerzip.source, layerzip
+        self.on_message("range requests not supported, downloading the whole layer")
+        tmpdir = stack.enter_context(tempfile.TemporaryDirectory())
+        _layer, outfilename = self.download(
+            ref, outdir=tmpdir, layerinfo=layerzip.layerinfo
+        )
+        return outfilename, None
+
+    def diff(
+        self,
+        old: str,
+        new: str,
+        include: typing.Optional[typing.Sequence[str]] = None,
+        exclude: typing.Optional[typing.Sequence[str]] = None,
+        content: typing.Optional[typing.Sequence[str]] = None,
+    ) -> DiffResult:
+        """Compares two layer versions (ARNs) or local zip files.
+
+        Only the central directories are read, by Range requests for layers
+        that are not cached. The (selected) files are compared by size, CRC32
+        and mode. Unified diffs are made of the changed files matching the
+        content glob patterns; only these files are fetched.
+        """
+        with contextlib.ExitStack() as stack:
+            sources = []
+            infolists = []
+            for ref in (old, new):
+                with phase("list", arn=ref):
+                    source, layerzip = self.open_compared_zip(ref, stack)
+                    try:
+                        with open_zipfile(source) as zipfile:
+                            infolists.append(zipfile.infolist())
+                    except (BadZipFile, TransferError) as exc:
+                        raise DownloadError(
+                            "Cannot read {}: {}".format(ref, exc)
+                        ) from exc
+                sources.append((ref, source, layerzip))
+            changes, unchanged = diff_entries(
+                *(select_entries(infos, include, exclude) for infos in infolists)
+            )
+            contents = {}  # type: typing.Dict[str, str]
+            if not content:
+                return DiffResult(old, new, changes, unchanged, contents)
+
+            changed = {change.name for change in changes}
+            data = {}  # type: typing.Dict[typing.Tuple[int, str], bytes]
+            for side, (ref, source, layerzip) in enumerate(sources):
+                entries = [
+                    info
+                    for info in select_entries(infolists[side], content)
+                    if info.filename in changed
+                ]
+                if not entries:
+                    continue
+                with phase("fetch", arn=ref) as fetchphase:
+                    try:
+                        if layerzip:
+                            fetchphase.nbytes = layerzip.prefetch(entries)
+                        with open_zipfile(source) as zipfile:
+                            for info in entries:
+                                data[side, info.filename] = zipfile.read(info)
+                    except (BadZipFile, TransferError) as exc:
+                        raise DownloadError(
+                            "Cannot read {}: {}".format(ref, exc)
+                        ) from exc
+            for change in changes:
+                if (0, change.name) in data or (1, change.name) in data:
+                    contents[change.name] = content_diff(
+                        change.name,
+                        data.get((0, change.name)),
+                        data.get((1, change.name)),
+                    )
+            return DiffResult(old, new, changes, unchanged, contents)
+
+    #
+    # Optimize
+    #
+
+    def optimize(
+        self,
+        zipfilename: str,
+        output: typing.Optional[str] = None,
+        prune: typing.Optional[typing.Sequence[str]] = None,
+        overwrite: bool = False,
+        compress_concurrency: typing.Optional[int] = None,
+        compress_level: int = DEFAULT_COMPRESS_LEVEL,
+    ) -> OptimizeResult:
+        """Repacks a layer zip file without the entries matching the prune glob
+        patterns, recompressing all files at compress_level.
+
+        The result is written to output (default: the zip file path with
+        -optimized before .zip) and is deterministic like the zip files of
+        publish, which can publish it.
+        """
+        if not path.isfile(zipfilename):
+            raise ValueError("{} is not a file".format(zipfilename))
+        outfilename = output or path.splitext(zipfilename)[0] + "-optimized.zip"
+        if path.lexists(outfilename) and not overwrite:
+            raise TargetExistsError(outfilename)
+        try:
+            with open_zipfile(zipfilename) as zipfile:
+                infolist = zipfile.infolist()
+        except BadZipFile as exc:
+            raise LayerBuildError(
+                "Cannot read {}: {}".format(zipfilename, exc)
+            ) from exc
+        kept = select_entries(infolist, exclude=prune)
+        keptnames = {info.filename for info in kept}
+        pruned = sorted(
+            info.filename
+            for info in infolist
+            if info.filename not in keptnames and not info.is_dir()
+        )
+        self.on_message(
+            "repacking {} to {}, pruning {} of {} files".format(
+                zipfilename,
+                outfilename,
+                len(pruned),
+                sum(not info.is_dir() for info in infolist),
+            )
+        )
+        try:
+            with phase("build") as buildphase:
+                built = write_zip(
+                    plan_repack(zipfilename, kept),
+                    outfilename,
+                    compress_concurrency,
+                    compress_level,
+                )
+                buildphase.nbytes = built.size
+            with open_zipfile(outfilename) as zipfile:
+                after = zip_stats(outfilename, zipfile.infolist())
+        except (BuildError, BadZipFile, OSError) as exc:
+            raise LayerBuildError(
+                "Cannot build {}: {}".format(outfilename, exc)
+            ) from exc
+        return OptimizeResult(
+            outfilename,
+            built.code_sha256,
+            zip_stats(zipfilename, infolist),
+            after,
+            pruned,
+        )
+
+    #
+    # Clone
+    #
+
+    def find_layer_version(
+        self, client, layername: str, codesha256: str
+    ) -> typing.Optional[str]:
+        """Returns the ARN of the newest version of the layer (in the account and
+        region of client) with the given content, None if there is none.
+
+        Versions are compared by the hash index of the layer, which keeps the
+        hashes of all versions seen (or published) by this client. Versions
+        not indexed yet are compared newest first, but at most MAX_HASH_QUERIES
+        of them are queried; older ones are only compared if their hash is in
+        the metadata cache.
+        """
+        index = self.hash_index(client.meta.region_name, layername)
+        with index.lock:
+            nqueried = 0
+            paginator = client.get_paginator("list_layer_versions")
+            for page in paginator.paginate(LayerName=layername):
+                for version in page["LayerVersions"]:
+                    arn = version["LayerVersionArn"]
+                    if arn in index.versions:
+                        continue
+                    versionhash = self.known_code_sha256(arn)
+                    if versionhash is None:
+                        if nqueried >= MAX_HASH_QUERIES:
+                            continue
+                        nqueried += 1
+                        versionhash = self.code_sha256_of(arn)
+                    index.add(arn, versionhash)
+            if nqueried >= MAX_HASH_QUERIES:
+                LOGGER.info(
+                    "Only compared the newest %d unknown versions of %s in %s",
+                    MAX_HASH_QUERIES,
+                    layername,
+                    client.meta.region_name,
+                )
+            return index.newest.get(codesha256)
+
+    def hash_index(self, region: str, layername: str) -> _HashIndex:
+        with self._hash_indexes_lock:
+            return self._hash_indexes.setdefault((region, layername), _HashIndex())
+
+    def remember_published(self, layername: str, layerinfo, result: CloneResult):
+        """Adds a published layer version to the hash index of its layer."""
+        if result.layer_version_arn and result.hash_match:
+            codesha256 = layerinfo["Content"]["CodeSha256"]
+            self._code_sha256s[result.layer_version_arn] = codesha256
+            index = self.hash_index(result.region, layername)
+            with index.lock:
+                index.add(result.layer_version_arn, codesha256)
+
+    def find_existing_in_region(
+        self, region: str, layername: str, layerinfo
+    ) -> typing.Optional[CloneResult]:
+        """Returns the result for an identical existing version, None if the layer
+        needs to be published (also if looking for one failed)."""
+        start = time.monotonic()
+        try:
+            arn = self.find_layer_version(
+                self.clients.client("lambda", region),
+                layername,
+                layerinfo["Content"]["CodeSha256"],
+            )
+        except Exception as exc:  # pylint:disable=broad-except
+            LOGGER.info("Cannot list layer versions in %s: %s", region, exc)
+            return None
+        if not arn:
+            return None
+        return CloneResult(
+            region, arn, time.monotonic() - start, True, None, existing=True
+        )
+
+    def find_existing_versions(
+        self, regions: typing.List[str], layername: str, layerinfo
+    ) -> typing.List[CloneResult]:
+        self.on_message("looking for identical layer versions in " + ", ".join(regions))
+        results = []
+        with ThreadPoolExecutor(
+            min(self.publish_concurrency, len(regions)), thread_name_prefix="lookup"
+        ) as executor:
+            futures = [
+                executor.submit(
+                    self.find_existing_in_region, region, layername, layerinfo
+                )
+                for region in regions
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                if result:
+                    self.on_message("found existing " + result.layer_version_arn)
+                    results.append(result)
+        return results
+
+    def stagers_for(
+        self,
+        target_regions: typing.List[str],
+        layername: str,
+        layerinfo,
+        outfilename: str,
+        s3_staging_bucket: typing.Optional[str] = None,
+        s3_staging_prefix: str = DEFAULT_PREFIX,
+    ) -> typing.Dict[str, typing.Callable[[], typing.ContextManager[dict]]]:
+        """Returns the stage argument of clone_to_region for each region."""
+        if s3_staging_bucket:
+            staging = S3Staging(
+                s3_staging_bucket,
+                s3_staging_prefix,
+                outfilename,
+                layername,
+                layerinfo["Content"]["CodeSha256"],
+                part_size=self.transferconfig.part_size,
+                concurrency=self.transferconfig.concurrency,
+            )
+            return {
+                region: functools.partial(
+                    staging.stage, self.clients.client("s3", region), region
+                )
+                for region in target_regions
+            }
+        # We need to read the whole file into memory at once,
+        # the API won't accept it any other way.
+        with phase("read", path.getsize(outfilename)), open(
+            outfilename, "rb"
+        ) as filehandle:
+            layercontent = filehandle.read()
+        return {
+            region: functools.partial(inline_content, layercontent)
+            for region in target_regions
+        }
+
+    def publish_to_regions(
+        self,
+        target_regions: typing.List[str],
+        layername: str,
+        layerinfo,
+        outfilename: str,
+        s3_staging_bucket: typing.Optional[str] = None,
+        s3_staging_prefix: str = DEFAULT_PREFIX,
+    ) -> typing.List[CloneResult]:
+        stagers = self.stagers_for(
+            target_regions,
+            layername,
+            layerinfo,
+            outfilename,
+            s3_staging_bucket,
+            s3_staging_prefix,
+        )
+        self.on_message("cloning layer to " + ", ".join(target_regions))
+        results = []
+        with ThreadPoolExecutor(
+            min(self.publish_concurrency, len(target_regions)),
+            thread_name_prefix="publish",
+        ) as executor:
+            futures = [
+                executor.submit(
+                    clone_to_region,
+                    self.clients.client("lambda", region),
+                    region,
+                    layername,
+                    layerinfo,
+                    stagers[region],
+                )
+                for region in target_regions
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                self.remember_published(layername, layerinfo, result)
+                if result.error:
+                    self.on_message(
+                        "failed cloning to {}: {}".format(result.region, result.error)
+                    )
+                else:
+                    self.on_message("created " + result.layer_version_arn)
+        return results
+
+    def clone(
+        self,
+        layer_arn: str,
+        target_regions: typing.Optional[typing.List[str]] = None,
+        overwrite: bool = False,
+        force_publish: bool = False,
+        s3_staging_bucket: typing.Optional[str] = None,
+        s3_staging_prefix: str = DEFAULT_PREFIX,
+        outdir: typing.Optional[str] = None,
+    ) -> typing.List[CloneResult]:
+        """Publishes the layer version in the target regions ("all" for all
+        regions that support Lambda; default: the region of layer_arn) of the
+        account of the clients.
+
+        Unless force_publish is set, an existing version with the same content
+        is reported instead of publishing a new one. Raises CloneError if
+        publishing failed in any region. The results are sorted by region.
+        """
+        arn = Arn.parse(layer_arn)
+        regions = resolve_target_regions(target_regions, arn.region, self.clients)
+        layername = LayerResourceName.from_arn(arn).layer_name
+        check_staging_bucket(s3_staging_bucket, regions)
+
+        layerinfo = self.query_layerinfo(layer_arn)
+        results = []
+        if not force_publish:
+            with phase("lookup", arn=layer_arn):
+                results = self.find_existing_versions(regions, layername, layerinfo)
+            found = {result.region for result in results}
+            regions = [region for region in regions if region not in found]
+        if regions:
+            _layer, outfilename = self.download(
+                layer_arn, overwrite, outdir, layerinfo=layerinfo
+            )
+            results.extend(
+                self.publish_to_regions(
+                    regions,
+                    layername,
+                    layerinfo,
+                    outfilename,
+                    s3_staging_bucket,
+                    s3_staging_prefix,
+                )
+            )
+
+        return checked_clone_results(results)
+
+    def publish(
+        self,
+        layer_arn: str,
+        folder: str,
+        target_regions: typing.Optional[typing.List[str]] = None,
+        layer_name: typing.Optional[str] = None,
+        output: typing.Optional[str] = None,
+        overwrite: bool = False,
+        force_publish: bool = False,
+        s3_staging_bucket: typing.Optional[str] = None,
+        s3_staging_prefix: str = DEFAULT_PREFIX,
+        compress_concurrency: typing.Optional[int] = None,
+        compress_level: int = DEFAULT_COMPRESS_LEVEL,
+    ) -> PublishResult:
+        """Builds a zip file from folder and publishes it as a new version of the
+        layer of layer_arn (or of layer_name) in the target regions.
+
+        The new version gets the description, compatible runtimes and license
+        of the layer version layer_arn, like a clone. The zip file is written
+        to output (default: the folder path plus .zip) and is deterministic,
+        so unless force_publish is set, an existing version with the same
+        content is reported instead of publishing a new one. Raises CloneError
+        if publishing failed in any region.
+
+        If folder is a zip file (e.g. of optimize), it is published as is.
+        """
+        arn = Arn.parse(layer_arn)
+        regions = resolve_target_regions(target_regions, arn.region, self.clients)
+        layername = layer_name or LayerResourceName.from_arn(arn).layer_name
+        check_staging_bucket(s3_staging_bucket, regions)
+        if path.isfile(folder):
+            if output:
+                raise ValueError("--output requires a folder to build")
+            outfilename = folder
+        elif path.isdir(folder):
+            outfilename = output or path.normpath(folder) + ".zip"
+            if path.lexists(outfilename) and not overwrite:
+                raise TargetExistsError(outfilename)
+        else:
+            raise ValueError("{} is neither a folder nor a zip file".format(folder))
+
+        sourceinfo = self.query_layerinfo(layer_arn, need_location=False)
+        if outfilename == folder:
+            built = built_zip(folder)
+        else:
+            self.on_message("building {} from {}".format(outfilename, folder))
+            try:
+                with phase("build") as buildphase:
+                    built = build_zip(
+                        folder, outfilename, compress_concurrency, compress_level
+                    )
+                    buildphase.nbytes = built.size
+            except (BuildError, OSError) as exc:
+                raise LayerBuildError(
+                    "Cannot build {}: {}".format(outfilename, exc)
+                ) from exc
+            self.on_message(
+                "built {} [{} entries, {} bytes, CodeSha256 {}]".format(
+                    outfilename, built.entries, built.code_size, built.code_sha256
+                )
+            )
+        # The new content with the metadata of the source version
+        layerinfo = dict(
+            sourceinfo,
+            Content=dict(CodeSha256=built.code_sha256, CodeSize=built.code_size),
+        )
+
+        results = []
+        if not force_publish:
+            with phase("lookup", arn=layer_arn):
+                results = self.find_existing_versions(regions, layername, layerinfo)
+            found = {result.region for result in results}
+            regions = [region for region in regions if region not in found]
+        if regions:
+            results.extend(
+                self.publish_to_regions(
+                    regions,
+                    layername,
+                    layerinfo,
+                    outfilename,
+                    s3_staging_bucket,
+                    s3_staging_prefix,
+                )
+            )
+        return PublishResult(built, checked_clone_results(results))
+
+    #
+    # Sync
+    #
+
+    def sync(
+        self,
+        layer_arn: str,
+        target_regions: typing.Optional[typing.List[str]] = None,
+        state_file: typing.Optional[str] = None,
+        parallelism: int = DEFAULT_SYNC_PARALLELISM,
+        s3_staging_bucket: typing.Optional[str] = None,
+        s3_staging_prefix: str = DEFAULT_PREFIX,
+    ) -> typing.List[SyncRecord]:
+        """Mirrors all versions of the layer of layer_arn (with or without
+        version) to the target regions, oldest first.
+
+        Which target version each source version was mirrored to is recorded
+        in state_file (default: a file in the directory of the layer cache),
+        so that later runs only list the versions. Versions that are not
+        recorded are matched by content hash, or else published; up to
+        parallelism versions are downloaded ahead of publishing. Raises
+        SyncError if mirroring failed for any version and region.
+        """
+        arn = Arn.parse(layer_arn)
+        layername = LayerResourceName.from_arn(arn).layer_name
+        source_layer_arn = unversioned_layer_arn(layer_arn)
+        regions = resolve_target_regions(target_regions, arn.region, self.clients)
+        check_staging_bucket(s3_staging_bucket, regions)
+        state = SyncState(
+            state_file
+            or default_state_file(
+                self.cache.root if self.cache else default_cache_dir(),
+                source_layer_arn,
+            ),
+            source_layer_arn,
+        ).load()
+
+        self.on_message("listing versions of " + source_layer_arn)
+        source_arns = list_layer_versions(
+            self.clients.client("lambda", arn.region), source_layer_arn
+        )
+        with ThreadPoolExecutor(
+            min(self.publish_concurrency, len(regions)), thread_name_prefix="list"
+        ) as executor:
+            target_arns = dict(
+                zip(
+                    regions,
+                    executor.map(
+                        lambda region: list_layer_versions(
+                            self.clients.client("lambda", region), layername
+                        ),
+                        regions,
+                    ),
+                )
+            )
+        pending = plan_sync(source_arns, target_arns, state)
+        records = [
+            SyncRecord(
+                source_arn, region, state.target(source_arn, region), "up-to-date"
+            )
+            for region in regions
+            for source_arn in source_arns
+            if source_arn not in pending[region]
+        ]
+        if any(pending.values()):
+            records.extend(
+                self.sync_pending(
+                    layername,
+                    pending,
+                    target_arns,
+                    state,
+                    parallelism,
+                    s3_staging_bucket,
+                    s3_staging_prefix,
+                )
+            )
+        failed = [record for record in records if record.status == "failed"]
+        if failed:
+            raise SyncError(
+                "mirroring failed for {} of {} layer versions".format(
+                    len(failed), len(records)
+                ),
+                records,
+            )
+        return records
+
+    def sync_pending(
+        self,
+        layername: str,
+        pending: typing.Dict[str, typing.List[str]],
+        target_arns: typing.Dict[str, typing.List[str]],
+        state: SyncState,
+        parallelism: int = DEFAULT_SYNC_PARALLELISM,
+        s3_staging_bucket: typing.Optional[str] = None,
+        s3_staging_prefix: str = DEFAULT_PREFIX,
+    ) -> typing.List[SyncRecord]:
+        """Matches pending versions by content hash, or else publishes them."""
+        source_arns = sorted(
+            {source_arn for arns in pending.values() for source_arn in arns},
+            key=layer_version_number,
+        )
+        self.on_message(
+            "comparing content hashes of {} pending layer versions".format(
+                len(source_arns)
+            )
+        )
+        source_hashes = {
+            source_arn: self.code_sha256_of(source_arn) for source_arn in source_arns
+        }
+        # region -> CodeSha256 -> ARN of the newest target version with it
+        target_hashes = {}  # type: typing.Dict[str, typing.Dict[str, str]]
+        for region, arns in pending.items():
+            if arns:
+                target_hashes[region] = {}
+                for target_arn in target_arns[region]:
+                    target_hashes[region].setdefault(
+                        self.code_sha256_of(target_arn), target_arn
+                    )
+
+        records = []
+        with contextlib.ExitStack() as stack:
+            tmpdir = stack.enter_context(tempfile.TemporaryDirectory(prefix="dt-sync-"))
+            downloader = stack.enter_context(
+                ThreadPoolExecutor(parallelism, thread_name_prefix="download")
+            )
+            publisher = stack.enter_context(
+                ThreadPoolExecutor(
+                    self.publish_concurrency, thread_name_prefix="publish"
+                )
+            )
+            downloads = {}  # type: typing.Dict[str, typing.Any]
+
+            def regions_for(source_arn: str) -> typing.List[str]:
+                return [
+                    region for region, arns in pending.items() if source_arn in arns
+                ]
+
+            def needs_publish(source_arn: str) -> bool:
+                return any(
+                    source_hashes[source_arn] not in target_hashes[region]
+                    for region in regions_for(source_arn)
+                )
+
+            def submit_download(source_arn: str):
+                if source_arn not in downloads:
+                    downloads[source_arn] = downloader.submit(
+                        self.download, source_arn, True, tmpdir
+                    )
+
+            # Versions are published oldest first, to keep their order in the
+            # target. Up to parallelism versions are downloaded ahead of
+            # publishing; versions with the same content as an earlier one are
+            # not downloaded ahead, as they will likely match the earlier one
+            # once it is published.
+            for index, source_arn in enumerate(source_arns):
+                ahead = []  # type: typing.List[str]
+                seen_hashes = set()
+                for next_arn in source_arns[index:]:
+                    if len(ahead) >= parallelism:
+                        break
+                    if source_hashes[next_arn] in seen_hashes or not needs_publish(
+                        next_arn
+                    ):
+                        continue
+                    seen_hashes.add(source_hashes[next_arn])
+                    ahead.append(next_arn)
+                for next_arn in ahead:
+                    submit_download(next_arn)
+
+                publish_regions = []
+                for region in regions_for(source_arn):
+                    existing = target_hashes[region].get(source_hashes[source_arn])
+                    if existing:
+                        state.record(source_arn, region, existing)
+                        records.append(
+                            SyncRecord(source_arn, region, existing, "matched")
+                        )
+                    else:
+                        publish_regions.append(region)
+                if not publish_regions:
+                    continue
+                submit_download(source_arn)
+                try:
+                    layer, outfilename = downloads.pop(source_arn).result()
+                except OperationCancelled:
+                    raise
+                except Exception as exc:  # pylint:disable=broad-except
+                    error = str(exc)
+                    self.on_message(
+                        "failed downloading {}: {}".format(source_arn, error)
+                    )
+                    records.extend(
+                        SyncRecord(source_arn, region, None, "failed", error)
+                        for region in publish_regions
+                    )
+                    continue
+                layerinfo = layer.layerinfo
+                stagers = self.stagers_for(
+                    publish_regions,
+                    layername,
+                    layerinfo,
+                    outfilename,
+                    s3_staging_bucket,
+                    s3_staging_prefix,
+                )
+                futures = [
+                    publisher.submit(
+                        clone_to_region,
+                        self.clients.client("lambda", region),
+                        region,
+                        layername,
+                        layerinfo,
+                        stagers[region],
+                    )
+                    for region in publish_regions
+                ]
+                for future in futures:
+                    result = future.result()
+                    if result.error:
+                        self.on_message(
+                            "failed mirroring to {}: {}".format(
+                                result.region, result.error
+                            )
+                        )
+                        records.append(
+                            SyncRecord(
+                                source_arn, result.region, None, "failed", result.error
+                            )
+                        )
+                        continue
+                    self.on_message("created " + result.layer_version_arn)
+                    state.record(source_arn, result.region, result.layer_version_arn)
+                    self.remember_published(layername, layerinfo, result)
+                    target_hashes[result.region][
+                        source_hashes[source_arn]
+                    ] = result.layer_version_arn
+                    records.append(
+                        SyncRecord(
+                            source_arn,
+                            result.region,
+                            result.layer_version_arn,
+                            "published",
+                        )
+                    )
+                os.remove(outfilename)
+        return records
+
+    #
+    # Discover
+    #
+
+    def discover(
+        self,
+        layers: typing.Sequence[str] = (),
+        regions: typing.Optional[typing.List[str]] = None,
+        profiles: typing.Optional[typing.Sequence[typing.Optional[str]]] = None,
+        names: typing.Optional[typing.Sequence[str]] = None,
+        runtimes: typing.Optional[typing.Sequence[str]] = None,
+        all_versions: bool = False,
+        parallelism: int = DEFAULT_DISCOVER_PARALLELISM,
+        on_found: typing.Optional[
+            typing.Callable[[typing.List[DiscoveredVersion]], None]
+        ] = None,
+    ) -> typing.List[DiscoveredVersion]:
+        """Lists layer versions in the regions (default: all regions that
+        support Lambda) of the accounts of profiles (default: the default
+        profile of the clients).
+
+        layers are names or ARNs of the layers to list the versions of; by
+        default, all layers whose name matches one of the names glob patterns
+        are listed. Only versions compatible with a runtime matching one of the
+        runtimes glob patterns are reported, and only the latest one unless
+        all_versions is set. on_found is called with the versions of each
+        region as soon as it is searched. Regions whose search failed are
+        reported through on_message; raises DiscoverError if all failed.
+        """
+        profiles = list(profiles or [None])
+        searches = [
+            (profile, region)
+            for profile in profiles
+            for region in resolve_target_regions(
+                regions or ["all"], None, self.clients, profile
+            )
+        ]
+        self.on_message(
+            "searching {} regions in {} accounts".format(
+                len({region for _profile, region in searches}), len(profiles)
+            )
+        )
+
+        def search(
+            profile: typing.Optional[str], region: str
+        ) -> typing.List[DiscoveredVersion]:
+            with phase("discover", region=region, profile=profile or ""):
+                return discover_in_region(
+                    self.clients.client("lambda", region, profile),
+                    profile,
+                    region,
+                    layers,
+                    names,
+                    runtimes,
+                    all_versions,
+                )
+
+        results = []  # type: typing.List[DiscoveredVersion]
+        nfailed = 0
+        with ThreadPoolExecutor(parallelism, thread_name_prefix="discover") as executor:
+            futures = {
+                executor.submit(search, profile, region): (profile, region)
+                for profile, region in searches
+            }
+            for future in as_completed(futures):
+                profile, region = futures[future]
+                try:
+                    found = future.result()
+                except Exception as exc:  # pylint:disable=broad-except
+                    LOGGER.debug("Searching %s failed", region, exc_info=True)
+                    self.on_message(
+                        "failed searching {}{}: {}".format(
+                            region, " ({})".format(profile) if profile else "", exc
+                        )
+                    )
+                    nfailed += 1
+                    continue
+                if on_found:
+                    on_found(found)
+                results.extend(found)
+        self.on_message(
+            "found {} layer versions in {} of {} searched regions".format(
+                len(results), len(searches) - nfailed, len(searches)
+            )
+        )
+        if searches and nfailed == len(searches):
+            raise DiscoverError("searching failed in all regions")
+        return results
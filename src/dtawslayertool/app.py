@@ -15,21 +15,68 @@
 """Utility to download or clone an AWS Lambda layer."""
 
 import argparse
-import hashlib
+import contextlib
+import io
 import json
 import logging
-import os
-import shutil
+import stat
 import sys
+import threading
+import time
 import typing
-from base64 import b64encode
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
 from os import path
-from typing import NamedTuple
-from urllib.request import urlretrieve
-from zipfile import ZipFile
 
-import boto3
+from dtawslayertool.api import (
+    DEFAULT_PUBLISH_CONCURRENCY,
+    Arn,
+    CloneError,
+    CloneResult,
+    DiscoveredVersion,
+    LayerClient,
+    LayerResourceName,
+    LayerToolError,
+    SyncError,
+    TargetExistsError,
+    unversioned_layer_arn,
+)
+from dtawslayertool.batch import BATCH_ACTIONS, FORMATS, read_manifest
+from dtawslayertool.build import DEFAULT_COMPRESS_LEVEL
+from dtawslayertool.cache import (
+    DEFAULT_MAX_SIZE,
+    LayerCache,
+    MetadataCache,
+    default_cache_dir,
+    format_size,
+    parse_size,
+)
+from dtawslayertool.clients import (
+    DEFAULT_MAX_POOL_CONNECTIONS,
+    DEFAULT_RETRY_MODE,
+    RETRY_MODES,
+    ClientConfig,
+    ClientRegistry,
+)
+from dtawslayertool.extract import DEFAULT_EXTRACT_CONCURRENCY, unix_mode
+from dtawslayertool.httppool import (
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_POOL,
+    DEFAULT_READ_TIMEOUT,
+    Timeouts,
+)
+from dtawslayertool.optimize import ZipStats, read_prune_rules
+from dtawslayertool.staging import DEFAULT_PREFIX
+from dtawslayertool.sync import SYNC_STATUSES, SyncRecord, default_state_file
+from dtawslayertool.timings import TIMINGS_FORMATS, phase, recording
+from dtawslayertool.transfer import (
+    DEFAULT_BUFSIZE,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_PART_SIZE,
+    TransferConfig,
+)
+from dtawslayertool.verify import DEFAULT_HASH_CONCURRENCY
 
 #
 # Commandline parsing #
@@ -45,6 +92,177 @@ def add_download_args(parser: argparse.ArgumentParser) -> None:
         action="store_true",
         help="overwrite existing layer contents or extracted folders",
     )
+    add_transfer_args(parser)
+
+
+def add_transfer_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--part-size",
+        type=parse_size,
+        default=DEFAULT_PART_SIZE,
+        help="""download layers larger than this in parts of this size,
+            e.g. 8M (default: 8M)""",
+        metavar="<size>",
+    )
+    parser.add_argument(
+        "--download-concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="number of parts to download in parallel (default: %(default)s)",
+        metavar="<n>",
+    )
+    parser.add_argument(
+        "--buffer-size",
+        type=parse_size,
+        default=DEFAULT_BUFSIZE,
+        help="read buffer size for downloads in a single part (default: 256K)",
+        metavar="<size>",
+    )
+
+
+def add_publish_args(parser: argparse.ArgumentParser, verb: str = "clone") -> None:
+    parser.add_argument(
+        "-t",
+        "--target-region",
+        action="append",
+        help="""{} the layer to the specified AWS region.
+            Can be given multiple times, "all" stands for all regions that
+            support Lambda. By default, the region of the source ARN is used""".format(
+            verb
+        ),
+        metavar="<aws region>",
+    )
+    parser.add_argument(
+        "--s3-staging-bucket",
+        help="""upload the layer to this S3 bucket and publish it from there
+            instead of sending it inline. This works for layers of any size.
+            The bucket must be in the target region; "{region}" in the name is
+            replaced by the target region. Missing buckets are created, staged
+            objects are deleted after publishing""",
+        metavar="<bucket>",
+    )
+    parser.add_argument(
+        "--s3-staging-prefix",
+        default=DEFAULT_PREFIX,
+        help="key prefix for staged objects (default: %(default)s)",
+        metavar="<prefix>",
+    )
+    parser.add_argument(
+        "--publish-concurrency",
+        type=int,
+        default=DEFAULT_PUBLISH_CONCURRENCY,
+        help="number of regions to publish to in parallel (default: %(default)s)",
+        metavar="<n>",
+    )
+
+
+def add_global_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "-p",
+        "--profile",
+        help="use the specified AWS profile (~/.aws/credentials)",
+        metavar="<aws profile>",
+    )
+    parser.add_argument("--debug", help="enable verbose debug logging", action="count")
+    parser.add_argument(
+        "--cache-dir",
+        help="""directory of the local layer cache.
+            Defaults to $DT_AWSLAYERTOOL_CACHE_DIR or the user cache directory""",
+        metavar="<folder>",
+    )
+    parser.add_argument(
+        "--cache-max-size",
+        type=parse_size,
+        help="""evict least recently used layers when the cache grows beyond
+            this size, e.g. 500M or 4G (default: 2G)""",
+        metavar="<size>",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="""neither use nor populate the local layer and layer meta
+            information caches""",
+    )
+    parser.add_argument(
+        "--max-pool-connections",
+        type=int,
+        default=DEFAULT_MAX_POOL_CONNECTIONS,
+        help="""maximum number of connections kept open per AWS client
+            (default: %(default)s)""",
+        metavar="<n>",
+    )
+    parser.add_argument(
+        "--retry-mode",
+        choices=RETRY_MODES,
+        default=DEFAULT_RETRY_MODE,
+        help="retry mode of the AWS clients (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        help="maximum number of attempts per AWS API call, including the first",
+        metavar="<n>",
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        help="""timeout in seconds for connecting to AWS APIs and the layer
+            content server (default: 60)""",
+        metavar="<seconds>",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        help="""timeout in seconds for reading AWS API responses and layer
+            contents (default: 60)""",
+        metavar="<seconds>",
+    )
+    parser.add_argument(
+        "--timings",
+        help="""write the duration, bytes processed, throughput and peak memory
+            of each phase (metadata, download, extract, publish, ...) to this file""",
+        metavar="<file>",
+    )
+    parser.add_argument(
+        "--timings-format",
+        choices=TIMINGS_FORMATS,
+        default="json",
+        help="format of the --timings file (default: %(default)s)",
+    )
+
+
+def add_selection_args(parser: argparse.ArgumentParser, verb: str) -> None:
+    parser.add_argument(
+        "--include",
+        action="append",
+        help="""only {} files matching this glob pattern (or in a matching
+            folder). Can be given multiple times""".format(verb),
+        metavar="<pattern>",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        help="""do not {} files matching this glob pattern (or in a matching
+            folder). Can be given multiple times""".format(verb),
+        metavar="<pattern>",
+    )
+
+
+def add_compress_args(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--compress-concurrency",
+        type=int,
+        help="number of processes compressing files (default: number of CPUs)",
+        metavar="<n>",
+    )
+    parser.add_argument(
+        "--compress-level",
+        type=int,
+        choices=range(10),
+        default=DEFAULT_COMPRESS_LEVEL,
+        help="zlib compression level from 0 to 9 (default: %(default)s)",
+        metavar="<level>",
+    )
 
 
 def add_common_args(parser: argparse.ArgumentParser) -> None:
@@ -65,13 +283,7 @@ Example:
 """,
     )
     parser.set_defaults(parser=parser)
-    parser.add_argument(
-        "-p",
-        "--profile",
-        help="use the specified AWS profile (~/.aws/credentials)",
-        metavar="<aws profile>",
-    )
-    parser.add_argument("--debug", help="enable verbose debug logging", action="count")
+    add_global_args(parser)
 
     subparsers = parser.add_subparsers(title="Commands", dest="command")
     subparsers.required = True
@@ -100,102 +312,285 @@ Example:
         help="extract the downloaded layer content to given folder",
         metavar="<folder>",
     )
+    pull_parser.add_argument(
+        "--extract-concurrency",
+        type=int,
+        default=DEFAULT_EXTRACT_CONCURRENCY,
+        help="number of files to extract in parallel (default: %(default)s)",
+        metavar="<n>",
+    )
+    pull_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="""with --overwrite, update an existing extract folder in place:
+            only write added or changed files and remove stale ones, leaving
+            unchanged files (and their mtimes) untouched""",
+    )
+    add_selection_args(pull_parser, "extract")
 
     clone_parser = add_subparser(
         "clone", help="clone layer to AWS account defined by current profile"
     )
     add_download_args(clone_parser)
+    add_publish_args(clone_parser)
     clone_parser.add_argument(
-        "-t",
-        "--target-region",
-        help="""clone the layer to the specified AWS region.
-            By default, the region of the source ARN is used""",
-        metavar="<aws region>",
+        "--force-publish",
+        action="store_true",
+        help="""publish a new layer version even if the target region already
+            has a version with the same content (CodeSha256)""",
     )
 
-    return parser
-
-
-#
-# Utility functions & types #
-#
-
-
-class Arn(NamedTuple):
-    partition: str
-    service: str
-    region: str
-    account_id: str
-    resource_type: str
-    resource_id: str
-
-    @classmethod
-    def parse(cls, raw: str) -> "Arn":
-        arn_prefix = "arn:"
-        if not raw.startswith(arn_prefix):
-            raise ValueError("Not an ARN (prefix missing): " + raw)
-        parts = raw[len(arn_prefix) :].split(":", 5)
-        if len(parts) == 5:
-            parts.insert(-2, None)  # resource-type is optional
-        if len(parts) != 6:
-            raise ValueError("ARN has too few parts: " + raw)
-        return cls._make(parts)
-
-    def __str__(self):
-        return "arn:" + ":".join(self)
-
-
-class LayerResourceName(NamedTuple):
-    layer_name: str
-    version: str
+    publish_parser = add_subparser(
+        "publish",
+        help="""publish a folder (e.g. a patched extracted layer) as new version
+            of the layer, with the meta information of the given version""",
+    )
+    publish_parser.add_argument(
+        "folder",
+        help="""the folder with the layer contents to publish, or a layer zip
+            file (e.g. of optimize) to publish as is""",
+    )
+    publish_parser.add_argument(
+        "--layer-name",
+        help="publish as a version of this layer instead of the layer of the ARN",
+        metavar="<name>",
+    )
+    publish_parser.add_argument(
+        "--output",
+        help="write the layer zip file to this file (default: <folder>.zip)",
+        metavar="<file>",
+    )
+    publish_parser.add_argument(
+        "-o",
+        "--overwrite",
+        action="store_true",
+        help="overwrite an existing layer zip file",
+    )
+    add_compress_args(publish_parser)
+    add_publish_args(publish_parser, "publish")
+    publish_parser.add_argument(
+        "--force-publish",
+        action="store_true",
+        help="""publish a new layer version even if the target region already
+            has a version with the same content (CodeSha256)""",
+    )
 
-    @classmethod
-    def parse(cls, raw: str) -> "LayerResourceName":
-        parts = raw.split(":", 2)
-        if len(parts) == 1:
-            return LayerResourceName(layer_name=parts[0], version=None)
-        if len(parts) > 2:
-            raise ValueError("Too many colons: " + raw)
-        return LayerResourceName._make(parts)
+    sync_parser = add_subparser(
+        "sync",
+        help="""mirror all versions of a layer to the AWS account defined by
+            current profile""",
+    )
+    add_transfer_args(sync_parser)
+    add_publish_args(sync_parser, "mirror")
+    sync_parser.add_argument(
+        "-j",
+        "--parallelism",
+        type=int,
+        default=2,
+        help="""number of layer versions to download in parallel
+            (default: %(default)s)""",
+        metavar="<n>",
+    )
+    sync_parser.add_argument(
+        "--state-file",
+        help="""file that records which versions were mirrored already.
+            Defaults to a file in the cache directory""",
+        metavar="<file>",
+    )
 
-    @classmethod
-    def from_arn(cls, arn: Arn) -> "LayerResourceName":
-        if arn.resource_type != "layer":
-            raise ValueError("Bad ARN type: " + arn.resource_type)
-        return cls.parse(arn.resource_id)
+    ls_parser = add_subparser(
+        "ls", help="list the layer contents without downloading the layer"
+    )
+    add_selection_args(ls_parser, "list")
 
-    def __str__(self):
-        return ":".join(self)
+    verify_parser = add_subparser(
+        "verify",
+        help="""check a downloaded layer zip file or extracted folder against
+            the layer""",
+    )
+    verify_parser.add_argument(
+        "target", help="the zip file or extracted folder to verify"
+    )
+    add_selection_args(verify_parser, "verify")
+    verify_parser.add_argument(
+        "--index",
+        help="""file that records the hashes of the verified files, so that
+            unchanged files are not hashed again (default: the target path
+            plus .hashes.json)""",
+        metavar="<file>",
+    )
+    verify_parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="hash all files and do not record their hashes",
+    )
+    verify_parser.add_argument(
+        "--hash-concurrency",
+        type=int,
+        default=DEFAULT_HASH_CONCURRENCY,
+        help="number of files to hash in parallel (default: %(default)s)",
+        metavar="<n>",
+    )
 
+    diff_parser = subparsers.add_parser(
+        "diff",
+        help="""compare two layer versions or zip files without downloading
+            them""",
+    )
+    diff_parser.add_argument("old", help="ARN or zip file of the old layer version")
+    diff_parser.add_argument("new", help="ARN or zip file of the new layer version")
+    add_selection_args(diff_parser, "compare")
+    diff_parser.add_argument(
+        "--content",
+        action="append",
+        help="""show the content diff of the changed files matching this glob
+            pattern (or in a matching folder). Only these files are fetched.
+            Can be given multiple times""",
+        metavar="<pattern>",
+    )
 
-# extract_all_with_permission from
-# https://stackoverflow.com/a/46837272/2128694
-# by de1 <https://stackoverflow.com/users/8676953/de1>
+    optimize_parser = subparsers.add_parser(
+        "optimize",
+        help="""repack a layer zip file without unneeded files and with even
+            compression""",
+    )
+    optimize_parser.add_argument("zipfile", help="the layer zip file to optimize")
+    optimize_parser.add_argument(
+        "--output",
+        help="""write the optimized zip file to this file
+            (default: <zipfile name>-optimized.zip)""",
+        metavar="<file>",
+    )
+    optimize_parser.add_argument(
+        "-o",
+        "--overwrite",
+        action="store_true",
+        help="overwrite an existing optimized zip file",
+    )
+    optimize_parser.add_argument(
+        "--prune",
+        action="append",
+        help="""leave out files matching this glob pattern (or in a matching
+            folder). Can be given multiple times""",
+        metavar="<pattern>",
+    )
+    optimize_parser.add_argument(
+        "--prune-rules",
+        help="""file with glob patterns of files to leave out, one per line.
+            Lines starting with # are comments""",
+        metavar="<file>",
+    )
+    add_compress_args(optimize_parser)
 
-ZIP_UNIX_SYSTEM = 3
+    discover_parser = subparsers.add_parser(
+        "discover",
+        help="list layer versions across regions and accounts as JSON Lines",
+    )
+    discover_parser.add_argument(
+        "layer",
+        nargs="*",
+        help="""name or ARN of a layer to list the versions of, in each searched
+            region. By default, all layers of the searched accounts are listed""",
+    )
+    discover_parser.add_argument(
+        "-r",
+        "--region",
+        action="append",
+        help="""search the specified AWS region. Can be given multiple times
+            (default: all regions that support Lambda)""",
+        metavar="<aws region>",
+    )
+    discover_parser.add_argument(
+        "--account-profile",
+        action="append",
+        help="""search the account of the specified AWS profile. Can be given
+            multiple times (default: the account of --profile)""",
+        metavar="<aws profile>",
+    )
+    discover_parser.add_argument(
+        "--name",
+        action="append",
+        help="""only report layers whose name matches this glob pattern.
+            Can be given multiple times""",
+        metavar="<pattern>",
+    )
+    discover_parser.add_argument(
+        "--runtime",
+        action="append",
+        help="""only report layer versions compatible with a runtime matching
+            this glob pattern, e.g. "python3.*". Can be given multiple times""",
+        metavar="<pattern>",
+    )
+    discover_parser.add_argument(
+        "--all-versions",
+        action="store_true",
+        help="report all matching versions instead of only the latest one",
+    )
+    discover_parser.add_argument(
+        "-j",
+        "--parallelism",
+        type=int,
+        default=8,
+        help="number of regions to search in parallel (default: %(default)s)",
+        metavar="<n>",
+    )
+    discover_parser.add_argument(
+        "--output",
+        help="write the JSON Lines results to this file instead of stdout",
+        metavar="<file>",
+    )
 
+    cache_parser = subparsers.add_parser(
+        "cache", help="list, prune or check the local layer cache"
+    )
+    cache_parser.add_argument(
+        "action",
+        choices=("list", "prune", "check"),
+        help="""list: print cached layers, most recently used first;
+            prune: evict layers beyond --cache-max-size;
+            check: rehash all cached layers and remove corrupted ones""",
+    )
 
-def extract_all_with_permission(zipfile: ZipFile, target_dir: str):
-    for info in zipfile.infolist():
-        extracted_path = zipfile.extract(info, target_dir)
+    batch_parser = subparsers.add_parser(
+        "batch",
+        help="run info, pull or clone for all layers listed in a manifest",
+    )
+    batch_parser.add_argument(
+        "manifest",
+        help="""manifest file (JSON, YAML or one command line per line),
+            - for stdin""",
+    )
+    batch_parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        help="manifest format. By default, guessed from the file extension",
+    )
+    batch_parser.add_argument(
+        "--default-action",
+        choices=BATCH_ACTIONS,
+        default="pull",
+        help="action for items that do not specify one (default: %(default)s)",
+    )
+    batch_parser.add_argument(
+        "-j",
+        "--parallelism",
+        type=int,
+        default=4,
+        help="number of items to process in parallel (default: %(default)s)",
+        metavar="<n>",
+    )
+    batch_parser.add_argument(
+        "--output",
+        help="write the JSON Lines results to this file instead of stdout",
+        metavar="<file>",
+    )
 
-        if info.create_system == ZIP_UNIX_SYSTEM:
-            unix_attributes = info.external_attr >> 16
-            if unix_attributes:
-                os.chmod(extracted_path, unix_attributes)
+    return parser
 
 
-def update_with_filecontents(
-    hasher: "hashlib._Hash", filename, bufsize: int = 8 * 1024 * 1024
-) -> "hashlib._Hash":
-    with open(filename, "rb") as infile:
-        buffer = memoryview(bytearray(bufsize))
-        while True:
-            nread = infile.readinto(buffer)
-            if nread <= 0:
-                break
-            hasher.update(buffer[:nread])
-    return hasher
+#
+# Utility functions & types #
+#
 
 
 def eprint(*args, **kwargs):
@@ -210,13 +605,6 @@ def print_values(mapping, keys):
         print("{:20} {}".format(str(key) + ":", value))
 
 
-def query_layerinfo(client, layer_arn):
-    eprint("querying layer version meta information for", layer_arn)
-    result = client.get_layer_version_by_arn(Arn=layer_arn)
-    loglayerinfo(result, "layer info for " + layer_arn)
-    return result
-
-
 def error_exists(name):
     sys.exit(
         "{} already exists. "
@@ -238,51 +626,125 @@ def show_progress(block_count, block_size, total_size):
             eprint("{:.0%}".format(ratio), end=" ")
 
 
-def download_layer(client, layer_arn: str, overwrite: bool):
-    layername = LayerResourceName.from_arn(Arn.parse(layer_arn))
-    outfilename = "{}-v{}.zip".format(*layername)
+class CliProgress:
+    """Prints the progress callbacks of a LayerClient to stderr."""
+
+    def __init__(self):
+        self.line_open = False  # The download progress line
+
+    def message(self, text: str):
+        self.end_line("Done.")
+        eprint(text)
+
+    def transfer(self, block_count, block_size, total_size):
+        self.line_open = True
+        show_progress(block_count, block_size, total_size)
+
+    def end_line(self, status: str):
+        if self.line_open:
+            self.line_open = False
+            eprint(status)  # Newline after progress report
+
+
+@contextlib.contextmanager
+def exit_on_error(args, progress: CliProgress) -> typing.Iterator[None]:
+    """Turns LayerClient errors into the command line error messages."""
+    try:
+        yield
+    except TargetExistsError as exc:
+        error_exists(exc.target)
+    except LayerToolError as exc:
+        progress.end_line("Failed.")
+        sys.exit(str(exc))
+    except ValueError as exc:
+        args.parser.error(str(exc))
+
+
+def client_registry_for(args) -> ClientRegistry:
+    # Creating the registry is cheap, boto3 is only imported for the first
+    # client. This keeps e.g. --help and the cache command fast.
+    return ClientRegistry(
+        args.profile,
+        ClientConfig(
+            max_pool_connections=args.max_pool_connections,
+            retry_mode=args.retry_mode,
+            max_attempts=args.max_attempts,
+            connect_timeout=args.connect_timeout,
+            read_timeout=args.read_timeout,
+        ),
+    )
 
-    if path.exists(outfilename) and not overwrite:
-        error_exists(outfilename)
 
-    layerinfo = query_layerinfo(client, layer_arn)
-    codesize = layerinfo["Content"]["CodeSize"]  # type: int
-    eprint(
-        "downloading {} content [{} bytes] to {} ...".format(
-            layer_arn, codesize, outfilename
-        )
+def metadata_cache_for(args) -> typing.Optional[MetadataCache]:
+    if args.no_cache:
+        return None
+    return MetadataCache(args.cache_dir or default_cache_dir())
+
+
+def make_layer_cache(args) -> LayerCache:
+    return LayerCache(
+        args.cache_dir or default_cache_dir(),
+        max_size=args.cache_max_size or DEFAULT_MAX_SIZE,
     )
-    httpresponse = urlretrieve(
-        layerinfo["Content"]["Location"], outfilename, reporthook=show_progress
-    )[1]
-    eprint("Done.")  # Newline after progress report
-    LOGGER.debug("Retrieved layer with HTTP response metadata:\n%s", httpresponse)
 
-    # Verify file by checking size & SHA265
 
-    filesize = path.getsize(outfilename)
-    if filesize != codesize:
-        sys.exit(
-            "Downloaded file corrupted -- expected {} bytes, but have {}".format(
-                codesize, filesize
-            )
-        )
-    filehash = b64encode(  # AWS reports the hash as Base64 instead of the usual hex
-        update_with_filecontents(hashlib.sha256(), outfilename).digest()
-    ).decode("ascii")
-    expecthash = layerinfo["Content"]["CodeSha256"]
-    if filehash != expecthash:
-        sys.exit(
-            "Downloaded file corrupted -- expected SHA256 {}, but have {}".format(
-                expecthash, filehash
-            )
-        )
-    eprint("downloaded layer content to", outfilename)
-    return layerinfo, outfilename
+def transfer_config_for(args) -> TransferConfig:
+    return TransferConfig(
+        part_size=getattr(args, "part_size", DEFAULT_PART_SIZE),
+        concurrency=getattr(args, "download_concurrency", DEFAULT_CONCURRENCY),
+        bufsize=getattr(args, "buffer_size", DEFAULT_BUFSIZE),
+        timeouts=Timeouts(
+            connect=args.connect_timeout or DEFAULT_CONNECT_TIMEOUT,
+            read=args.read_timeout or DEFAULT_READ_TIMEOUT,
+        ),
+    )
+
+
+def layer_cache_for(args) -> typing.Optional[LayerCache]:
+    """Returns the layer cache to use for downloads, None if disabled."""
+    if args.no_cache:
+        return None
+    return make_layer_cache(args)
+
+
+def layer_client_for(
+    args, clients: ClientRegistry, progress: CliProgress
+) -> LayerClient:
+    # Not all commands have all options.
+    return LayerClient(
+        clients,
+        cache=layer_cache_for(args),
+        metacache=metadata_cache_for(args),
+        transferconfig=transfer_config_for(args),
+        extract_concurrency=getattr(
+            args, "extract_concurrency", DEFAULT_EXTRACT_CONCURRENCY
+        ),
+        publish_concurrency=getattr(
+            args, "publish_concurrency", DEFAULT_PUBLISH_CONCURRENCY
+        ),
+        on_message=progress.message,
+        on_transfer=progress.transfer,
+    )
 
 
-def lambda_client_for(layer_arn: str, session: boto3.Session):
-    return session.client("lambda", region_name=Arn.parse(layer_arn).region)
+def print_clone_results(results: typing.Iterable[CloneResult]):
+    rowformat = "{:16} {:>8} {:8} {}"
+    print(rowformat.format("REGION", "SECONDS", "SHA256", "RESULT"))
+    for result in results:
+        if not result.layer_version_arn:
+            hashstatus = "-"
+        else:
+            hashstatus = "match" if result.hash_match else "MISMATCH"
+        print(
+            rowformat.format(
+                result.region,
+                "{:.1f}".format(result.seconds),
+                hashstatus,
+                result.error
+                or result.layer_version_arn
+                + (" (existing)" if result.existing else ""),
+            )
+        )
 
 
 def print_layerinfo(layerinfo):
@@ -297,12 +759,10 @@ def print_layerinfo(layerinfo):
             "CreatedDate",
         ),
     )
-    print_values(content, keys=("CodeSize", "CodeSha256", "Location"))
-
-
-def loglayerinfo(layerinfo, description: str):
-    if LOGGER.isEnabledFor(logging.DEBUG):
-        LOGGER.debug("%s: %s", description, json.dumps(layerinfo, indent=2))
+    print_values(content, keys=("CodeSize", "CodeSha256"))
+    # Not cached beyond its expiry
+    if "Location" in content:
+        print_values(content, keys=("Location",))
 
 
 #
@@ -310,62 +770,463 @@ def loglayerinfo(layerinfo, description: str):
 #
 
 
-def cmd_info(args, session: boto3.Session):
-    print_layerinfo(
-        query_layerinfo(lambda_client_for(args.layer_arn, session), args.layer_arn)
-    )
-
-
-def cmd_pull(args, session: boto3.Session):
-    extractdir = args.extract  # type: str
-    need_clean = False
-    if extractdir:
-        if path.exists(extractdir):
-            if args.overwrite:
-                need_clean = True
-            else:
-                error_exists(extractdir)
-    _layerinfo, outfilename = download_layer(
-        lambda_client_for(args.layer_arn, session), args.layer_arn, args.overwrite
-    )
-    if extractdir:
-        if need_clean:
-            shutil.rmtree(extractdir)
-        eprint('extracting layer contents to "{}"'.format(args.extract))
-        with ZipFile(outfilename, "r") as zipfile:
-            extract_all_with_permission(zipfile, args.extract)
-
-
-def cmd_clone(args, session: boto3.Session):
-    layerinfo, outfilename = download_layer(
-        lambda_client_for(args.layer_arn, session), args.layer_arn, args.overwrite
-    )
-    arn = Arn.parse(args.layer_arn)
-    target_region = args.target_region or arn.region
-    eprint("cloning layer to", target_region)
-    client = session.client("lambda", region_name=target_region)
-
-    # We need to read the whole file into memory at once,
-    # the API won't accept it any other way.
-    with open(outfilename, "rb") as filehandle:
-        layercontent = filehandle.read()
-
-    newlayerinfo = client.publish_layer_version(
-        LayerName=LayerResourceName.from_arn(arn).layer_name,
-        Description=layerinfo["Description"],
-        CompatibleRuntimes=layerinfo["CompatibleRuntimes"],
-        LicenseInfo=layerinfo["LicenseInfo"],
-        Content=dict(ZipFile=layercontent),
-    )
-    loglayerinfo(newlayerinfo, "new layer")
-    newlayerhash = newlayerinfo["Content"]["CodeSha256"]
-    layerhash = layerinfo["Content"]["CodeSha256"]
-    if newlayerhash != layerhash:
-        sys.exit(
-            "something went terribly wrong -"
-            " SHA256 fingerprint of source and cloned layer do not match."
+def run_info(layerclient: LayerClient, args) -> dict:
+    return layerclient.info(args.layer_arn).layerinfo
+
+
+def run_pull(layerclient: LayerClient, args) -> dict:
+    pulled = layerclient.pull(
+        args.layer_arn,
+        extract=args.extract,
+        overwrite=args.overwrite,
+        incremental=args.incremental,
+        include=args.include,
+        exclude=args.exclude,
+    )
+    result = dict(file=pulled.file, extracted=pulled.extracted)
+    if pulled.changes:
+        result["changes"] = {
+            key: len(value) for key, value in pulled.changes._asdict().items()
+        }
+    return result
+
+
+def run_clone(layerclient: LayerClient, args) -> typing.List[CloneResult]:
+    return layerclient.clone(
+        args.layer_arn,
+        args.target_region,
+        overwrite=args.overwrite,
+        force_publish=args.force_publish,
+        s3_staging_bucket=args.s3_staging_bucket,
+        s3_staging_prefix=args.s3_staging_prefix,
+    )
+
+
+def cmd_info(args, clients: ClientRegistry):
+    progress = CliProgress()
+    with exit_on_error(args, progress):
+        layerinfo = run_info(layer_client_for(args, clients, progress), args)
+    print_layerinfo(layerinfo)
+    return layerinfo
+
+
+def cmd_pull(args, clients: ClientRegistry):
+    progress = CliProgress()
+    with exit_on_error(args, progress):
+        return run_pull(layer_client_for(args, clients, progress), args)
+
+
+def cmd_ls(args, clients: ClientRegistry):
+    progress = CliProgress()
+    with exit_on_error(args, progress):
+        entries = layer_client_for(args, clients, progress).list_contents(
+            args.layer_arn, args.include, args.exclude
         )
-    eprint("created", newlayerinfo["LayerVersionArn"])
+    for info in entries:
+        mode = unix_mode(info)
+        print(
+            "{:10} {:>10} {} {}".format(
+                stat.filemode(mode) if mode else "",
+                info.file_size,
+                datetime(*info.date_time).isoformat(" "),
+                info.filename,
+            )
+        )
+    eprint(
+        "{} entries, {} total".format(
+            len(entries), format_size(sum(info.file_size for info in entries))
+        )
+    )
+    return [
+        dict(
+            name=info.filename,
+            size=info.file_size,
+            compressed_size=info.compress_size,
+            mode=unix_mode(info),
+            modified=datetime(*info.date_time).isoformat(),
+        )
+        for info in entries
+    ]
+
+
+def cmd_clone(args, clients: ClientRegistry):
+    progress = CliProgress()
+    error = None
+    with exit_on_error(args, progress):
+        try:
+            results = run_clone(layer_client_for(args, clients, progress), args)
+        except CloneError as exc:
+            results = exc.results
+            error = str(exc)
+
+    if len(results) > 1:
+        print_clone_results(results)
+    if error:
+        sys.exit(error)
+    return [result._asdict() for result in results]
+
+
+def cmd_verify(args, clients: ClientRegistry):
+    progress = CliProgress()
+    with exit_on_error(args, progress):
+        result = layer_client_for(args, clients, progress).verify(
+            args.layer_arn,
+            args.target,
+            include=args.include,
+            exclude=args.exclude,
+            index_file=args.index,
+            use_index=not args.no_index,
+            concurrency=args.hash_concurrency,
+        )
+    if result.sha256_match is False:
+        print("{:8} {}".format("sha256", result.target))
+    for status in ("changed", "missing", "extra"):
+        for name in getattr(result, status):
+            print("{:8} {}".format(status, name))
+    eprint("{}: {}".format(result.target, result))
+    if not result.ok:
+        sys.exit("{} does not match {}".format(result.target, args.layer_arn))
+    return dict(result._asdict(), ok=result.ok)
+
+
+def cmd_diff(args, clients: ClientRegistry):
+    progress = CliProgress()
+    with exit_on_error(args, progress):
+        result = layer_client_for(args, clients, progress).diff(
+            args.old,
+            args.new,
+            include=args.include,
+            exclude=args.exclude,
+            content=args.content,
+        )
+    for change in result.changes:
+        modechange = ""
+        if change.old_mode and change.new_mode and change.old_mode != change.new_mode:
+            modechange = " ({} -> {})".format(
+                stat.filemode(change.old_mode), stat.filemode(change.new_mode)
+            )
+        print(
+            "{:8} {:>+10} {}{}".format(
+                change.status, change.size_delta, change.name, modechange
+            )
+        )
+    for name in sorted(result.contents):
+        sys.stdout.write(result.contents[name])
+    eprint(str(result))
+    return dict(
+        old=result.old,
+        new=result.new,
+        changes=[
+            dict(change._asdict(), size_delta=change.size_delta)
+            for change in result.changes
+        ],
+        unchanged=result.unchanged,
+        size_delta=result.size_delta,
+        contents=result.contents,
+    )
+
+
+def print_optimize_report(before: ZipStats, after: ZipStats):
+    rowformat = "{:14} {:>10} {:>10} {:>8}"
+    print(rowformat.format("", "BEFORE", "AFTER", "CHANGE"))
+    for label, attr, formatter in (
+        ("zip size", "zip_size", format_size),
+        ("size", "size", format_size),
+        ("files", "files", str),
+        ("extract time", "extract_seconds", "{:.2f}s".format),
+    ):
+        old, new = getattr(before, attr), getattr(after, attr)
+        print(
+            rowformat.format(
+                label,
+                formatter(old),
+                formatter(new),
+                "{:+.1%}".format((new - old) / old) if old else "-",
+            )
+        )
+
+
+def cmd_optimize(args, clients: ClientRegistry):
+    progress = CliProgress()
+    prune = list(args.prune or [])
+    if args.prune_rules:
+        try:
+            prune.extend(read_prune_rules(args.prune_rules))
+        except OSError as exc:
+            sys.exit("Cannot read {}: {}".format(args.prune_rules, exc))
+    with exit_on_error(args, progress):
+        result = layer_client_for(args, clients, progress).optimize(
+            args.zipfile,
+            output=args.output,
+            prune=prune,
+            overwrite=args.overwrite,
+            compress_concurrency=args.compress_concurrency,
+            compress_level=args.compress_level,
+        )
+    for name in result.pruned:
+        print("{:8} {}".format("pruned", name))
+    print_optimize_report(result.before, result.after)
+    eprint("wrote {} (CodeSha256 {})".format(result.file, result.code_sha256))
+    return dict(
+        result._asdict(), before=result.before._asdict(), after=result.after._asdict()
+    )
+
+
+def cmd_publish(args, clients: ClientRegistry):
+    progress = CliProgress()
+    error = None
+    with exit_on_error(args, progress):
+        try:
+            build, results = layer_client_for(args, clients, progress).publish(
+                args.layer_arn,
+                args.folder,
+                args.target_region,
+                layer_name=args.layer_name,
+                output=args.output,
+                overwrite=args.overwrite,
+                force_publish=args.force_publish,
+                s3_staging_bucket=args.s3_staging_bucket,
+                s3_staging_prefix=args.s3_staging_prefix,
+                compress_concurrency=args.compress_concurrency,
+                compress_level=args.compress_level,
+            )
+        except CloneError as exc:
+            results = exc.results
+            error = str(exc)
+
+    if len(results) > 1:
+        print_clone_results(results)
+    if error:
+        sys.exit(error)
+    return dict(build._asdict(), results=[result._asdict() for result in results])
+
+
+def cmd_sync(args, clients: ClientRegistry):
+    progress = CliProgress()
+    error = None
+    with exit_on_error(args, progress):
+        try:
+            records = layer_client_for(args, clients, progress).sync(
+                args.layer_arn,
+                args.target_region,
+                state_file=args.state_file
+                or default_state_file(
+                    args.cache_dir or default_cache_dir(),
+                    unversioned_layer_arn(args.layer_arn),
+                ),
+                parallelism=args.parallelism,
+                s3_staging_bucket=args.s3_staging_bucket,
+                s3_staging_prefix=args.s3_staging_prefix,
+            )
+        except SyncError as exc:
+            records = exc.records
+            error = str(exc)
+
+    print_sync_records(records)
+    if error:
+        sys.exit(error)
+    return [record._asdict() for record in records]
+
+
+def print_sync_records(records: typing.Iterable[SyncRecord]):
+    rowformat = "{:16} {:>10} {:>8} {:>9} {:>6}"
+    print(rowformat.format("REGION", *(status.upper() for status in SYNC_STATUSES)))
+    regions = list(dict.fromkeys(record.region for record in records))
+    for region in regions:
+        statuses = [record.status for record in records if record.region == region]
+        print(
+            rowformat.format(
+                region, *(statuses.count(status) for status in SYNC_STATUSES)
+            )
+        )
+
+
+def cmd_discover(args, clients: ClientRegistry):
+    progress = CliProgress()
+    with contextlib.ExitStack() as stack:
+        outfile = (
+            stack.enter_context(open(args.output, "w", encoding="utf-8"))
+            if args.output
+            else sys.stdout
+        )
+
+        # Results are written as soon as a region is done.
+        def write_found(found: typing.List[DiscoveredVersion]):
+            for version in found:
+                outfile.write(json.dumps(version._asdict(), default=str) + "\n")
+            outfile.flush()
+
+        with exit_on_error(args, progress):
+            found = layer_client_for(args, clients, progress).discover(
+                args.layer,
+                args.region,
+                args.account_profile or [args.profile],
+                names=args.name,
+                runtimes=args.runtime,
+                all_versions=args.all_versions,
+                parallelism=args.parallelism,
+                on_found=write_found,
+            )
+    return [version._asdict() for version in found]
+
+
+def cmd_cache(args, _clients: ClientRegistry):
+    cache = make_layer_cache(args)
+    if args.action == "list":
+        entries = cache.entries()
+        for entry in entries:
+            print(
+                "{:44} {:>10} {}".format(
+                    entry.codesha256,
+                    format_size(entry.size),
+                    datetime.fromtimestamp(entry.last_used).isoformat(" ", "seconds"),
+                )
+            )
+        eprint(
+            "{} cached layers, {} total in {}".format(
+                len(entries),
+                format_size(sum(entry.size for entry in entries)),
+                cache.layerdir,
+            )
+        )
+    elif args.action == "prune":
+        evicted = cache.prune()
+        eprint(
+            "evicted {} cached layers, freed {}".format(
+                len(evicted), format_size(sum(entry.size for entry in evicted))
+            )
+        )
+    elif args.action == "check":
+        corrupted = cache.check()
+        for entry in corrupted:
+            eprint("removed corrupted cache entry", entry.codesha256)
+        eprint("{} corrupted cached layers found".format(len(corrupted)))
+
+
+def cmd_batch(args, clients: ClientRegistry):
+    try:
+        manifest = read_manifest(args.manifest, args.format, args.default_action)
+    except (OSError, ValueError) as exc:
+        sys.exit("Cannot read manifest {}: {}".format(args.manifest, exc))
+
+    # Items are parsed like command lines, with the global options of the batch.
+    globalparser = argparse.ArgumentParser(add_help=False)
+    add_global_args(globalparser)
+    items = []  # type: typing.List[typing.Union[argparse.Namespace, str]]
+    for argv in manifest:
+        globalargs = argparse.Namespace(
+            parser=args.parser,
+            **{dest: getattr(args, dest) for dest in vars(globalparser.parse_args([]))}
+        )
+        items.append(parse_batch_item(args.parser, argv, globalargs))
+
+    # Items for the same layer version write the same download (and maybe
+    # extract) paths, so they run one after the other.
+    locks = {}  # type: typing.Dict[str, threading.Lock]
+    for itemargs in items:
+        if not isinstance(itemargs, str):
+            for output in batch_item_outputs(itemargs):
+                locks.setdefault(output, threading.Lock())
+
+    nfailed = 0
+    with contextlib.ExitStack() as stack:
+        outfile = (
+            stack.enter_context(open(args.output, "w", encoding="utf-8"))
+            if args.output
+            else sys.stdout
+        )
+        executor = stack.enter_context(
+            ThreadPoolExecutor(args.parallelism, thread_name_prefix="batch")
+        )
+        futures = [
+            executor.submit(run_batch_item, index, itemargs, clients, locks)
+            for index, itemargs in enumerate(items)
+        ]
+        for future in as_completed(futures):
+            record = future.result()
+            nfailed += record["status"] != "ok"
+            outfile.write(json.dumps(record, default=str) + "\n")
+            outfile.flush()
+    if nfailed:
+        sys.exit("{} of {} batch items failed".format(nfailed, len(items)))
+
+
+BATCH_RUNNERS = dict(info=run_info, pull=run_pull, clone=run_clone)
+
+
+def parse_batch_item(
+    parser: argparse.ArgumentParser,
+    argv: typing.List[str],
+    globalargs: argparse.Namespace,
+) -> typing.Union[argparse.Namespace, str]:
+    """Returns the parsed arguments of a manifest item, or why it is invalid."""
+    if argv[0] not in BATCH_ACTIONS:
+        return "unsupported action " + argv[0]
+    errors = io.StringIO()
+    try:
+        with contextlib.redirect_stderr(errors):
+            return parser.parse_args(argv, namespace=globalargs)
+    except SystemExit:
+        lines = errors.getvalue().strip().splitlines()
+        return "invalid item {}: {}".format(" ".join(argv), lines[-1] if lines else "")
+
+
+def batch_item_outputs(args) -> typing.List[str]:
+    """Returns the paths the batch item writes to."""
+    if args.command == "info":
+        return []
+    try:
+        layername = LayerResourceName.from_arn(Arn.parse(args.layer_arn))
+    except ValueError:
+        return []  # The item fails without writing anything
+    outputs = ["{}-v{}.zip".format(*layername)]
+    if getattr(args, "extract", None):
+        outputs.append(path.abspath(args.extract))
+    return outputs
+
+
+def run_batch_item(
+    index: int,
+    args: typing.Union[argparse.Namespace, str],
+    clients: ClientRegistry,
+    locks: typing.Dict[str, threading.Lock],
+) -> dict:
+    """Runs a batch item and returns its result record instead of raising.
+
+    args is the error message for items that could not be parsed. The item
+    holds the locks of its outputs while it runs.
+    """
+    if isinstance(args, str):
+        return dict(
+            index=index, action=None, arn=None, status="failed", error=args, seconds=0.0
+        )
+    record = dict(index=index, action=args.command, arn=args.layer_arn)
+    start = time.monotonic()
+    try:
+        with contextlib.ExitStack() as stack:
+            for output in sorted(batch_item_outputs(args)):
+                stack.enter_context(locks[output])
+            result = BATCH_RUNNERS[args.command](
+                layer_client_for(args, clients, CliProgress()), args
+            )
+        if isinstance(result, dict):
+            result.pop("ResponseMetadata", None)
+        elif isinstance(result, list):
+            result = [item._asdict() for item in result]
+        record.update(status="ok", result=result)
+    except CloneError as exc:
+        record.update(
+            status="failed",
+            error=str(exc),
+            result=[result._asdict() for result in exc.results],
+        )
+    except (LayerToolError, ValueError) as exc:
+        record.update(status="failed", error=str(exc))
+    except Exception as exc:  # pylint:disable=broad-except
+        LOGGER.debug("Batch item %d failed", index, exc_info=True)
+        record.update(status="failed", error="{}: {}".format(type(exc).__name__, exc))
+    record["seconds"] = round(time.monotonic() - start, 3)
+    return record
 
 
 #
@@ -382,12 +1243,17 @@ def main(args: typing.Sequence[str] = None):
         else:
             logging.basicConfig(level=logging.DEBUG)
         LOGGER.setLevel(logging.DEBUG)
-    session = (
-        boto3.Session()
-        if not args.profile
-        else boto3.Session(profile_name=args.profile)
-    )
-    globals()["cmd_" + args.command](args, session)
+    command = globals()["cmd_" + args.command]
+    if not args.timings:
+        command(args, client_registry_for(args))
+        return
+    with recording(dict(command=args.command)) as recorder:
+        try:
+            with phase("total"):
+                command(args, client_registry_for(args))
+        finally:
+            recorder.add_stats("http", DEFAULT_POOL.stats().to_json())
+            recorder.write(args.timings, args.timings_format)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,120 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Parsing of batch manifests into command lines for the individual items.
+
+A manifest lists layer ARNs with the action to run on them. It is either
+
+* JSON or YAML: a list (or a mapping with an "items" list) whose entries are
+  ARN strings or mappings with "arn", an optional "action" and any options of
+  that action, e.g. {"arn": "...", "action": "pull", "extract": "dir"}.
+* Lines: one command line per line, e.g. "pull <arn> --extract dir", or just
+  an ARN. Empty lines and lines starting with # are ignored.
+
+Items without action use the default action.
+"""
+
+import json
+import shlex
+import sys
+import typing
+from os import path
+
+BATCH_ACTIONS = ("info", "pull", "clone")
+FORMATS = ("json", "yaml", "lines")
+
+
+class ManifestError(ValueError):
+    pass
+
+
+def guess_format(filename: str) -> str:
+    ext = path.splitext(filename)[1].lower()
+    if ext == ".json":
+        return "json"
+    if ext in (".yaml", ".yml"):
+        return "yaml"
+    return "lines"
+
+
+def option_to_args(name: str, value) -> typing.List[str]:
+    flag = "--" + name.replace("_", "-")
+    if value is True:
+        return [flag]
+    if value is False or value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [arg for elem in value for arg in option_to_args(name, elem)]
+    return [flag + "=" + str(value)]
+
+
+def item_to_argv(item, default_action: str) -> typing.List[str]:
+    if isinstance(item, str):
+        return [default_action, item]
+    if not isinstance(item, dict) or "arn" not in item:
+        raise ManifestError("Manifest item needs an ARN: " + json.dumps(item))
+    options = dict(item)
+    arn = options.pop("arn")
+    argv = [options.pop("action", default_action)]
+    for name, value in options.items():
+        argv.extend(option_to_args(name, value))
+    argv.append(arn)
+    return argv
+
+
+def line_to_argv(line: str, default_action: str) -> typing.List[str]:
+    argv = shlex.split(line)
+    if argv[0] not in BATCH_ACTIONS:
+        argv.insert(0, default_action)
+    return argv
+
+
+def parse_manifest(
+    text: str, fmt: str, default_action: str
+) -> typing.List[typing.List[str]]:
+    """Returns the command line (starting with the action) for each item."""
+    if fmt == "lines":
+        return [
+            line_to_argv(line, default_action)
+            for line in map(str.strip, text.splitlines())
+            if line and not line.startswith("#")
+        ]
+    if fmt == "yaml":
+        try:
+            # Imported lazily as it is slow to import and rarely needed.
+            import yaml  # pylint:disable=import-outside-toplevel
+        except ImportError:
+            raise ManifestError(
+                "Reading YAML manifests requires PyYAML (pip install PyYAML)"
+            ) from None
+        data = yaml.safe_load(text)
+    else:
+        data = json.loads(text)
+    if isinstance(data, dict):
+        data = data.get("items")
+    if not isinstance(data, list):
+        raise ManifestError("Manifest must contain a list of items")
+    return [item_to_argv(item, default_action) for item in data]
+
+
+def read_manifest(
+    filename: str, fmt: typing.Optional[str], default_action: str
+) -> typing.List[typing.List[str]]:
+    """Reads the manifest from filename ("-" for stdin), see parse_manifest."""
+    if filename == "-":
+        text = sys.stdin.read()
+    else:
+        with open(filename, encoding="utf-8") as infile:
+            text = infile.read()
+    return parse_manifest(text, fmt or guess_format(filename), default_action)
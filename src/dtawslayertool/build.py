@@ -0,0 +1,425 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deterministic layer zip files built from a folder or repacked from a zip file.
+
+Entries are sorted by name and get a fixed timestamp, so building the same
+folder again gives the same CodeSha256 (with the same zlib version and
+compression level) and an identical existing layer version can be found. The
+Unix permission bits of files and folders are kept, symlinks are stored as
+links.
+
+Files are compressed in batches on a process pool, since zlib compression of
+a whole layer on one core is slow. Files larger than a batch are compressed
+in chunks to a temporary file instead of in memory. zipfile cannot write
+compressed data it did not compress itself, so the zip file is written here.
+Layers are far below the limits that would need zip64.
+"""
+
+import contextlib
+import hashlib
+import os
+import shutil
+import stat
+import struct
+import tempfile
+import typing
+import zlib
+from base64 import b64encode
+from collections import deque
+from os import path
+from typing import NamedTuple
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+from dtawslayertool.extract import ZIP_UNIX_SYSTEM
+
+DEFAULT_COMPRESS_LEVEL = 6  # zlib's default
+# The earliest timestamp a zip file can hold
+FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# Small files are compressed together, to keep the process pool overhead low.
+# Larger files are compressed on their own, in chunks of CHUNK_SIZE.
+MAX_BATCH_SIZE = 4 * 1024 * 1024
+MAX_BATCH_ENTRIES = 64
+CHUNK_SIZE = 1024 * 1024
+# Batches in flight per worker; bounds the compressed data held in memory.
+BATCHES_PER_WORKER = 2
+
+ZIP_VERSION = 20  # Needed for deflate and folders
+MSDOS_DIRECTORY = 0x10
+UTF8_FLAG = 0x800
+ZIP32_MAX = 0xFFFFFFFF
+ZIP32_MAX_ENTRIES = 0xFFFF
+
+
+class BuildError(Exception):
+    pass
+
+
+class BuildEntry(NamedTuple):
+    info: ZipInfo
+    # The file to read, or the symlink; with member, the zip file to read it from
+    source: str
+    size: int
+    # The entry of the zip file source
+    member: typing.Optional[str] = None
+
+
+class BuildResult(NamedTuple):
+    file: str
+    code_sha256: str
+    code_size: int
+    entries: int
+    size: int  # Uncompressed
+
+
+class _Compressed(NamedTuple):
+    compress_type: int
+    crc: int
+    file_size: int
+    data: bytes
+    # For large files, the temporary file holding the data instead
+    datafile: typing.Optional[str] = None
+
+    @property
+    def compress_size(self) -> int:
+        return path.getsize(self.datafile) if self.datafile else len(self.data)
+
+
+def entry_info(name: str, mode: int) -> ZipInfo:
+    info = ZipInfo(name, FIXED_DATE_TIME)
+    info.create_system = ZIP_UNIX_SYSTEM
+    info.external_attr = (stat.S_IFMT(mode) | stat.S_IMODE(mode)) << 16
+    if stat.S_ISDIR(mode):
+        info.external_attr |= MSDOS_DIRECTORY
+    return info
+
+
+def plan_build(
+    source_dir: str, exclude: typing.Iterable[str] = ()
+) -> typing.List[BuildEntry]:
+    """Returns the entries for the files, folders and symlinks below source_dir,
+    sorted by name. The paths in exclude (e.g. the zip file to build) are
+    skipped."""
+    excluded = {path.abspath(excludepath) for excludepath in exclude}
+    entries = []
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        for name in dirnames + filenames:
+            fullpath = path.join(dirpath, name)
+            if path.abspath(fullpath) in excluded:
+                continue
+            zipname = path.relpath(fullpath, source_dir).replace(os.sep, "/")
+            stat_result = os.lstat(fullpath)
+            mode = stat_result.st_mode
+            if stat.S_ISDIR(mode):
+                entries.append(BuildEntry(entry_info(zipname + "/", mode), fullpath, 0))
+            elif stat.S_ISLNK(mode) or stat.S_ISREG(mode):
+                # os.walk does not descend into symlinked folders, they are
+                # stored as links as well.
+                size = stat_result.st_size if stat.S_ISREG(mode) else 0
+                entries.append(BuildEntry(entry_info(zipname, mode), fullpath, size))
+            else:
+                raise BuildError("Cannot add special file " + fullpath)
+    entries.sort(key=lambda entry: entry.info.filename)
+    return entries
+
+
+# (source, is_link, member, size) of a BuildEntry
+_BatchItem = typing.Tuple[str, bool, typing.Optional[str], int]
+
+
+def _read_source(source: str, is_link: bool) -> bytes:
+    if is_link:
+        return os.fsencode(os.readlink(source))
+    with open(source, "rb") as infile:
+        return infile.read()
+
+
+def _open_source(
+    source: str, member: typing.Optional[str]
+) -> typing.ContextManager[typing.BinaryIO]:
+    if member is None:
+        return open(source, "rb")
+    return _open_member(source, member)
+
+
+@contextlib.contextmanager
+def _open_member(source: str, member: str) -> typing.Iterator[typing.BinaryIO]:
+    with ZipFile(source) as zipfile, zipfile.open(member) as infile:
+        yield infile
+
+
+def _compress_large(
+    source: str, member: typing.Optional[str], level: int, tmpdir: str
+) -> _Compressed:
+    """Compresses the file in chunks to a temporary file in tmpdir."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    crc = 0
+    file_size = 0
+    fd, datafile = tempfile.mkstemp(dir=tmpdir)
+    with open(fd, "wb") as outfile:
+        with _open_source(source, member) as infile:
+            for chunk in iter(lambda: infile.read(CHUNK_SIZE), b""):
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+                outfile.write(compressor.compress(chunk))
+        outfile.write(compressor.flush())
+        if outfile.tell() < file_size:
+            return _Compressed(ZIP_DEFLATED, crc, file_size, b"", datafile)
+        # Incompressible, stored as is
+        outfile.seek(0)
+        outfile.truncate()
+        with _open_source(source, member) as infile:
+            shutil.copyfileobj(infile, outfile, CHUNK_SIZE)
+    return _Compressed(ZIP_STORED, crc, file_size, b"", datafile)
+
+
+def _compress_batch(
+    batch: typing.List[_BatchItem], level: int, tmpdir: str
+) -> typing.List[_Compressed]:
+    """Reads and compresses the entries; runs in a worker process."""
+    results = []
+    zipfiles = {}  # type: typing.Dict[str, ZipFile]
+    try:
+        for source, is_link, member, size in batch:
+            if size > MAX_BATCH_SIZE and not is_link:
+                results.append(_compress_large(source, member, level, tmpdir))
+                continue
+            if member is None:
+                data = _read_source(source, is_link)
+            else:
+                if source not in zipfiles:
+                    zipfiles[source] = ZipFile(source)
+                data = zipfiles[source].read(member)
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            compressed = compressor.compress(data) + compressor.flush()
+            if len(compressed) < len(data):
+                results.append(
+                    _Compressed(ZIP_DEFLATED, zlib.crc32(data), len(data), compressed)
+                )
+            else:
+                results.append(
+                    _Compressed(ZIP_STORED, zlib.crc32(data), len(data), data)
+                )
+    finally:
+        for zipfile in zipfiles.values():
+            zipfile.close()
+    return results
+
+
+def _batches(
+    entries: typing.Iterable[BuildEntry],
+) -> typing.List[typing.List[_BatchItem]]:
+    batches = []  # type: typing.List[typing.List[_BatchItem]]
+    batchsize = 0
+    for entry in entries:
+        if (
+            not batches
+            or batchsize + entry.size > MAX_BATCH_SIZE
+            or len(batches[-1]) >= MAX_BATCH_ENTRIES
+        ):
+            batches.append([])
+            batchsize = 0
+        is_link = stat.S_ISLNK(entry.info.external_attr >> 16)
+        batches[-1].append((entry.source, is_link, entry.member, entry.size))
+        batchsize += entry.size
+    return batches
+
+
+def _compressed(
+    entries: typing.List[BuildEntry], level: int, concurrency: int, tmpdir: str
+) -> typing.Iterator[_Compressed]:
+    """Yields the compressed entries in order. Large files are compressed to
+    temporary files in tmpdir."""
+    batches = _batches(entries)
+    if concurrency <= 1 or len(batches) <= 1:
+        for batch in batches:
+            yield from _compress_batch(batch, level, tmpdir)
+        return
+    # Imported lazily to keep the startup fast, multiprocessing is slow to
+    # import and only needed for building large layers.
+    # pylint:disable=import-outside-toplevel
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(concurrency) as pool:
+        pending = deque()  # type: typing.Deque
+        for batch in batches:
+            if len(pending) >= concurrency * BATCHES_PER_WORKER:
+                yield from pending.popleft().result()
+            pending.append(pool.submit(_compress_batch, batch, level, tmpdir))
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _dos_date_time(date_time: typing.Tuple[int, ...]) -> typing.Tuple[int, int]:
+    year, month, day, hour, minute, second = date_time
+    return (
+        (year - 1980) << 9 | month << 5 | day,
+        hour << 11 | minute << 5 | second // 2,
+    )
+
+
+class _ZipWriter:
+    """Writes entries that are compressed already, and hashes the output."""
+
+    def __init__(self, fileobj: typing.BinaryIO):
+        self.fileobj = fileobj
+        self.hasher = hashlib.sha256()
+        self.offset = 0
+        self.size = 0  # Uncompressed
+        self.central = []  # type: typing.List[bytes]
+
+    def _write(self, data: bytes):
+        self.fileobj.write(data)
+        self.hasher.update(data)
+        self.offset += len(data)
+
+    def add(self, info: ZipInfo, compressed: _Compressed):
+        try:
+            name = info.filename.encode("ascii")
+            flags = 0
+        except UnicodeEncodeError:
+            name = info.filename.encode("utf-8")
+            flags = UTF8_FLAG
+        dosdate, dostime = _dos_date_time(info.date_time)
+        if max(self.offset, compressed.file_size) > ZIP32_MAX:
+            raise BuildError("Layer too large, it would need a zip64 file")
+        fields = (
+            ZIP_VERSION,
+            flags,
+            compressed.compress_type,
+            dostime,
+            dosdate,
+            compressed.crc,
+            compressed.compress_size,
+            compressed.file_size,
+            len(name),
+            0,  # Extra field length
+        )
+        self.central.append(
+            struct.pack(
+                "<4s2B5H3L5H2L",
+                b"PK\x01\x02",
+                ZIP_VERSION,  # Made by
+                info.create_system,
+                *fields[:-1],
+                0,  # Extra field length
+                0,  # Comment length
+                0,  # Disk number
+                0,  # Internal attributes
+                info.external_attr,
+                self.offset,
+            )
+            + name
+        )
+        self._write(struct.pack("<4s5H3L2H", b"PK\x03\x04", *fields) + name)
+        if compressed.datafile:
+            with open(compressed.datafile, "rb") as datafile:
+                for chunk in iter(lambda: datafile.read(CHUNK_SIZE), b""):
+                    self._write(chunk)
+            os.remove(compressed.datafile)
+        else:
+            self._write(compressed.data)
+        self.size += compressed.file_size
+
+    def close(self):
+        if len(self.central) > ZIP32_MAX_ENTRIES:
+            raise BuildError("Too many files, they would need a zip64 file")
+        start = self.offset
+        for record in self.central:
+            self._write(record)
+        self._write(
+            struct.pack(
+                "<4s4H2LH",
+                b"PK\x05\x06",
+                0,  # Disk number
+                0,  # Disk with the central directory
+                len(self.central),
+                len(self.central),
+                self.offset - start,
+                start,
+                0,  # Comment length
+            )
+        )
+
+
+def plan_repack(
+    zipfilename: str, infolist: typing.Iterable[ZipInfo]
+) -> typing.List[BuildEntry]:
+    """Returns the entries to repack the given entries of a zip file, sorted by
+    name. Unix modes are kept, timestamps are replaced by the fixed one."""
+    entries = []
+    for info in infolist:
+        newinfo = ZipInfo(info.filename, FIXED_DATE_TIME)
+        newinfo.create_system = info.create_system
+        newinfo.external_attr = info.external_attr
+        entries.append(BuildEntry(newinfo, zipfilename, info.file_size, info.filename))
+    entries.sort(key=lambda entry: entry.info.filename)
+    return entries
+
+
+def build_zip(
+    source_dir: str,
+    outfilename: str,
+    concurrency: typing.Optional[int] = None,
+    level: int = DEFAULT_COMPRESS_LEVEL,
+    entries: typing.Optional[typing.List[BuildEntry]] = None,
+) -> BuildResult:
+    """Writes the deterministic zip file of source_dir (or of the given entries
+    of plan_build) to outfilename. See write_zip."""
+    if entries is None:
+        entries = plan_build(source_dir, exclude=(outfilename, outfilename + ".tmp"))
+    return write_zip(entries, outfilename, concurrency, level)
+
+
+def write_zip(
+    entries: typing.List[BuildEntry],
+    outfilename: str,
+    concurrency: typing.Optional[int] = None,
+    level: int = DEFAULT_COMPRESS_LEVEL,
+) -> BuildResult:
+    """Writes the entries (of plan_build or plan_repack) to outfilename.
+
+    concurrency is the number of compressing processes (default: the number of
+    CPUs); with 1, files are compressed in this process.
+    """
+    if concurrency is None:
+        concurrency = os.cpu_count() or 1
+    file_entries = [entry for entry in entries if not entry.info.is_dir()]
+    tmpdir = tempfile.TemporaryDirectory(prefix="dt-build-")
+    compressed = _compressed(file_entries, level, concurrency, tmpdir.name)
+    tmpfilename = outfilename + ".tmp"
+    try:
+        with open(tmpfilename, "wb") as outfile:
+            writer = _ZipWriter(outfile)
+            for entry in entries:
+                if entry.info.is_dir():
+                    writer.add(entry.info, _Compressed(ZIP_STORED, 0, 0, b""))
+                else:
+                    writer.add(entry.info, next(compressed))
+            writer.close()
+        os.replace(tmpfilename, outfilename)
+    except BaseException:
+        if path.lexists(tmpfilename):
+            os.remove(tmpfilename)
+        raise
+    finally:
+        compressed.close()  # Shuts the process pool down
+        tmpdir.cleanup()
+    return BuildResult(
+        outfilename,
+        b64encode(writer.hasher.digest()).decode("ascii"),
+        writer.offset,
+        len(entries),
+        writer.size,
+    )
@@ -0,0 +1,309 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Persistent local caches for layer contents and layer version meta information."""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+import typing
+from base64 import b64decode, b64encode
+from datetime import datetime, timezone
+from os import path
+from typing import NamedTuple, Optional
+from urllib.parse import parse_qs, quote, urlsplit
+
+from dtawslayertool.extract import read_chunks
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+LOGGER = logging.getLogger(__name__)
+
+CACHE_DIR_ENV = "DT_AWSLAYERTOOL_CACHE_DIR"
+DEFAULT_MAX_SIZE = 2 * 1024**3
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def default_cache_dir() -> str:
+    envdir = os.environ.get(CACHE_DIR_ENV)
+    if envdir:
+        return envdir
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA") or path.expanduser("~")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME") or path.join(
+            path.expanduser("~"), ".cache"
+        )
+    return path.join(base, "dt-awslayertool")
+
+
+def parse_size(raw: str) -> int:
+    """Parses a byte count with an optional binary unit suffix, e.g. 500M or 2G."""
+    match = re.fullmatch(r"\s*(\d+)\s*([KMGT]?)i?B?\s*", raw, re.IGNORECASE)
+    if not match:
+        raise ValueError("Not a valid size: " + raw)
+    return int(match.group(1)) * _SIZE_UNITS[match.group(2).upper()]
+
+
+def format_size(size: int) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "TiB"
+    return "{:.1f} {}".format(size, unit) if unit != "B" else "{} B".format(size)
+
+
+def code_sha256(filename, bufsize: int = 8 * 1024 * 1024) -> str:
+    """Returns the SHA-256 of the file, Base64 encoded like AWS's CodeSha256."""
+    hasher = hashlib.sha256()
+    for chunk in read_chunks(filename, bufsize):
+        hasher.update(chunk)
+    return b64encode(hasher.digest()).decode("ascii")
+
+
+def _reflink(src: str, dst: str) -> bool:
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    with open(src, "rb") as srcfile, open(dst, "xb") as dstfile:
+        try:
+            fcntl.ioctl(dstfile.fileno(), FICLONE, srcfile.fileno())
+            return True
+        except OSError:
+            pass
+    os.remove(dst)
+    return False
+
+
+def link_or_copy(src: str, dst: str, hardlink: bool = True) -> str:
+    """Gives dst the contents of src as cheaply as possible.
+
+    dst must not exist yet. Returns the method used: reflink (copy-on-write
+    clone), hardlink (unless disabled) or copy.
+    """
+    if _reflink(src, dst):
+        return "reflink"
+    if hardlink:
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+class CacheEntry(NamedTuple):
+    codesha256: str
+    path: str
+    size: int
+    last_used: float
+
+
+class LayerCache:
+    """Content-addressed store of layer zips with size-bounded LRU eviction.
+
+    Entries are named after the hex SHA-256 of their content. Their mtime is
+    bumped on every use and serves as the LRU timestamp.
+    """
+
+    SUFFIX = ".zip"
+
+    def __init__(self, root: str, max_size: int = DEFAULT_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self.layerdir = path.join(root, "layers")
+
+    def entry_path(self, codesha256: str) -> str:
+        return path.join(self.layerdir, b64decode(codesha256).hex() + self.SUFFIX)
+
+    def lookup(self, codesha256: str, size: Optional[int] = None) -> Optional[str]:
+        """Returns the path of the cached content or None if not cached.
+
+        If size is given, an entry with a different size is considered
+        corrupted and removed.
+        """
+        entrypath = self.entry_path(codesha256)
+        try:
+            if size is not None and path.getsize(entrypath) != size:
+                LOGGER.warning("Removing corrupted cache entry %s", entrypath)
+                os.remove(entrypath)
+                return None
+            os.utime(entrypath)
+        except FileNotFoundError:
+            return None
+        return entrypath
+
+    def materialize(
+        self, codesha256: str, dst: str, size: Optional[int] = None
+    ) -> Optional[str]:
+        """Creates dst from the cached content, if any.
+
+        Returns the method used (see link_or_copy) or None on a cache miss.
+        """
+        entrypath = self.lookup(codesha256, size)
+        if not entrypath:
+            return None
+        return link_or_copy(entrypath, dst)
+
+    def store(self, filename: str, codesha256: str) -> str:
+        """Adds the (already verified) file to the cache and evicts old entries."""
+        os.makedirs(self.layerdir, exist_ok=True)
+        entrypath = self.entry_path(codesha256)
+        tmppath = "{}.{}-{}.tmp".format(entrypath, os.getpid(), threading.get_ident())
+        if path.lexists(tmppath):
+            os.remove(tmppath)
+        # Never a hardlink: the entry would change with the user's file, and
+        # lookup only checks the size.
+        link_or_copy(filename, tmppath, hardlink=False)
+        os.replace(tmppath, entrypath)
+        self.prune(keep=entrypath)
+        return entrypath
+
+    def entries(self) -> typing.List[CacheEntry]:
+        """Returns all entries, most recently used first."""
+        result = []
+        try:
+            names = os.listdir(self.layerdir)
+        except FileNotFoundError:
+            return result
+        for name in names:
+            if not name.endswith(self.SUFFIX):
+                continue
+            try:
+                codesha256 = b64encode(bytes.fromhex(name[: -len(self.SUFFIX)])).decode(
+                    "ascii"
+                )
+            except ValueError:
+                continue
+            entrypath = path.join(self.layerdir, name)
+            try:
+                stat = os.stat(entrypath)
+            except FileNotFoundError:  # Concurrently evicted
+                continue
+            result.append(
+                CacheEntry(codesha256, entrypath, stat.st_size, stat.st_mtime)
+            )
+        result.sort(key=lambda entry: entry.last_used, reverse=True)
+        return result
+
+    def prune(
+        self, max_size: Optional[int] = None, keep: Optional[str] = None
+    ) -> typing.List[CacheEntry]:
+        """Evicts least recently used entries until the cache fits max_size.
+
+        The entry at path keep is never evicted. Returns the evicted entries.
+        """
+        if max_size is None:
+            max_size = self.max_size
+        evicted = []
+        total = 0
+        for entry in self.entries():
+            total += entry.size
+            if total > max_size and entry.path != keep:
+                LOGGER.debug("Evicting cache entry %s", entry.path)
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+                total -= entry.size
+                evicted.append(entry)
+        return evicted
+
+    def check(self) -> typing.List[CacheEntry]:
+        """Rehashes all entries and removes corrupted ones, which are returned."""
+        corrupted = []
+        for entry in self.entries():
+            if code_sha256(entry.path) != entry.codesha256:
+                os.remove(entry.path)
+                corrupted.append(entry)
+        return corrupted
+
+
+def presigned_url_expiry(url: str) -> Optional[float]:
+    """Returns when the presigned URL expires (as Unix time), None if unknown."""
+    query = parse_qs(urlsplit(url).query)
+    try:
+        if "X-Amz-Date" in query:  # Signature version 4
+            signed = datetime.strptime(query["X-Amz-Date"][0], "%Y%m%dT%H%M%SZ")
+            return signed.replace(tzinfo=timezone.utc).timestamp() + int(
+                query["X-Amz-Expires"][0]
+            )
+        return float(query["Expires"][0])  # Signature version 2
+    except (KeyError, ValueError):
+        return None
+
+
+class MetadataCache:
+    """Stores get_layer_version_by_arn results, keyed by layer version ARN.
+
+    Layer versions are immutable, so entries are kept indefinitely, except
+    for the presigned Content.Location URL, which is only returned until
+    shortly before it expires.
+    """
+
+    LOCATION_EXPIRES = "LocationExpires"
+
+    # Leave some time to actually use the URL.
+    EXPIRY_MARGIN_SECONDS = 60
+
+    def __init__(self, root: str):
+        self.root = root
+        self.metadir = path.join(root, "meta")
+
+    def entry_path(self, layer_arn: str) -> str:
+        return path.join(self.metadir, quote(layer_arn, safe="") + ".json")
+
+    def lookup(self, layer_arn: str) -> Optional[dict]:
+        """Returns the cached layer info, without Location if it expired."""
+        try:
+            with open(self.entry_path(layer_arn), encoding="utf-8") as infile:
+                layerinfo = json.load(infile)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            LOGGER.warning("Ignoring corrupted cache entry for %s", layer_arn)
+            return None
+        content = layerinfo["Content"]
+        expires = content.pop(self.LOCATION_EXPIRES, None)
+        if not expires or expires - self.EXPIRY_MARGIN_SECONDS < time.time():
+            content.pop("Location", None)
+        return layerinfo
+
+    def store(self, layer_arn: str, layerinfo: dict):
+        layerinfo = dict(layerinfo)
+        layerinfo.pop("ResponseMetadata", None)
+        content = layerinfo["Content"] = dict(layerinfo["Content"])
+        if "Location" in content:
+            content[self.LOCATION_EXPIRES] = presigned_url_expiry(content["Location"])
+        os.makedirs(self.metadir, exist_ok=True)
+        entrypath = self.entry_path(layer_arn)
+        tmppath = "{}.{}-{}.tmp".format(entrypath, os.getpid(), threading.get_ident())
+        with open(tmppath, "w", encoding="utf-8") as outfile:
+            json.dump(layerinfo, outfile, default=str)
+        os.replace(tmppath, entrypath)
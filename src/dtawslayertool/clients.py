@@ -0,0 +1,111 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reuse of boto3 clients across the operations of a run."""
+
+import logging
+import threading
+import typing
+from typing import NamedTuple
+
+if typing.TYPE_CHECKING:
+    import boto3
+
+LOGGER = logging.getLogger(__name__)
+
+# botocore defaults to 10, which parallel publishing, S3 staging and batch items
+# sharing a client exhaust quickly.
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+RETRY_MODES = ("legacy", "standard", "adaptive")
+DEFAULT_RETRY_MODE = "standard"
+
+
+class ClientConfig(NamedTuple):
+    max_pool_connections: int = DEFAULT_MAX_POOL_CONNECTIONS
+    retry_mode: str = DEFAULT_RETRY_MODE
+    max_attempts: typing.Optional[int] = None  # botocore default if None
+    connect_timeout: typing.Optional[float] = None
+    read_timeout: typing.Optional[float] = None
+
+    def to_botocore(self):
+        # Imported lazily to keep the startup fast, boto3 is only needed once
+        # the first client is created.
+        from botocore.config import Config  # pylint:disable=import-outside-toplevel
+
+        retries = dict(mode=self.retry_mode)  # type: typing.Dict[str, typing.Any]
+        if self.max_attempts is not None:
+            retries["total_max_attempts"] = self.max_attempts
+        kwargs = dict(
+            max_pool_connections=self.max_pool_connections, retries=retries
+        )  # type: typing.Dict[str, typing.Any]
+        if self.connect_timeout is not None:
+            kwargs["connect_timeout"] = self.connect_timeout
+        if self.read_timeout is not None:
+            kwargs["read_timeout"] = self.read_timeout
+        return Config(**kwargs)
+
+
+class ClientRegistry:
+    """Creates boto3 clients on first use and reuses them afterwards.
+
+    Clients are keyed by (profile, region, service). Neither sessions nor
+    client creation are thread-safe in boto3, so both happen under a lock; the
+    clients themselves may be shared between threads.
+    """
+
+    def __init__(
+        self,
+        profile: typing.Optional[str] = None,
+        config: ClientConfig = ClientConfig(),
+    ):
+        self.profile = profile
+        self.config = config
+        self._botocore_config = None
+        self._sessions = {}  # type: typing.Dict[typing.Optional[str], boto3.Session]
+        self._clients = {}  # type: typing.Dict[tuple, typing.Any]
+        self._lock = threading.Lock()
+
+    def _session(self, profile: typing.Optional[str]) -> "boto3.Session":
+        session = self._sessions.get(profile)
+        if session is None:
+            import boto3  # pylint:disable=import-outside-toplevel
+
+            session = (
+                boto3.Session(profile_name=profile) if profile else boto3.Session()
+            )
+            self._sessions[profile] = session
+        return session
+
+    def client(self, service: str, region: str, profile: typing.Optional[str] = None):
+        """Returns the client for service in region, using the default profile
+        of the registry if profile is None."""
+        profile = profile or self.profile
+        key = (profile, region, service)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                LOGGER.debug("Creating %s client for %s (%s)", service, region, profile)
+                if self._botocore_config is None:
+                    self._botocore_config = self.config.to_botocore()
+                client = self._session(profile).client(
+                    service, region_name=region, config=self._botocore_config
+                )
+                self._clients[key] = client
+            return client
+
+    def available_regions(
+        self, service: str, profile: typing.Optional[str] = None
+    ) -> typing.List[str]:
+        with self._lock:
+            return self._session(profile or self.profile).get_available_regions(service)
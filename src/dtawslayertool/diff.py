@@ -0,0 +1,152 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Differences between the entries of two layer zip files.
+
+Files are compared by the size, CRC32 and Unix mode recorded in the central
+directories, so no file content has to be read. Content diffs are only made
+for the files asked for.
+"""
+
+import difflib
+import typing
+from typing import NamedTuple
+from zipfile import ZipInfo
+
+from dtawslayertool.extract import unix_mode
+
+DIFF_STATUSES = ("added", "removed", "modified")
+
+
+class EntryDiff(NamedTuple):
+    name: str
+    status: str  # One of DIFF_STATUSES
+    # None if the file is not in that zip file
+    old_size: typing.Optional[int]
+    new_size: typing.Optional[int]
+    # 0 if the zip file does not record Unix modes
+    old_mode: int = 0
+    new_mode: int = 0
+
+    @property
+    def size_delta(self) -> int:
+        return (self.new_size or 0) - (self.old_size or 0)
+
+
+class DiffResult(NamedTuple):
+    old: str
+    new: str
+    # Sorted by name
+    changes: typing.List[EntryDiff]
+    unchanged: int
+    # Unified diffs of the requested files, by name
+    contents: typing.Dict[str, str]
+
+    @property
+    def size_delta(self) -> int:
+        return sum(change.size_delta for change in self.changes)
+
+    def count(self, status: str) -> int:
+        return sum(change.status == status for change in self.changes)
+
+    def __str__(self):
+        return "{} added, {} removed, {} modified, {} unchanged ({:+d} bytes)".format(
+            self.count("added"),
+            self.count("removed"),
+            self.count("modified"),
+            self.unchanged,
+            self.size_delta,
+        )
+
+
+def diff_entries(
+    old: typing.Iterable[ZipInfo], new: typing.Iterable[ZipInfo]
+) -> typing.Tuple[typing.List[EntryDiff], int]:
+    """Compares the file entries of two zip files by size, CRC32 and mode.
+
+    Modes are only compared if both zip files record them. Returns the changes
+    and the number of unchanged files.
+    """
+    old_files = {info.filename: info for info in old if not info.is_dir()}
+    new_files = {info.filename: info for info in new if not info.is_dir()}
+    changes = []
+    unchanged = 0
+    for name in sorted(old_files.keys() | new_files.keys()):
+        old_info = old_files.get(name)
+        new_info = new_files.get(name)
+        if not old_info:
+            changes.append(
+                EntryDiff(
+                    name, "added", None, new_info.file_size, 0, unix_mode(new_info)
+                )
+            )
+            continue
+        if not new_info:
+            changes.append(
+                EntryDiff(
+                    name, "removed", old_info.file_size, None, unix_mode(old_info), 0
+                )
+            )
+            continue
+        old_mode, new_mode = unix_mode(old_info), unix_mode(new_info)
+        if (
+            (old_info.CRC, old_info.file_size) != (new_info.CRC, new_info.file_size)
+            or old_mode
+            and new_mode
+            and old_mode != new_mode
+        ):
+            changes.append(
+                EntryDiff(
+                    name,
+                    "modified",
+                    old_info.file_size,
+                    new_info.file_size,
+                    old_mode,
+                    new_mode,
+                )
+            )
+        else:
+            unchanged += 1
+    return changes, unchanged
+
+
+def _text_lines(data: bytes) -> typing.Optional[typing.List[str]]:
+    """Returns the lines of data, None if it is not UTF-8 text."""
+    if b"\0" in data:
+        return None
+    try:
+        return data.decode("utf-8").splitlines(keepends=True)
+    except UnicodeDecodeError:
+        return None
+
+
+def content_diff(
+    name: str, old_data: typing.Optional[bytes], new_data: typing.Optional[bytes]
+) -> str:
+    """Returns the unified diff of a file, None data for a missing file."""
+    old_lines = _text_lines(old_data or b"")
+    new_lines = _text_lines(new_data or b"")
+    if old_lines is None or new_lines is None:
+        return "Binary files a/{0} and b/{0} differ\n".format(name)
+    lines = difflib.unified_diff(
+        old_lines,
+        new_lines,
+        "a/" + name if old_data is not None else "/dev/null",
+        "b/" + name if new_data is not None else "/dev/null",
+    )
+    # Like diff, mark a last line without newline.
+    return "".join(
+        line if line.endswith("\n") else line + "\n\\ No newline at end of file\n"
+        for line in lines
+    )
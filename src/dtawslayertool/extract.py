@@ -0,0 +1,346 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Parallel extraction of layer contents.
+
+Layers often consist of thousands of small files, so entries are decompressed
+on a thread pool (zlib releases the GIL) where each worker reads through its
+own ZipFile handle. Directories are created up front, permissions and
+modification times are applied in bulk once all files are written.
+"""
+
+import os
+import shutil
+import threading
+import time
+import typing
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from stat import S_IMODE, S_ISREG
+from typing import NamedTuple
+from zipfile import ZipFile, ZipInfo
+
+DEFAULT_EXTRACT_CONCURRENCY = 8
+
+ZIP_UNIX_SYSTEM = 3
+
+
+class ExtractError(Exception):
+    pass
+
+
+def safe_relpath(name: str) -> str:
+    """Returns the native relative path for the zip entry name.
+
+    Raises ExtractError for names that would end up outside of the target
+    directory, instead of silently rewriting them like ZipFile.extract.
+    """
+    normalized = name.replace(os.sep, "/")
+    if os.altsep:
+        normalized = normalized.replace(os.altsep, "/")
+    parts = [part for part in normalized.split("/") if part not in ("", ".")]
+    if (
+        normalized.startswith("/")
+        or ".." in parts
+        or (parts and path.splitdrive(parts[0])[0])
+    ):
+        raise ExtractError("Refusing to extract unsafe path: " + name)
+    return path.join(*parts) if parts else ""
+
+
+def unix_mode(info: ZipInfo) -> int:
+    """Returns the Unix permission bits of the entry, 0 if there are none."""
+    # Same handling as the former extract_all_with_permission from
+    # https://stackoverflow.com/a/46837272/2128694
+    # by de1 <https://stackoverflow.com/users/8676953/de1>
+    if info.create_system == ZIP_UNIX_SYSTEM:
+        return info.external_attr >> 16
+    return 0
+
+
+def zip_mtime(info: ZipInfo) -> float:
+    try:
+        return time.mktime(info.date_time + (0, 0, -1))
+    except (OverflowError, ValueError):
+        return time.time()
+
+
+class ExtractEntry(NamedTuple):
+    info: ZipInfo
+    target: str
+
+
+def plan_extraction(
+    infolist: typing.Iterable[ZipInfo], target_dir: str
+) -> typing.Tuple[
+    typing.List[str], typing.List[ExtractEntry], typing.List[ExtractEntry]
+]:
+    """Returns (all directories to create, directory entries, file entries)."""
+    target_dir = path.normpath(target_dir)
+    dirs = {target_dir}
+    dir_entries = []
+    file_entries = []
+    for info in infolist:
+        relpath = safe_relpath(info.filename)
+        if not relpath:
+            continue
+        target = path.join(target_dir, relpath)
+        if info.is_dir():
+            dir_entries.append(ExtractEntry(info, target))
+            parent = target
+        else:
+            file_entries.append(ExtractEntry(info, target))
+            parent = path.dirname(target)
+        while parent not in dirs:
+            dirs.add(parent)
+            parent = path.dirname(parent)
+    # Sorting puts parents before their children.
+    return sorted(dirs), dir_entries, file_entries
+
+
+# A zip file name or a function that opens a new ZipFile on each call
+ZipSource = typing.Union[str, typing.Callable[[], ZipFile]]
+
+
+def open_zipfile(source: ZipSource) -> ZipFile:
+    if callable(source):
+        return source()
+    return ZipFile(source, "r")
+
+
+class _WorkerZipFiles:
+    """Opens one ZipFile handle per worker thread, so reads do not contend for
+    the lock of a shared file object."""
+
+    def __init__(self, source: "ZipSource"):
+        self.source = source
+        self._local = threading.local()
+        self._handles = []  # type: typing.List[ZipFile]
+        self._lock = threading.Lock()
+
+    def get(self) -> ZipFile:
+        zipfile = getattr(self._local, "zipfile", None)
+        if zipfile is None:
+            zipfile = open_zipfile(self.source)
+            self._local.zipfile = zipfile
+            with self._lock:
+                self._handles.append(zipfile)
+        return zipfile
+
+    def close(self):
+        for zipfile in self._handles:
+            zipfile.close()
+
+
+def write_entry(zipfile: ZipFile, entry: ExtractEntry, bufsize: int = 256 * 1024):
+    if path.isdir(entry.target) and not path.islink(entry.target):
+        raise ExtractError("Cannot extract over directory " + entry.target)
+    if path.lexists(entry.target):
+        # Replaces read-only files and does not write through symlinks.
+        os.unlink(entry.target)
+    with zipfile.open(entry.info) as src, open(entry.target, "wb") as dst:
+        shutil.copyfileobj(src, dst, bufsize)
+
+
+def apply_attributes(entries: typing.Iterable[ExtractEntry]):
+    for entry in entries:
+        mode = unix_mode(entry.info)
+        if mode:
+            os.chmod(entry.target, mode)
+        mtime = zip_mtime(entry.info)
+        os.utime(entry.target, (mtime, mtime))
+
+
+def _map(concurrency: int, func, items: list) -> list:
+    if concurrency <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="extract") as pool:
+        return list(pool.map(func, items))
+
+
+def write_entries(
+    source: "ZipSource", file_entries: typing.List[ExtractEntry], concurrency: int
+):
+    handles = _WorkerZipFiles(source)
+    try:
+        _map(concurrency, lambda entry: write_entry(handles.get(), entry), file_entries)
+    finally:
+        handles.close()
+
+
+def apply_dir_attributes(dir_entries: typing.Iterable[ExtractEntry]):
+    # Deepest directories first, so that writing their attributes does not
+    # change the mtime of the parent again and restrictive permissions of a
+    # parent do not prevent updating its children.
+    apply_attributes(
+        sorted(dir_entries, key=lambda entry: entry.target.count(os.sep), reverse=True)
+    )
+
+
+def read_entries(
+    source: "ZipSource", entries: typing.Optional[typing.Iterable[ZipInfo]]
+) -> typing.Iterable[ZipInfo]:
+    if entries is None:
+        with open_zipfile(source) as zipfile:
+            entries = zipfile.infolist()
+    return entries
+
+
+def extract_all(
+    source: "ZipSource",
+    target_dir: str,
+    concurrency: int = DEFAULT_EXTRACT_CONCURRENCY,
+    entries: typing.Optional[typing.Iterable[ZipInfo]] = None,
+) -> typing.List[ExtractEntry]:
+    """Extracts the zip file (or only the given entries of it) to target_dir.
+
+    See ZipSource for the possible sources.
+
+    Returns the extracted file entries.
+    """
+    dirs, dir_entries, file_entries = plan_extraction(
+        read_entries(source, entries), target_dir
+    )
+    for dirname in dirs:
+        os.makedirs(dirname, exist_ok=True)
+    write_entries(source, file_entries, concurrency)
+    apply_attributes(file_entries)
+    apply_dir_attributes(dir_entries)
+    return file_entries
+
+
+class ExtractSummary(NamedTuple):
+    added: typing.List[str]
+    changed: typing.List[str]
+    removed: typing.List[str]
+    unchanged: typing.List[str]
+
+    def __str__(self):
+        return "{} added, {} changed, {} removed, {} unchanged".format(*map(len, self))
+
+
+def read_chunks(filename: str, bufsize: int) -> typing.Iterator[memoryview]:
+    """Yields the content of the file in chunks of up to bufsize bytes. All
+    chunks share one buffer, a chunk is only valid until the next is read."""
+    with open(filename, "rb") as infile:
+        buffer = memoryview(bytearray(bufsize))
+        while True:
+            nread = infile.readinto(buffer)
+            if nread <= 0:
+                break
+            yield buffer[:nread]
+
+
+def file_crc32(filename: str, bufsize: int = 256 * 1024) -> int:
+    crc = 0
+    for chunk in read_chunks(filename, bufsize):
+        crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def is_unchanged(entry: ExtractEntry) -> bool:
+    """Compares size and CRC32 of the existing file with the zip entry."""
+    try:
+        stat = os.lstat(entry.target)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+    if not S_ISREG(stat.st_mode) or stat.st_size != entry.info.file_size:
+        return False
+    return file_crc32(entry.target) == entry.info.CRC
+
+
+def scan_tree(target_dir: str) -> typing.Tuple[typing.Set[str], typing.Set[str]]:
+    """Returns the paths of all non-directories and directories below target_dir."""
+    files = set()
+    dirs = set()
+    for dirpath, dirnames, filenames in os.walk(target_dir):
+        for dirname in list(dirnames):
+            dirpath_full = path.join(dirpath, dirname)
+            if path.islink(dirpath_full):  # os.walk does not follow it
+                files.add(dirpath_full)
+            else:
+                dirs.add(dirpath_full)
+        files.update(path.join(dirpath, filename) for filename in filenames)
+    return files, dirs
+
+
+def extract_incremental(
+    source: "ZipSource",
+    target_dir: str,
+    concurrency: int = DEFAULT_EXTRACT_CONCURRENCY,
+    entries: typing.Optional[typing.Iterable[ZipInfo]] = None,
+) -> ExtractSummary:
+    """Updates an existing extraction in target_dir to match the zip file.
+
+    Files whose size and CRC32 match their entry are left untouched (including
+    their mtime), changed and added files are written, and files or
+    directories that are not in the zip file anymore are removed.
+    """
+    dirs, dir_entries, file_entries = plan_extraction(
+        read_entries(source, entries), target_dir
+    )
+    target_dir = path.normpath(target_dir)
+    old_files, old_dirs = scan_tree(target_dir)
+    new_files = {entry.target for entry in file_entries}
+
+    unchanged_flags = _map(concurrency, is_unchanged, file_entries)
+    written = [
+        entry
+        for entry, unchanged in zip(file_entries, unchanged_flags)
+        if not unchanged
+    ]
+
+    def relpaths(paths: typing.Iterable[str]) -> typing.List[str]:
+        return sorted(path.relpath(name, target_dir) for name in paths)
+
+    removed = old_files - new_files
+    for name in removed:
+        os.unlink(name)
+    # Directories that are replaced by files or not in the zip file anymore
+    stale_dirs = (old_dirs - set(dirs)) | (old_dirs & new_files)
+    for dirname in sorted(
+        stale_dirs, key=lambda name: name.count(os.sep), reverse=True
+    ):
+        if path.lexists(dirname):
+            for name in scan_tree(dirname)[0]:
+                removed.add(name)
+            shutil.rmtree(dirname)
+
+    for dirname in dirs:
+        # Never extract through symlinks, but target_dir itself may be one.
+        if dirname != target_dir and path.islink(dirname):
+            os.unlink(dirname)
+        os.makedirs(dirname, exist_ok=True)
+    write_entries(source, written, concurrency)
+    apply_attributes(written)
+    unchanged = [
+        entry for entry, is_same in zip(file_entries, unchanged_flags) if is_same
+    ]
+    for entry in unchanged:
+        mode = unix_mode(entry.info)
+        if mode and S_IMODE(os.lstat(entry.target).st_mode) != S_IMODE(mode):
+            os.chmod(entry.target, mode)
+    apply_dir_attributes(dir_entries)
+
+    return ExtractSummary(
+        added=relpaths(
+            entry.target for entry in written if entry.target not in old_files
+        ),
+        changed=relpaths(
+            entry.target for entry in written if entry.target in old_files
+        ),
+        removed=relpaths(removed - new_files),
+        unchanged=relpaths(entry.target for entry in unchanged),
+    )
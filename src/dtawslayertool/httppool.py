@@ -0,0 +1,333 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keep-alive HTTP connections for downloading layer contents.
+
+urlopen connects (and negotiates TLS) for every request, but ranged downloads,
+RemoteZip and batch runs make many requests to the same S3 endpoints.
+HttpPool keeps the idle connections per host and reuses them. Requests through
+a proxy (or for other schemes than http and https) fall back to urlopen.
+"""
+
+import io
+import logging
+import threading
+import time
+import typing
+from collections import deque
+from typing import NamedTuple
+from urllib.error import HTTPError
+from urllib.parse import SplitResult, urljoin, urlsplit
+
+if typing.TYPE_CHECKING:
+    import http.client
+    import ssl
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CONNECT_TIMEOUT = 60.0
+DEFAULT_READ_TIMEOUT = 60.0
+MAX_IDLE_PER_HOST = 16
+# Servers close idle connections after a while (S3 after about 20 seconds);
+# older ones are not worth the failed attempt.
+MAX_IDLE_SECONDS = 15.0
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+
+class Timeouts(NamedTuple):
+    connect: float = DEFAULT_CONNECT_TIMEOUT
+    # Maximum time without receiving data
+    read: float = DEFAULT_READ_TIMEOUT
+
+
+class HttpStats(NamedTuple):
+    requests: int
+    connections: int  # Newly opened
+    reused: int  # Requests on a kept-alive connection
+    bytes: int  # Response bodies
+    # Summed duration of the requests, from sending them until their response
+    # was closed. Requests in parallel count in full.
+    seconds: float
+
+    @property
+    def throughput(self) -> typing.Optional[float]:
+        """Average bytes per second of a single request, None if unknown."""
+        return self.bytes / self.seconds if self.seconds else None
+
+    def to_json(self) -> dict:
+        return dict(self._asdict(), throughput=self.throughput)
+
+
+class PooledResponse:
+    """Response whose connection goes back to the pool once it is closed after
+    its body was read completely. Otherwise, the connection is closed."""
+
+    def __init__(
+        self,
+        pool: "HttpPool",
+        key: typing.Optional[tuple],
+        conn: typing.Optional["http.client.HTTPConnection"],
+        response: "http.client.HTTPResponse",
+        start: float,
+    ):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._start = start
+        self._nbytes = 0
+        self._closed = False
+
+    @property
+    def status(self) -> int:
+        return self._response.status
+
+    @property
+    def reason(self) -> str:
+        return self._response.reason
+
+    @property
+    def headers(self) -> "http.client.HTTPMessage":
+        return self._response.headers
+
+    def readinto(self, buffer) -> int:
+        nread = self._response.readinto(buffer)
+        self._nbytes += nread
+        return nread
+
+    def read(self, amt: typing.Optional[int] = None) -> bytes:
+        data = self._response.read(amt)
+        self._nbytes += len(data)
+        return data
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        reusable = self._response.isclosed() and not self._response.will_close
+        self._response.close()
+        self._pool.finished(
+            self._key,
+            self._conn,
+            reusable,
+            self._nbytes,
+            time.monotonic() - self._start,
+        )
+
+    def __enter__(self) -> "PooledResponse":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# (connection, time it became idle), most recently used last
+_IdleConnections = typing.Deque[typing.Tuple["http.client.HTTPConnection", float]]
+
+
+class HttpPool:
+    """Thread-safe pool of keep-alive connections, per scheme, host and port."""
+
+    def __init__(
+        self,
+        max_idle_per_host: int = MAX_IDLE_PER_HOST,
+        max_idle_seconds: float = MAX_IDLE_SECONDS,
+    ):
+        self.max_idle_per_host = max_idle_per_host
+        self.max_idle_seconds = max_idle_seconds
+        self._idle = {}  # type: typing.Dict[tuple, _IdleConnections]
+        self._lock = threading.Lock()
+        self._sslcontext = None  # type: typing.Optional[ssl.SSLContext]
+        self._counts = dict(requests=0, connections=0, reused=0, bytes=0)
+        self._seconds = 0.0
+
+    def stats(self) -> HttpStats:
+        with self._lock:
+            return HttpStats(seconds=self._seconds, **self._counts)
+
+    def open(
+        self,
+        url: str,
+        headers: typing.Optional[typing.Dict[str, str]] = None,
+        timeouts: Timeouts = Timeouts(),
+    ) -> PooledResponse:
+        """GETs url, following redirects. Raises HTTPError for error statuses,
+        like urlopen."""
+        for _redirect in range(MAX_REDIRECTS + 1):
+            response = self._request(url, headers or {}, timeouts)
+            if response.status < 300:
+                return response
+            location = response.headers.get("Location")
+            # Error bodies are small, reading them lets the connection be reused.
+            body = response.read()
+            response.close()
+            if response.status in REDIRECT_STATUSES and location:
+                url = urljoin(url, location)
+                continue
+            raise HTTPError(
+                url,
+                response.status,
+                response.reason,
+                response.headers,
+                io.BytesIO(body),
+            )
+        raise HTTPError(
+            url,
+            response.status,
+            "Too many redirects",
+            response.headers,
+            io.BytesIO(b""),
+        )
+
+    def close(self):
+        """Closes the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, _idlesince in connections:
+                conn.close()
+
+    def finished(
+        self,
+        key: typing.Optional[tuple],
+        conn: typing.Optional["http.client.HTTPConnection"],
+        reusable: bool,
+        nbytes: int,
+        seconds: float,
+    ):
+        with self._lock:
+            self._counts["bytes"] += nbytes
+            self._seconds += seconds
+            if conn is None:
+                return
+            if reusable:
+                connections = self._idle.setdefault(key, deque())
+                if len(connections) < self.max_idle_per_host:
+                    connections.append((conn, time.monotonic()))
+                    return
+        conn.close()
+
+    def _request(
+        self, url: str, headers: typing.Dict[str, str], timeouts: Timeouts
+    ) -> PooledResponse:
+        # Imported lazily to keep the startup fast, see _connect.
+        import http.client  # pylint:disable=import-outside-toplevel
+        from urllib.request import (  # pylint:disable=import-outside-toplevel
+            Request,
+            urlopen,
+        )
+
+        start = time.monotonic()
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or _proxied(parts):
+            response = urlopen(Request(url, headers=headers), timeout=timeouts.read)
+            self._count(connections=1)
+            return PooledResponse(self, None, None, response, start)
+
+        key = (parts.scheme, parts.hostname, parts.port)
+        target = parts.path or "/"
+        if parts.query:
+            target += "?" + parts.query
+        conn = self._checkout(key)
+        while True:
+            reused = conn is not None
+            if conn is None:
+                conn = self._connect(parts, timeouts)
+            try:
+                conn.sock.settimeout(timeouts.read)
+                conn.request("GET", target, headers=headers)
+                response = conn.getresponse()
+            except (ConnectionError, http.client.BadStatusLine) as exc:
+                conn.close()
+                if not reused:
+                    raise
+                LOGGER.debug("Kept-alive connection to %s failed: %s", key, exc)
+                conn = None
+                continue
+            except BaseException:
+                conn.close()
+                raise
+            if reused:
+                self._count(reused=1)
+            else:
+                self._count(connections=1)
+            return PooledResponse(self, key, conn, response, start)
+
+    def _count(self, **increments: int):
+        with self._lock:
+            self._counts["requests"] += 1
+            for name, increment in increments.items():
+                self._counts[name] += increment
+
+    def _checkout(self, key: tuple) -> typing.Optional["http.client.HTTPConnection"]:
+        expired = []
+        conn = None
+        with self._lock:
+            connections = self._idle.get(key)
+            while connections:
+                candidate, idlesince = connections.pop()
+                if time.monotonic() - idlesince <= self.max_idle_seconds:
+                    conn = candidate
+                    break
+                expired.append(candidate)
+        for candidate in expired:
+            candidate.close()
+        return conn
+
+    def _connect(
+        self, parts: SplitResult, timeouts: Timeouts
+    ) -> "http.client.HTTPConnection":
+        # Imported lazily to keep the startup fast, http.client and ssl are
+        # only needed once the first layer is downloaded.
+        import http.client  # pylint:disable=import-outside-toplevel
+
+        if parts.scheme == "https":
+            conn = http.client.HTTPSConnection(
+                parts.hostname,
+                parts.port,
+                timeout=timeouts.connect,
+                context=self._ssl_context(),
+            )  # type: http.client.HTTPConnection
+        else:
+            conn = http.client.HTTPConnection(
+                parts.hostname, parts.port, timeout=timeouts.connect
+            )
+        try:
+            conn.connect()
+        except BaseException:
+            conn.close()
+            raise
+        return conn
+
+    def _ssl_context(self) -> "ssl.SSLContext":
+        import ssl  # pylint:disable=import-outside-toplevel
+
+        with self._lock:
+            if self._sslcontext is None:
+                self._sslcontext = ssl.create_default_context()
+            return self._sslcontext
+
+
+def _proxied(parts: SplitResult) -> bool:
+    from urllib.request import (  # pylint:disable=import-outside-toplevel
+        getproxies,
+        proxy_bypass,
+    )
+
+    return parts.scheme in getproxies() and not proxy_bypass(parts.hostname)
+
+
+# Shared by all downloads of the process
+DEFAULT_POOL = HttpPool()
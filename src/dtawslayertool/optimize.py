@@ -0,0 +1,79 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Size and extract time statistics of layer zip files, and prune rules.
+
+Lambda unpacks layers at cold start, which takes longer the more files and
+bytes a layer has. The extract time estimate uses rough throughputs of that
+unpacking; it is meant for comparing two zip files of the same layer, not as
+a prediction.
+"""
+
+import os
+import typing
+from typing import NamedTuple
+from zipfile import ZIP_STORED, ZipInfo
+
+# Creating, writing and closing a file or creating a folder
+EXTRACT_SECONDS_PER_ENTRY = 0.0001
+INFLATE_BYTES_PER_SECOND = 200 * 1024 * 1024
+COPY_BYTES_PER_SECOND = 1024 * 1024 * 1024
+
+
+class ZipStats(NamedTuple):
+    zip_size: int
+    size: int  # Uncompressed
+    files: int
+    extract_seconds: float  # Estimated
+
+
+class OptimizeResult(NamedTuple):
+    file: str
+    code_sha256: str
+    before: ZipStats
+    after: ZipStats
+    # Sorted
+    pruned: typing.List[str]
+
+
+def estimate_extract_seconds(infolist: typing.Iterable[ZipInfo]) -> float:
+    seconds = 0.0
+    for info in infolist:
+        seconds += EXTRACT_SECONDS_PER_ENTRY
+        if info.compress_type == ZIP_STORED:
+            seconds += info.file_size / COPY_BYTES_PER_SECOND
+        else:
+            seconds += info.file_size / INFLATE_BYTES_PER_SECOND
+    return seconds
+
+
+def zip_stats(filename: str, infolist: typing.List[ZipInfo]) -> ZipStats:
+    """Returns the statistics of the zip file with the given entries."""
+    return ZipStats(
+        os.path.getsize(filename),
+        sum(info.file_size for info in infolist),
+        sum(not info.is_dir() for info in infolist),
+        estimate_extract_seconds(infolist),
+    )
+
+
+def read_prune_rules(filename: str) -> typing.List[str]:
+    """Reads glob patterns, one per line. Empty lines and lines starting with #
+    are skipped."""
+    with open(filename, encoding="utf-8") as rulesfile:
+        return [
+            line.strip()
+            for line in rulesfile
+            if line.strip() and not line.lstrip().startswith("#")
+        ]
@@ -0,0 +1,261 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Random access to a layer's zip file through HTTP Range requests.
+
+Only the end of central directory records and the central directory are
+fetched to list the contents; selected entries are fetched in a few coalesced
+ranges. zipfile does the parsing (including zip64) and CRC checks, it reads
+through a file object that serves the fetched blocks.
+"""
+
+import bisect
+import fnmatch
+import io
+import logging
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile, ZipInfo
+
+from dtawslayertool.transfer import DEFAULT_CONCURRENCY, TransferError, UrlSource
+
+LOGGER = logging.getLogger(__name__)
+
+# End of central directory record (22 bytes) with the longest possible comment,
+# plus room for the zip64 locator and record that precede it.
+TAIL_SIZE = 22 + 0xFFFF + 20 + 56
+MIN_FETCH_SIZE = 64 * 1024
+# Unselected entries between selected ones are fetched as well if they are
+# smaller than this, to save a request.
+MAX_GAP = 256 * 1024
+DEFAULT_MAX_RANGE_SIZE = 8 * 1024 * 1024
+
+
+class RangesNotSupported(TransferError):
+    pass
+
+
+def _path_prefixes(name: str) -> typing.Iterator[str]:
+    """Yields name and all its parent directories, e.g. a/b/c, a/b, a."""
+    name = name.rstrip("/")
+    while name:
+        yield name
+        name = name.rpartition("/")[0]
+
+
+def name_matches(name: str, patterns: typing.Sequence[str]) -> bool:
+    """Checks if the entry name or one of its parent directories matches one
+    of the glob patterns."""
+    return any(
+        fnmatch.fnmatchcase(prefix, pattern.rstrip("/"))
+        for prefix in _path_prefixes(name)
+        for pattern in patterns
+    )
+
+
+def is_selected(
+    name: str,
+    include: typing.Optional[typing.Sequence[str]] = None,
+    exclude: typing.Optional[typing.Sequence[str]] = None,
+) -> bool:
+    """See select_entries."""
+    return (not include or name_matches(name, include)) and not (
+        exclude and name_matches(name, exclude)
+    )
+
+
+def select_entries(
+    infolist: typing.Iterable[ZipInfo],
+    include: typing.Optional[typing.Sequence[str]] = None,
+    exclude: typing.Optional[typing.Sequence[str]] = None,
+) -> typing.List[ZipInfo]:
+    """Filters entries by glob patterns.
+
+    An entry matches a pattern if its name or one of its parent directories
+    does, so "nodejs" selects the whole folder. Without include patterns, all
+    entries that are not excluded are selected.
+    """
+
+    return [info for info in infolist if is_selected(info.filename, include, exclude)]
+
+
+class _BlockCache:
+    """Fetched byte ranges of the remote file, shared by all readers."""
+
+    def __init__(self, source: UrlSource, size: int):
+        self.source = source
+        self.size = size
+        self._starts = []  # type: typing.List[int]
+        self._blocks = {}  # type: typing.Dict[int, bytes]
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def fetch(self, start: int, length: int):
+        length = min(length, self.size - start)
+        if length <= 0:
+            return
+        rangeheader = "bytes={}-{}".format(start, start + length - 1)
+        LOGGER.debug("Fetching %s", rangeheader)
+        with self.source.open(rangeheader) as response:
+            if response.status != 206:
+                raise RangesNotSupported(
+                    "Server does not support range requests (HTTP {})".format(
+                        response.status
+                    )
+                )
+            data = response.read()
+        if len(data) != length:
+            raise TransferError(
+                "Expected {} bytes for {}, got {}".format(
+                    length, rangeheader, len(data)
+                )
+            )
+        with self._lock:
+            self.requests += 1
+            if start not in self._blocks:
+                bisect.insort(self._starts, start)
+            self._blocks[start] = data
+
+    def find(self, pos: int) -> typing.Optional[typing.Tuple[int, bytes]]:
+        """Returns the block (start, data) that contains pos, if any."""
+        with self._lock:
+            index = bisect.bisect_right(self._starts, pos) - 1
+            # Blocks may overlap, so look back for one that reaches pos.
+            while index >= 0:
+                start = self._starts[index]
+                data = self._blocks[start]
+                if pos < start + len(data):
+                    return start, data
+                index -= 1
+            return None
+
+
+class _RemoteFile(io.RawIOBase):
+    """Seekable, read-only file object on a _BlockCache.
+
+    Reads of ranges that are not in the cache yet fetch at least
+    MIN_FETCH_SIZE bytes.
+    """
+
+    def __init__(self, cache: _BlockCache):
+        super().__init__()
+        self._cache = cache
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._cache.size
+        if offset < 0:
+            raise ValueError("Negative seek position {}".format(offset))
+        self._pos = offset
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        wanted = min(len(buffer), self._cache.size - self._pos)
+        nread = 0
+        with memoryview(buffer) as view:
+            while nread < wanted:
+                pos = self._pos + nread
+                block = self._cache.find(pos)
+                if block is None:
+                    self._cache.fetch(pos, max(wanted - nread, MIN_FETCH_SIZE))
+                    continue
+                start, data = block
+                chunk = data[pos - start : pos - start + wanted - nread]
+                view[nread : nread + len(chunk)] = chunk
+                nread += len(chunk)
+        self._pos += nread
+        return nread
+
+
+class RemoteZip:
+    """A zip file at a URL that supports Range requests."""
+
+    def __init__(
+        self,
+        source: UrlSource,
+        size: int,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        max_range_size: int = DEFAULT_MAX_RANGE_SIZE,
+    ):
+        self._cache = _BlockCache(source, size)
+        self.concurrency = concurrency
+        self.max_range_size = max_range_size
+        tailstart = max(0, size - TAIL_SIZE)
+        self._cache.fetch(tailstart, size - tailstart)
+        self._zipfile = self.open_zipfile()
+
+    @property
+    def requests(self) -> int:
+        """Number of range requests made so far."""
+        return self._cache.requests
+
+    def open_zipfile(self) -> ZipFile:
+        """Returns a new ZipFile (with its own file position) on the remote file."""
+        return ZipFile(_RemoteFile(self._cache), "r")
+
+    def infolist(self) -> typing.List[ZipInfo]:
+        return self._zipfile.infolist()
+
+    def entry_ranges(
+        self, entries: typing.Iterable[ZipInfo]
+    ) -> typing.List[typing.Tuple[int, int]]:
+        """Returns the coalesced (start, length) ranges that hold the entries.
+
+        An entry spans from its local header to the next entry's local header
+        (or the central directory), which includes the local extra field and
+        data descriptor whose sizes the central directory does not tell.
+        """
+        offsets = sorted(info.header_offset for info in self.infolist())
+        offsets.append(self._zipfile.start_dir)
+        wanted = sorted({info.header_offset for info in entries})
+        ranges = []  # type: typing.List[typing.List[int]]
+        for start in wanted:
+            end = offsets[bisect.bisect_right(offsets, start)]
+            if ranges and start - ranges[-1][1] <= MAX_GAP:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        result = []
+        for start, end in ranges:
+            for partstart in range(start, end, self.max_range_size):
+                result.append((partstart, min(self.max_range_size, end - partstart)))
+        return result
+
+    def prefetch(self, entries: typing.Iterable[ZipInfo]) -> int:
+        """Fetches the given entries in parallel, so that reading them does
+        not issue any further requests. Returns the number of bytes fetched."""
+        ranges = self.entry_ranges(entries)
+        LOGGER.info("Fetching %d ranges", len(ranges))
+        if len(ranges) <= 1 or self.concurrency <= 1:
+            for start, length in ranges:
+                self._cache.fetch(start, length)
+        else:
+            with ThreadPoolExecutor(
+                self.concurrency, thread_name_prefix="range"
+            ) as pool:
+                list(pool.map(lambda rng: self._cache.fetch(*rng), ranges))
+        return sum(length for _start, length in ranges)
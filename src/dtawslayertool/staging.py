@@ -0,0 +1,109 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Staging of layer contents in S3 for publish_layer_version."""
+
+import contextlib
+import logging
+import typing
+import uuid
+from base64 import b64decode
+
+LOGGER = logging.getLogger(__name__)
+
+REGION_PLACEHOLDER = "{region}"
+DEFAULT_PREFIX = "dt-awslayertool/"
+
+# S3 rejects multipart uploads with smaller parts (except the last one).
+MIN_MULTIPART_CHUNKSIZE = 5 * 1024 * 1024
+
+
+@contextlib.contextmanager
+def inline_content(layercontent: bytes) -> typing.Iterator[dict]:
+    """Passes the layer content directly in the publish_layer_version request."""
+    yield dict(ZipFile=layercontent)
+
+
+class S3Staging:
+    """Uploads layer contents to per-region staging buckets.
+
+    publish_layer_version requires the bucket to be in the same region as the
+    layer, so bucket names may contain REGION_PLACEHOLDER. Missing buckets are
+    created, staged objects are deleted once the layer is published.
+    """
+
+    def __init__(
+        self,
+        bucket_template: str,
+        prefix: str,
+        filename: str,
+        layername: str,
+        codesha256: str,
+        part_size: int,
+        concurrency: int,
+    ):
+        self.bucket_template = bucket_template
+        self.filename = filename
+        # Unique per run, so that concurrent runs staging the same content do
+        # not delete each other's objects.
+        self.key = "{}{}/{}-{}.zip".format(
+            prefix, layername, b64decode(codesha256).hex(), uuid.uuid4().hex
+        )
+        # pylint:disable=import-outside-toplevel
+        # Imported lazily to keep the startup fast, see ClientRegistry._session.
+        from boto3.s3.transfer import TransferConfig as S3TransferConfig
+
+        self.transferconfig = S3TransferConfig(
+            multipart_threshold=max(part_size, MIN_MULTIPART_CHUNKSIZE),
+            multipart_chunksize=max(part_size, MIN_MULTIPART_CHUNKSIZE),
+            max_concurrency=concurrency,
+        )
+
+    def bucket_for(self, region: str) -> str:
+        return self.bucket_template.replace(REGION_PLACEHOLDER, region)
+
+    def ensure_bucket(self, s3client, bucket: str, region: str):
+        from botocore.exceptions import (  # pylint:disable=import-outside-toplevel
+            ClientError,
+        )
+
+        try:
+            s3client.head_bucket(Bucket=bucket)
+            return
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] not in ("404", "NoSuchBucket"):
+                raise
+        LOGGER.info("Creating staging bucket %s in %s", bucket, region)
+        if region == "us-east-1":  # Rejects an explicit LocationConstraint
+            s3client.create_bucket(Bucket=bucket)
+        else:
+            s3client.create_bucket(
+                Bucket=bucket,
+                CreateBucketConfiguration=dict(LocationConstraint=region),
+            )
+
+    @contextlib.contextmanager
+    def stage(self, s3client, region: str) -> typing.Iterator[dict]:
+        """Uploads the layer content and yields the Content for publishing."""
+        bucket = self.bucket_for(region)
+        self.ensure_bucket(s3client, bucket, region)
+        LOGGER.info("Staging layer content as s3://%s/%s", bucket, self.key)
+        s3client.upload_file(
+            self.filename, bucket, self.key, Config=self.transferconfig
+        )
+        try:
+            yield dict(S3Bucket=bucket, S3Key=self.key)
+        finally:
+            LOGGER.info("Removing staged s3://%s/%s", bucket, self.key)
+            s3client.delete_object(Bucket=bucket, Key=self.key)
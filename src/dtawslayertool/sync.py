@@ -0,0 +1,117 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bookkeeping for mirroring all versions of a layer to other regions."""
+
+import json
+import logging
+import os
+import threading
+import typing
+from os import path
+from typing import NamedTuple
+from urllib.parse import quote
+
+LOGGER = logging.getLogger(__name__)
+
+
+SYNC_STATUSES = ("up-to-date", "matched", "published", "failed")
+
+
+class SyncRecord(NamedTuple):
+    source: str
+    region: str
+    target: typing.Optional[str]
+    status: str  # One of SYNC_STATUSES
+    error: typing.Optional[str] = None
+
+
+def default_state_file(cache_root: str, source_layer_arn: str) -> str:
+    return path.join(cache_root, "sync", quote(source_layer_arn, safe="") + ".json")
+
+
+def layer_version_number(layer_version_arn: str) -> int:
+    return int(layer_version_arn.rsplit(":", 1)[1])
+
+
+class SyncState:
+    """Remembers which target layer version each source version was mirrored
+    to, per target region.
+
+    The state only saves API calls: entries are checked against the versions
+    that currently exist in the target, and a lost state file is rebuilt by
+    matching content hashes.
+    """
+
+    def __init__(self, filename: str, source_layer_arn: str):
+        self.filename = filename
+        self.source_layer_arn = source_layer_arn
+        # source version ARN -> region -> target version ARN
+        self.versions = {}  # type: typing.Dict[str, typing.Dict[str, str]]
+        self._lock = threading.Lock()
+
+    def load(self) -> "SyncState":
+        try:
+            with open(self.filename, encoding="utf-8") as infile:
+                saved = json.load(infile)
+        except FileNotFoundError:
+            return self
+        except ValueError:
+            LOGGER.warning("Ignoring unreadable sync state %s", self.filename)
+            return self
+        if saved.get("Source") != self.source_layer_arn:
+            LOGGER.warning(
+                "Ignoring sync state %s for other layer %s",
+                self.filename,
+                saved.get("Source"),
+            )
+            return self
+        self.versions = saved.get("Versions", {})
+        return self
+
+    def target(self, source_arn: str, region: str) -> typing.Optional[str]:
+        with self._lock:
+            return self.versions.get(source_arn, {}).get(region)
+
+    def record(self, source_arn: str, region: str, target_arn: str):
+        with self._lock:
+            self.versions.setdefault(source_arn, {})[region] = target_arn
+            os.makedirs(path.dirname(path.abspath(self.filename)), exist_ok=True)
+            tmpfilename = self.filename + ".tmp"
+            with open(tmpfilename, "w", encoding="utf-8") as outfile:
+                json.dump(
+                    dict(Source=self.source_layer_arn, Versions=self.versions),
+                    outfile,
+                    indent=1,
+                    sort_keys=True,
+                )
+            os.replace(tmpfilename, self.filename)
+
+
+def plan_sync(
+    source_arns: typing.Iterable[str],
+    target_arns: typing.Dict[str, typing.Collection[str]],
+    state: SyncState,
+) -> typing.Dict[str, typing.List[str]]:
+    """Returns the source version ARNs (oldest first) that are not known to be
+    mirrored, for each region of target_arns (region -> existing versions)."""
+    ordered = sorted(source_arns, key=layer_version_number)
+    return {
+        region: [
+            source_arn
+            for source_arn in ordered
+            if state.target(source_arn, region) not in existing
+        ]
+        for region, existing in target_arns.items()
+    }
@@ -0,0 +1,282 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-phase timing instrumentation (--timings).
+
+Code wraps its phases (metadata query, download, extraction, publishing, ...)
+in phase(). While recording() is active, each phase is recorded with its
+duration, bytes processed, the peak RSS of the process at its end and how much
+the phase raised that peak. The operating system only keeps the peak of the
+whole process, so a phase that needs less memory than an earlier one raises
+it by 0.
+Embedding code can attach its own tracer with add_hook, e.g. to create a span
+per phase::
+
+    @contextlib.contextmanager
+    def span_hook(phase):
+        with tracer.start_as_current_span(phase.name, attributes=phase.labels) as span:
+            try:
+                yield
+            finally:
+                span.set_attribute("bytes", phase.nbytes or 0)
+
+    timings.add_hook(span_hook)
+
+Hooks run for every phase, also without --timings.
+"""
+
+import contextlib
+import json
+import sys
+import threading
+import time
+import typing
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+TIMINGS_FORMATS = ("json", "openmetrics")
+METRIC_PREFIX = "dt_awslayertool_phase_"
+STATS_METRIC_PREFIX = "dt_awslayertool_"
+
+
+def peak_rss() -> typing.Optional[int]:
+    """Returns the peak resident set size of the process so far, in bytes."""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class Phase:
+    """A running or finished phase. nbytes may be set while it runs."""
+
+    def __init__(self, name: str, labels: typing.Dict[str, str], nbytes=None):
+        self.name = name
+        self.labels = labels
+        self.nbytes = nbytes  # type: typing.Optional[int]
+        self.start = time.monotonic()
+        self.seconds = None  # type: typing.Optional[float]
+        # Of the whole process so far, at the end of the phase
+        self.process_peak_rss = None  # type: typing.Optional[int]
+        # Increase of the process peak RSS while the phase ran
+        self.peak_rss_increase = None  # type: typing.Optional[int]
+        self.error = None  # type: typing.Optional[str]
+
+    @property
+    def throughput(self) -> typing.Optional[float]:
+        """Bytes per second, None if unknown."""
+        if self.nbytes is None or not self.seconds:
+            return None
+        return self.nbytes / self.seconds
+
+
+# A hook is called with the phase when it starts and returns a context manager
+# that is exited once the phase finished (with seconds, nbytes, etc. set).
+PhaseHook = typing.Callable[[Phase], typing.ContextManager]
+
+_hooks = []  # type: typing.List[PhaseHook]
+_recorder = None  # type: typing.Optional[Recorder]
+
+
+def add_hook(hook: PhaseHook):
+    _hooks.append(hook)
+
+
+def remove_hook(hook: PhaseHook):
+    _hooks.remove(hook)
+
+
+class Recorder:
+    """Collects the finished phases of all threads."""
+
+    def __init__(self, labels: typing.Optional[typing.Dict[str, str]] = None):
+        self.labels = labels or {}
+        self.origin = time.monotonic()
+        self.phases = []  # type: typing.List[Phase]
+        # group -> name -> value, for counters of the whole run
+        self.stats = {}  # type: typing.Dict[str, typing.Dict[str, typing.Any]]
+        self._lock = threading.Lock()
+
+    def add(self, phase: Phase):
+        with self._lock:
+            self.phases.append(phase)
+
+    def add_stats(self, group: str, values: typing.Dict[str, typing.Any]):
+        """Adds counters that are not tied to a phase, e.g. of connections."""
+        with self._lock:
+            self.stats[group] = dict(values)
+
+    def to_json(self) -> dict:
+        with self._lock:
+            phases = sorted(self.phases, key=lambda phase: phase.start)
+        return dict(
+            labels=self.labels,
+            stats=self.stats,
+            phases=[
+                dict(
+                    name=phase.name,
+                    labels=phase.labels,
+                    start=round(phase.start - self.origin, 6),
+                    seconds=round(phase.seconds, 6),
+                    bytes=phase.nbytes,
+                    throughput=phase.throughput,
+                    process_peak_rss=phase.process_peak_rss,
+                    peak_rss_increase=phase.peak_rss_increase,
+                    error=phase.error,
+                )
+                for phase in phases
+            ],
+        )
+
+    def to_openmetrics(self) -> str:
+        """Returns the phases in the OpenMetrics text format.
+
+        Phases with the same name and labels (e.g. of parallel batch items)
+        are summed up, for the peak RSS values the maximum counts.
+        """
+        aggregated = {}  # type: typing.Dict[tuple, typing.List]
+        with self._lock:
+            phases = list(self.phases)
+        for phase in phases:
+            labels = dict(self.labels, phase=phase.name, **phase.labels)
+            key = tuple(sorted(labels.items()))
+            # count, seconds, bytes, process peak RSS, peak RSS increase
+            values = aggregated.setdefault(key, [0, 0.0, None, None, None])
+            values[0] += 1
+            values[1] += phase.seconds
+            if phase.nbytes is not None:
+                values[2] = (values[2] or 0) + phase.nbytes
+            if phase.process_peak_rss is not None:
+                values[3] = max(values[3] or 0, phase.process_peak_rss)
+            if phase.peak_rss_increase is not None:
+                values[4] = max(values[4] or 0, phase.peak_rss_increase)
+
+        metrics = (
+            ("count", None, "Number of times the phase ran", lambda v: v[0]),
+            ("seconds", "seconds", "Total duration of the phase", lambda v: v[1]),
+            ("bytes", "bytes", "Bytes processed in the phase", lambda v: v[2]),
+            (
+                "throughput_bytes_per_second",
+                None,
+                "Bytes processed per second",
+                lambda v: v[2] / v[1] if v[2] is not None and v[1] else None,
+            ),
+            (
+                "process_peak_rss_bytes",
+                "bytes",
+                "Peak resident set size of the process at the end of the phase",
+                lambda v: v[3],
+            ),
+            (
+                "peak_rss_increase_bytes",
+                "bytes",
+                "Increase of the process peak resident set size during the phase",
+                lambda v: v[4],
+            ),
+        )
+        lines = []
+        for suffix, unit, help_text, getter in metrics:
+            name = METRIC_PREFIX + suffix
+            lines.append("# TYPE {} gauge".format(name))
+            if unit:
+                lines.append("# UNIT {} {}".format(name, unit))
+            lines.append("# HELP {} {}".format(name, help_text))
+            for key, values in aggregated.items():
+                value = getter(values)
+                if value is not None:
+                    lines.append(
+                        "{}{{{}}} {}".format(
+                            name,
+                            ",".join(
+                                '{}="{}"'.format(label, _escape(labelvalue))
+                                for label, labelvalue in key
+                            ),
+                            value,
+                        )
+                    )
+        labels = ",".join(
+            '{}="{}"'.format(label, _escape(value))
+            for label, value in sorted(self.labels.items())
+        )
+        for group, values in self.stats.items():
+            for key, value in values.items():
+                if value is None:
+                    continue
+                name = "{}{}_{}".format(STATS_METRIC_PREFIX, group, key)
+                lines.append("# TYPE {} gauge".format(name))
+                lines.append("{}{{{}}} {}".format(name, labels, value))
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename: str, fmt: str = "json"):
+        with open(filename, "w", encoding="utf-8") as outfile:
+            if fmt == "openmetrics":
+                outfile.write(self.to_openmetrics())
+            else:
+                json.dump(self.to_json(), outfile, indent=2)
+                outfile.write("\n")
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+@contextlib.contextmanager
+def recording(
+    labels: typing.Optional[typing.Dict[str, str]] = None,
+) -> typing.Iterator[Recorder]:
+    """Records all phases (of all threads) while active."""
+    global _recorder  # pylint:disable=global-statement
+    previous = _recorder
+    _recorder = Recorder(labels)
+    try:
+        yield _recorder
+    finally:
+        _recorder = previous
+
+
+@contextlib.contextmanager
+def phase(
+    name: str, nbytes: typing.Optional[int] = None, **labels: str
+) -> typing.Iterator[Phase]:
+    """Times the enclosed code as phase name.
+
+    The yielded Phase can be used to set nbytes once it is known.
+    """
+    recorder = _recorder
+    current = Phase(name, labels, nbytes)
+    if recorder is None and not _hooks:
+        yield current
+        return
+    with contextlib.ExitStack() as stack:
+        for hook in list(_hooks):
+            stack.enter_context(hook(current))
+        startpeak = peak_rss()
+        current.start = time.monotonic()
+        try:
+            yield current
+        except BaseException as exc:
+            current.error = type(exc).__name__
+            raise
+        finally:
+            current.seconds = time.monotonic() - current.start
+            current.process_peak_rss = peak_rss()
+            if current.process_peak_rss is not None and startpeak is not None:
+                current.peak_rss_increase = current.process_peak_rss - startpeak
+            if recorder is not None:
+                recorder.add(current)
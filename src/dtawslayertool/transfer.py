@@ -0,0 +1,477 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Download of layer contents with verification while the bytes arrive."""
+
+import hashlib
+import itertools
+import json
+import logging
+import os
+import threading
+import typing
+from base64 import b64encode
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from os import path
+from typing import NamedTuple
+from urllib.error import HTTPError
+
+from dtawslayertool.httppool import DEFAULT_POOL, HttpPool, Timeouts
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_BUFSIZE = 256 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_CONCURRENCY = 8
+
+PART_SUFFIX = ".part"
+SIDECAR_SUFFIX = ".json"
+
+ReportHook = typing.Callable[[int, int, int], None]
+
+
+class TransferError(Exception):
+    pass
+
+
+class VerificationError(TransferError):
+    pass
+
+
+class TransferCancelled(Exception):
+    """Raised by a reporthook to abort the download. Unlike after other errors,
+    the partial download is removed instead of kept for resuming."""
+
+
+def verify_size(codesize: int, actualsize: int):
+    if actualsize != codesize:
+        raise VerificationError(
+            "Downloaded file corrupted -- expected {} bytes, but have {}".format(
+                codesize, actualsize
+            )
+        )
+
+
+def verify_hash(codesha256: str, hasher: "hashlib._Hash"):
+    # AWS reports the hash as Base64 instead of the usual hex
+    actualhash = b64encode(hasher.digest()).decode("ascii")
+    if actualhash != codesha256:
+        raise VerificationError(
+            "Downloaded file corrupted -- expected SHA256 {}, but have {}".format(
+                codesha256, actualhash
+            )
+        )
+
+
+class TransferConfig(NamedTuple):
+    part_size: int = DEFAULT_PART_SIZE
+    concurrency: int = DEFAULT_CONCURRENCY
+    # Read buffer of single stream downloads
+    bufsize: int = DEFAULT_BUFSIZE
+    timeouts: Timeouts = Timeouts()
+
+
+def download_verified(
+    url: str,
+    filename: str,
+    codesize: int,
+    codesha256: str,
+    reporthook: typing.Optional[ReportHook] = None,
+    config: TransferConfig = TransferConfig(),
+    refresh_url: typing.Optional[typing.Callable[[], str]] = None,
+):
+    """Downloads url to filename, hashing and counting the bytes as they arrive.
+
+    The content is written to filename + PART_SUFFIX and only renamed to
+    filename once verified. Content larger than config.part_size is fetched as
+    byte ranges by config.concurrency threads, unless the server ignores the
+    Range header. Completed ranges are recorded in a sidecar file, so that a
+    download that failed for any other reason than a verification error
+    resumes with the missing ranges on the next call.
+
+    If the server responds with 403 (e.g. because the presigned URL expired),
+    refresh_url is called to get a new URL.
+
+    Raises VerificationError as soon as the content is known not to match
+    codesize/codesha256, and removes the partial file in that case (as well
+    as if the reporthook raises TransferCancelled).
+    reporthook has the same signature as the one for urlretrieve. Returns the
+    HTTP response headers (of the first request).
+    """
+    partfilename = filename + PART_SUFFIX
+    urlsource = UrlSource(url, refresh_url, config.timeouts)
+    state = _PartState(
+        partfilename + SIDECAR_SUFFIX, codesize, codesha256, config.part_size
+    )
+    try:
+        try:
+            if codesize <= config.part_size:
+                raise _RangesNotUsed()
+            headers = _download_ranges(
+                urlsource, partfilename, state, codesha256, reporthook, config
+            )
+        except _RangesNotUsed as exc:
+            state.discard()
+            with exc.response or urlsource.open() as response:
+                headers = _download_stream(
+                    response, partfilename, codesize, codesha256, reporthook, config
+                )
+    except BaseException as exc:
+        if state.parts and not isinstance(exc, (VerificationError, TransferCancelled)):
+            LOGGER.warning(
+                "Keeping partial download %s for resuming, rerun to continue",
+                partfilename,
+            )
+        else:
+            LOGGER.debug("Removing partial download %s", partfilename)
+            state.discard()
+            _remove_if_exists(partfilename)
+        raise
+    os.replace(partfilename, filename)
+    state.discard()
+    return headers
+
+
+def _remove_if_exists(filename: str):
+    try:
+        os.remove(filename)
+    except FileNotFoundError:
+        pass
+
+
+class _RangesNotUsed(Exception):
+    """Signals that the content needs to be downloaded as a single stream."""
+
+    def __init__(self, response=None):
+        super().__init__()
+        self.response = response
+
+
+class UrlSource:
+    """The content URL, which is refreshed when the server denies access.
+
+    Requests use kept-alive connections of pool.
+    """
+
+    MAX_REFRESHES = 3
+
+    def __init__(
+        self,
+        url: str,
+        refresh: typing.Optional[typing.Callable[[], str]],
+        timeouts: Timeouts = Timeouts(),
+        pool: HttpPool = DEFAULT_POOL,
+    ):
+        self.url = url
+        self.timeouts = timeouts
+        self.pool = pool
+        self._refresh = refresh
+        self._refreshcount = 0
+        self._lock = threading.Lock()
+
+    def open(self, rangeheader: typing.Optional[str] = None):
+        url = self.url
+        while True:
+            headers = {"Range": rangeheader} if rangeheader else {}
+            try:
+                return self.pool.open(url, headers, self.timeouts)
+            except HTTPError as exc:
+                if exc.code != 403 or not self._refresh:
+                    raise
+                exc.close()
+                url = self._refreshed(url)
+
+    def _refreshed(self, staleurl: str) -> str:
+        with self._lock:
+            # Other threads might have hit the 403 at the same time.
+            if self.url == staleurl:
+                if self._refreshcount >= self.MAX_REFRESHES:
+                    raise TransferError(
+                        "Access to layer content still denied after {}"
+                        " URL refreshes".format(self._refreshcount)
+                    )
+                self._refreshcount += 1
+                LOGGER.info("Access denied, refreshing content URL")
+                self.url = self._refresh()
+            return self.url
+
+
+class _PartState:
+    """Sidecar file that records the completely written ranges of a .part file.
+
+    Each range is stored with its own SHA-256, so that a resumed download can
+    detect parts that did not make it to the disk intact.
+    """
+
+    def __init__(self, filename: str, codesize: int, codesha256: str, part_size: int):
+        self.filename = filename
+        self.key = dict(CodeSha256=codesha256, CodeSize=codesize, PartSize=part_size)
+        self.parts = {}  # type: typing.Dict[int, str]
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.filename, encoding="utf-8") as infile:
+                saved = json.load(infile)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            LOGGER.warning("Ignoring unreadable download state %s", self.filename)
+            return
+        if saved.get("Key") != self.key:
+            LOGGER.info("Download state %s is for other content", self.filename)
+            return
+        self.parts = {int(offset): digest for offset, digest in saved["Parts"].items()}
+
+    def add(self, offset: int, digest: str):
+        with self._lock:
+            self.parts[offset] = digest
+            tmpfilename = self.filename + ".tmp"
+            with open(tmpfilename, "w", encoding="utf-8") as outfile:
+                json.dump(dict(Key=self.key, Parts=self.parts), outfile)
+            os.replace(tmpfilename, self.filename)
+
+    def discard(self):
+        self.parts = {}
+        _remove_if_exists(self.filename)
+
+
+def _range_header(start: int, length: int) -> str:
+    return "bytes={}-{}".format(start, start + length - 1)
+
+
+def _content_range_total(headers) -> int:
+    # Content-Range: bytes <start>-<end>/<total>
+    contentrange = headers.get("Content-Range", "")
+    try:
+        return int(contentrange.rsplit("/", 1)[1])
+    except (IndexError, ValueError):
+        raise TransferError("Bad Content-Range: " + contentrange) from None
+
+
+def _download_stream(
+    response,
+    filename: str,
+    codesize: int,
+    codesha256: str,
+    reporthook: typing.Optional[ReportHook],
+    config: TransferConfig,
+):
+    hasher = hashlib.sha256()
+    nbytes = 0
+    with open(filename, "wb") as outfile:
+        contentlength = response.headers.get("Content-Length")
+        if contentlength is not None:
+            verify_size(codesize, int(contentlength))
+        if reporthook:
+            reporthook(0, config.bufsize, codesize)
+        buffer = memoryview(bytearray(config.bufsize))
+        blockcount = 0
+        while True:
+            nread = response.readinto(buffer)
+            if not nread:
+                break
+            nbytes += nread
+            if nbytes > codesize:
+                verify_size(codesize, nbytes)
+            chunk = buffer[:nread]
+            hasher.update(chunk)
+            outfile.write(chunk)
+            blockcount += 1
+            if reporthook:
+                reporthook(blockcount, config.bufsize, codesize)
+    verify_size(codesize, nbytes)
+    verify_hash(codesha256, hasher)
+    return response.headers
+
+
+def _preallocate(fileno: int, size: int):
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fileno, 0, size)
+            return
+        except OSError:  # E.g. not supported by the file system
+            pass
+    os.ftruncate(fileno, size)
+
+
+class _PartFile:
+    """Reads and writes parts at their offset in a single file from multiple threads."""
+
+    def __init__(self, fileno: int):
+        self.fileno = fileno
+        self._lock = None if hasattr(os, "pwrite") else threading.Lock()
+
+    def write(self, data: memoryview, offset: int):
+        if self._lock:  # No pwrite on Windows
+            with self._lock:
+                os.lseek(self.fileno, offset, os.SEEK_SET)
+                while data:
+                    data = data[os.write(self.fileno, data) :]
+            return
+        while data:
+            nwritten = os.pwrite(self.fileno, data, offset)
+            data = data[nwritten:]
+            offset += nwritten
+
+    def read(self, offset: int, length: int) -> bytes:
+        if self._lock:
+            with self._lock:
+                os.lseek(self.fileno, offset, os.SEEK_SET)
+                return os.read(self.fileno, length)
+        return os.pread(self.fileno, length, offset)
+
+
+class _RangedDownload:
+    def __init__(
+        self,
+        urlsource: UrlSource,
+        partfile: _PartFile,
+        state: _PartState,
+        codesize: int,
+    ):
+        self.urlsource = urlsource
+        self.partfile = partfile
+        self.state = state
+        self.codesize = codesize
+        self.part_size = state.key["PartSize"]
+
+    def length_at(self, offset: int) -> int:
+        return min(self.part_size, self.codesize - offset)
+
+    def fetch(self, offset: int, response=None) -> memoryview:
+        """Fetches a range (if no response is given) and writes it in place.
+        The response is closed, also if it was given.
+
+        Returns the part's content for hashing in order.
+        """
+        length = self.length_at(offset)
+        if response is None:
+            response = self.urlsource.open(_range_header(offset, length))
+        with response:
+            contentrange = response.headers.get("Content-Range", "")
+            if response.status != 206 or not contentrange.startswith(
+                "bytes {}-".format(offset)
+            ):
+                raise TransferError(
+                    "Expected partial content for range at {}, got HTTP {} {}".format(
+                        offset, response.status, contentrange
+                    )
+                )
+            buffer = memoryview(bytearray(length))
+            nbytes = 0
+            while nbytes < length:
+                nread = response.readinto(buffer[nbytes:])
+                if not nread:
+                    raise TransferError(
+                        "Range at {} ended after {} of {} bytes".format(
+                            offset, nbytes, length
+                        )
+                    )
+                nbytes += nread
+        self.partfile.write(buffer, offset)
+        self.state.add(offset, hashlib.sha256(buffer).hexdigest())
+        return buffer
+
+    def reread(self, offset: int) -> bytes:
+        """Returns a part written by a previous attempt, fetching it if damaged."""
+        data = self.partfile.read(offset, self.length_at(offset))
+        if hashlib.sha256(data).hexdigest() == self.state.parts[offset]:
+            return data
+        LOGGER.info("Part at %d of previous download is damaged, refetching", offset)
+        return self.fetch(offset)
+
+
+def _download_ranges(
+    urlsource: UrlSource,
+    filename: str,
+    state: _PartState,
+    codesha256: str,
+    reporthook: typing.Optional[ReportHook],
+    config: TransferConfig,
+):
+    # SHA-256 cannot be computed out of order, so finished parts are hashed in
+    # order of their offset. Parts are only requested while at most
+    # config.concurrency of them are pending, which bounds the memory needed
+    # for parts that wait to be hashed.
+    codesize = state.key["CodeSize"]
+    offsets = range(0, codesize, config.part_size)
+    if path.exists(filename):
+        state.load()
+    else:
+        state.discard()
+    if state.parts:
+        LOGGER.info(
+            "Resuming download with %d of %d parts done", len(state.parts), len(offsets)
+        )
+
+    # The first missing range doubles as probe for Range support.
+    firstresponse = None
+    headers = None
+    missing = [offset for offset in offsets if offset not in state.parts]
+    if missing:
+        firstresponse = urlsource.open(
+            _range_header(missing[0], min(config.part_size, codesize - missing[0]))
+        )
+        if firstresponse.status != 206:
+            LOGGER.debug("Server ignored Range header, using single stream")
+            raise _RangesNotUsed(firstresponse)
+        headers = firstresponse.headers
+        try:
+            verify_size(codesize, _content_range_total(headers))
+        except BaseException:
+            firstresponse.close()
+            raise
+
+    hasher = hashlib.sha256()
+    with open(filename, "r+b" if state.parts else "w+b") as outfile, ThreadPoolExecutor(
+        config.concurrency, thread_name_prefix="download"
+    ) as executor:
+        _preallocate(outfile.fileno(), codesize)
+        download = _RangedDownload(
+            urlsource, _PartFile(outfile.fileno()), state, codesize
+        )
+
+        def submit(offset: int) -> Future:
+            nonlocal firstresponse
+            if offset in state.parts:
+                return executor.submit(download.reread, offset)
+            response, firstresponse = firstresponse, None
+            return executor.submit(download.fetch, offset, response)
+
+        if reporthook:
+            reporthook(0, config.part_size, codesize)
+        pending = deque()  # type: typing.Deque[Future]
+        nextoffsets = iter(offsets)
+        try:
+            for blockcount in range(1, len(offsets) + 1):
+                for offset in itertools.islice(
+                    nextoffsets, config.concurrency - len(pending)
+                ):
+                    pending.append(submit(offset))
+                hasher.update(pending.popleft().result())
+                if reporthook:
+                    reporthook(blockcount, config.part_size, codesize)
+        finally:
+            for future in pending:
+                future.cancel()
+            if firstresponse:
+                firstresponse.close()
+    try:
+        verify_hash(codesha256, hasher)
+    except VerificationError:
+        state.discard()
+        raise
+    return headers
@@ -0,0 +1,272 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Verification of local layer zips and extracted folders.
+
+A zip file matches the layer if it has the layer's CodeSha256. An extracted
+folder is compared file by file with the size and CRC32 of the zip entries,
+which the central directory of the layer holds, so the layer itself is not
+downloaded. Files are hashed in parallel (hashlib and zlib release the GIL).
+
+The hashes are recorded in a sidecar index next to the verified zip file or
+folder. A file whose path, size, mtime and inode did not change since it was
+hashed is not read again.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from stat import S_ISREG
+from typing import NamedTuple
+from zipfile import ZipInfo
+
+from dtawslayertool.cache import code_sha256
+from dtawslayertool.extract import file_crc32, safe_relpath, scan_tree
+from dtawslayertool.remotezip import is_selected, select_entries
+
+LOGGER = logging.getLogger(__name__)
+
+INDEX_SUFFIX = ".hashes.json"
+DEFAULT_HASH_CONCURRENCY = 8
+# A file can change again within the mtime granularity of the file system
+# after it was hashed, without a visible change of its mtime. Hashes of files
+# modified this shortly before are not recorded.
+RACY_SECONDS = 2.0
+
+
+def default_index_file(target: str) -> str:
+    """Returns the sidecar index of the zip file or folder target."""
+    return path.normpath(path.abspath(target)) + INDEX_SUFFIX
+
+
+def crc32_hex(filename: str) -> str:
+    return "{:08x}".format(file_crc32(filename))
+
+
+def entry_crc32_hex(info: ZipInfo) -> str:
+    return "{:08x}".format(info.CRC)
+
+
+class HashIndex:
+    """Sidecar file with the hashes of files, keyed by (path, size, mtime, inode).
+
+    With filename None, nothing is loaded or saved. Only the entries used
+    since loading are saved, so the index does not keep removed files.
+    """
+
+    def __init__(self, filename: typing.Optional[str], algorithm: str):
+        self.filename = filename
+        self.algorithm = algorithm
+        # path -> [size, mtime in ns, inode, hash]
+        self.entries = {}  # type: typing.Dict[str, list]
+        self.hits = 0
+        self.misses = 0
+        self.hashed_bytes = 0
+        self._used = {}  # type: typing.Dict[str, list]
+        self._lock = threading.Lock()
+
+    def load(self):
+        if not self.filename:
+            return
+        try:
+            with open(self.filename, encoding="utf-8") as infile:
+                saved = json.load(infile)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            LOGGER.warning("Ignoring unreadable hash index %s", self.filename)
+            return
+        if saved.get("Algorithm") != self.algorithm:
+            LOGGER.info("Hash index %s is for other hashes", self.filename)
+            return
+        self.entries = saved["Files"]
+
+    def lookup(self, name: str, stat: os.stat_result) -> typing.Optional[str]:
+        key = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        with self._lock:
+            entry = self.entries.get(name)
+            if entry and entry[:3] == key:
+                self._used[name] = entry
+                self.hits += 1
+                return entry[3]
+            self.misses += 1
+        return None
+
+    def add(self, name: str, stat: os.stat_result, digest: str, hashed_at: float):
+        with self._lock:
+            self.hashed_bytes += stat.st_size
+            if stat.st_mtime < hashed_at - RACY_SECONDS:
+                self._used[name] = [stat.st_size, stat.st_mtime_ns, stat.st_ino, digest]
+
+    def save(self):
+        """Writes the used entries. Failing to do so is only logged, the index
+        is an optimization."""
+        if not self.filename:
+            return
+        tmpfilename = self.filename + ".tmp"
+        try:
+            with open(tmpfilename, "w", encoding="utf-8") as outfile:
+                json.dump(dict(Algorithm=self.algorithm, Files=self._used), outfile)
+            os.replace(tmpfilename, self.filename)
+        except OSError as exc:
+            LOGGER.warning("Cannot write hash index %s: %s", self.filename, exc)
+
+    def hash_files(
+        self,
+        files: typing.List[typing.Tuple[str, str, os.stat_result]],
+        hashfunc: typing.Callable[[str], str],
+        concurrency: int = DEFAULT_HASH_CONCURRENCY,
+    ) -> typing.List[str]:
+        """Returns the hashes of the (name, file name, stat) files, taken from
+        the index where possible."""
+
+        def digest(item: typing.Tuple[str, str, os.stat_result]) -> str:
+            name, filename, stat = item
+            result = self.lookup(name, stat)
+            if result is None:
+                hashed_at = time.time()
+                result = hashfunc(filename)
+                self.add(name, stat, result, hashed_at)
+            return result
+
+        if concurrency <= 1 or len(files) <= 1:
+            return [digest(item) for item in files]
+        with ThreadPoolExecutor(concurrency, thread_name_prefix="verify") as pool:
+            return list(pool.map(digest, files))
+
+
+class VerifyResult(NamedTuple):
+    target: str
+    # Only for zip files
+    sha256_match: typing.Optional[bool]
+    # Relative paths (of zip entries for a zip file)
+    missing: typing.List[str]
+    changed: typing.List[str]
+    extra: typing.List[str]
+    verified: int  # Files (or entries) that match
+    hashed: int  # The other hashes were taken from the index
+
+    @property
+    def ok(self) -> bool:
+        return self.sha256_match is not False and not (
+            self.missing or self.changed or self.extra
+        )
+
+    def __str__(self):
+        return "{} verified, {} changed, {} missing, {} extra ({} hashed)".format(
+            self.verified,
+            len(self.changed),
+            len(self.missing),
+            len(self.extra),
+            self.hashed,
+        )
+
+
+def compare_entries(
+    expected: typing.Iterable[ZipInfo], actual: typing.Iterable[ZipInfo]
+) -> typing.Tuple[typing.List[str], typing.List[str], typing.List[str], int]:
+    """Compares the file entries of two zip files by size and CRC32.
+
+    Returns (missing, changed, extra, number of matching entries).
+    """
+    expected_files = {info.filename: info for info in expected if not info.is_dir()}
+    actual_files = {info.filename: info for info in actual if not info.is_dir()}
+    changed = [
+        name
+        for name in sorted(expected_files.keys() & actual_files.keys())
+        if (expected_files[name].CRC, expected_files[name].file_size)
+        != (actual_files[name].CRC, actual_files[name].file_size)
+    ]
+    return (
+        sorted(expected_files.keys() - actual_files.keys()),
+        changed,
+        sorted(actual_files.keys() - expected_files.keys()),
+        len(expected_files.keys() & actual_files.keys()) - len(changed),
+    )
+
+
+def zip_matches(
+    filename: str, codesha256: str, codesize: int, index: HashIndex
+) -> bool:
+    """Checks the zip file's size and SHA-256."""
+    stat = os.stat(filename)
+    if stat.st_size != codesize:
+        return False
+    (digest,) = index.hash_files(
+        [(path.basename(filename), filename, stat)], code_sha256
+    )
+    index.save()
+    return digest == codesha256
+
+
+def verify_tree(
+    target_dir: str,
+    entries: typing.Iterable[ZipInfo],
+    index: HashIndex,
+    concurrency: int = DEFAULT_HASH_CONCURRENCY,
+    include: typing.Optional[typing.Sequence[str]] = None,
+    exclude: typing.Optional[typing.Sequence[str]] = None,
+) -> VerifyResult:
+    """Checks that target_dir holds exactly the files of the zip entries, with
+    the same size and CRC32. Permissions and mtimes are not compared.
+
+    With include/exclude (see select_entries), only the selected entries and
+    files are compared; other files in target_dir are not extra.
+    """
+    expected = {
+        safe_relpath(info.filename): info
+        for info in select_entries(entries, include, exclude)
+        if not info.is_dir()
+    }
+    files, _dirs = scan_tree(target_dir)
+    present = {path.relpath(name, target_dir) for name in files}
+    present = {
+        relpath
+        for relpath in present
+        if is_selected(relpath.replace(os.sep, "/"), include, exclude)
+    }
+    if index.filename:
+        present.discard(path.relpath(index.filename, target_dir))
+
+    changed = []
+    tohash = []  # type: typing.List[typing.Tuple[str, str, os.stat_result]]
+    for relpath in sorted(expected.keys() & present):
+        filename = path.join(target_dir, relpath)
+        stat = os.lstat(filename)
+        if not S_ISREG(stat.st_mode) or stat.st_size != expected[relpath].file_size:
+            changed.append(relpath)
+        else:
+            tohash.append((relpath, filename, stat))
+    digests = index.hash_files(tohash, crc32_hex, concurrency)
+    verified = 0
+    for (relpath, _filename, _stat), digest in zip(tohash, digests):
+        if digest == entry_crc32_hex(expected[relpath]):
+            verified += 1
+        else:
+            changed.append(relpath)
+    index.save()
+    return VerifyResult(
+        target_dir,
+        None,
+        missing=sorted(expected.keys() - present),
+        changed=sorted(changed),
+        extra=sorted(present - expected.keys()),
+        verified=verified,
+        hashed=index.misses,
+    )
@@ -0,0 +1,153 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import socketserver
+import sys
+import threading
+import typing
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer is not available before Python 3.7
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients close connections with unread responses on purpose
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class LayerServer:
+    """Local stand-in for the S3 endpoint that serves layer contents."""
+
+    def __init__(self):
+        self.files = {}  # type: typing.Dict[str, bytes]
+        self.requests = []  # type: typing.List[typing.Tuple[str, str, str]]
+        self.support_ranges = True
+        self.forbidden = set()  # type: typing.Set[str]
+        # Range header value -> HTTP status to fail requests with
+        self.range_errors = {}  # type: typing.Dict[str, int]
+        # Close connections after each response without announcing it, like
+        # servers do with kept-alive connections that are idle for too long
+        self.drop_connections = False
+        # Client (address, port) of each accepted connection
+        self.connections = set()  # type: typing.Set[typing.Tuple[str, int]]
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), _LayerRequestHandler)
+        self._server.layerserver = self
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, kwargs=dict(poll_interval=0.05)
+        )
+
+    @property
+    def base_url(self) -> str:
+        return "http://{}:{}".format(*self._server.server_address)
+
+    def add(self, urlpath: str, content: bytes) -> str:
+        """Serves content at urlpath and returns its full URL."""
+        self.files[urlpath] = content
+        return self.base_url + urlpath
+
+    def get_requests(self, urlpath: str) -> typing.List[typing.Tuple[str, str]]:
+        """Returns (method, range header) for all requests to urlpath."""
+        return [(req[0], req[2]) for req in self.requests if req[1] == urlpath]
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+class _LayerRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):  # pylint:disable=redefined-builtin
+        pass
+
+    def do_HEAD(self):  # pylint:disable=invalid-name
+        self._respond(send_body=False)
+
+    def do_GET(self):  # pylint:disable=invalid-name
+        self._respond(send_body=True)
+
+    def _respond(self, send_body: bool):
+        layerserver = self.server.layerserver  # type: LayerServer
+        urlpath = self.path.split("?", 1)[0]
+        rangeheader = self.headers.get("Range")
+        layerserver.requests.append((self.command, urlpath, rangeheader))
+        layerserver.connections.add(self.client_address)
+        if layerserver.drop_connections:
+            self.close_connection = True
+        content = layerserver.files.get(urlpath)
+        if urlpath in layerserver.forbidden:
+            self._send_empty(403)
+            return
+        if content is None:
+            self._send_empty(404)
+            return
+        if rangeheader in layerserver.range_errors:
+            self._send_empty(layerserver.range_errors[rangeheader])
+            return
+
+        status = 200
+        body = content
+        headers = {"Content-Type": "application/zip"}
+        if layerserver.support_ranges:
+            headers["Accept-Ranges"] = "bytes"
+            match = re.fullmatch(r"bytes=(\d*)-(\d*)", rangeheader or "")
+            if match:
+                start, end = match.groups()
+                if not start:
+                    start, end = max(0, len(content) - int(end)), len(content) - 1
+                else:
+                    start = int(start)
+                    end = min(int(end), len(content) - 1) if end else len(content) - 1
+                if start >= len(content):
+                    headers["Content-Range"] = "bytes */{}".format(len(content))
+                    self._send_empty(416, headers)
+                    return
+                status = 206
+                body = content[start : end + 1]
+                headers["Content-Range"] = "bytes {}-{}/{}".format(
+                    start, end, len(content)
+                )
+
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _send_empty(self, status: int, headers: typing.Optional[dict] = None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+@pytest.fixture
+def layer_server() -> typing.Iterable[LayerServer]:
+    server = LayerServer()
+    server.start()
+    yield server
+    server.stop()
@@ -0,0 +1,64 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from dtawslayertool.batch import ManifestError, guess_format, parse_manifest
+
+ARN = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+
+
+def test_lines():
+    manifest = """
+# comment
+{arn}
+clone {arn} -t eu-central-1 -t eu-west-1
+info {arn}
+""".format(arn=ARN)
+    assert parse_manifest(manifest, "lines", "pull") == [
+        ["pull", ARN],
+        ["clone", ARN, "-t", "eu-central-1", "-t", "eu-west-1"],
+        ["info", ARN],
+    ]
+
+
+def test_json():
+    manifest = """{{"items": [
+        "{arn}",
+        {{"arn": "{arn}", "action": "pull", "extract": "dir", "overwrite": true}},
+        {{"arn": "{arn}", "action": "clone", "target_region": ["a", "b"]}}
+    ]}}""".format(arn=ARN)
+    assert parse_manifest(manifest, "json", "info") == [
+        ["info", ARN],
+        ["pull", "--extract=dir", "--overwrite", ARN],
+        ["clone", "--target-region=a", "--target-region=b", ARN],
+    ]
+
+
+def test_yaml():
+    yaml = pytest.importorskip("yaml")
+    manifest = yaml.safe_dump([{"arn": ARN, "action": "clone", "overwrite": False}])
+    assert parse_manifest(manifest, "yaml", "pull") == [["clone", ARN]]
+
+
+def test_missing_arn():
+    with pytest.raises(ManifestError, match="needs an ARN"):
+        parse_manifest('[{"action": "pull"}]', "json", "pull")
+
+
+def test_guess_format():
+    assert guess_format("layers.json") == "json"
+    assert guess_format("layers.YML") == "yaml"
+    assert guess_format("layers.txt") == "lines"
+    assert guess_format("-") == "lines"
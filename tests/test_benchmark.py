@@ -0,0 +1,57 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+BENCHMARK_SCRIPT = Path(__file__).parent.parent / "scripts" / "benchmark.py"
+
+
+def run_benchmark(*args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, str(BENCHMARK_SCRIPT), "--layer", "tiny:256K:50"]
+        + ["--repeat", "1", "--command", "info", "--command", "pull-x"]
+        + list(args),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=False,
+    )
+
+
+@pytest.mark.skipif(not hasattr(os, "wait4"), reason="needs os.wait4")
+def test_baseline_and_regression(tmp_path: Path):
+    baselinefile = tmp_path / "baseline.json"
+    proc = run_benchmark(
+        "--workdir", str(tmp_path), "--save-baseline", str(baselinefile)
+    )
+    assert proc.returncode == 0, proc.stderr
+    assert "tiny/pull-x" in proc.stdout
+    baseline = json.loads(baselinefile.read_text("utf-8"))
+    assert set(baseline["results"]) == {"tiny/info", "tiny/pull-x"}
+    assert baseline["results"]["tiny/info"]["throughput"] is None
+    assert baseline["results"]["tiny/pull-x"]["peak_rss"] > 0
+
+    for result in baseline["results"].values():
+        result["seconds"] /= 10
+    baselinefile.write_text(json.dumps(baseline), "utf-8")
+    proc = run_benchmark("--workdir", str(tmp_path), "--baseline", str(baselinefile))
+    assert proc.returncode == 1
+    assert "SLOWER" in proc.stdout
+    assert "regressions in: tiny/info, tiny/pull-x" in proc.stderr
@@ -0,0 +1,147 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import stat
+import time
+from pathlib import Path
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+import pytest
+
+from dtawslayertool import build
+from dtawslayertool.build import build_zip, plan_build
+from dtawslayertool.cache import code_sha256
+from dtawslayertool.extract import extract_all, unix_mode
+
+
+def make_tree(root: Path):
+    (root / "nodejs" / "bin").mkdir(parents=True)
+    (root / "nodejs" / "bin" / "agent").write_bytes(b"#!/bin/sh\ntrue\n" * 100)
+    (root / "nodejs" / "bin" / "agent").chmod(0o755)
+    for i in range(50):
+        (root / "nodejs" / "f{}.js".format(i)).write_bytes(b"x" * i)
+    (root / "nodejs" / "private").mkdir(mode=0o700)
+    (root / "nodejs" / "private" / "config.json").write_bytes(b"{}")
+    (root / "nodejs" / "private" / "config.json").chmod(0o600)
+    (root / "café.txt").write_bytes(b"")
+
+
+def test_plan_build_order(tmp_path: Path):
+    make_tree(tmp_path)
+    names = [entry.info.filename for entry in plan_build(str(tmp_path))]
+    assert names == sorted(names)
+    assert names[:3] == ["café.txt", "nodejs/", "nodejs/bin/"]
+
+
+@pytest.mark.parametrize("concurrency", [1, 3])
+def test_build_zip(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, concurrency: int):
+    monkeypatch.setattr(build, "MAX_BATCH_ENTRIES", 8)
+    source = tmp_path / "source"
+    make_tree(source)
+    result = build_zip(str(source), str(tmp_path / "layer.zip"), concurrency)
+
+    assert result.code_sha256 == code_sha256(result.file)
+    assert result.code_size == os.path.getsize(result.file)
+    assert result.entries == 56
+    with ZipFile(result.file) as zipfile:
+        assert zipfile.testzip() is None
+        infos = {info.filename: info for info in zipfile.infolist()}
+        assert zipfile.read("nodejs/bin/agent") == b"#!/bin/sh\ntrue\n" * 100
+    assert infos["nodejs/bin/agent"].compress_type == ZIP_DEFLATED
+    assert infos["nodejs/f1.js"].compress_type == ZIP_STORED
+    assert {info.date_time for info in infos.values()} == {build.FIXED_DATE_TIME}
+    assert stat.S_IMODE(unix_mode(infos["nodejs/bin/agent"])) == 0o755
+    assert stat.S_IMODE(unix_mode(infos["nodejs/private/"])) == 0o700
+
+    # Extracting restores the permissions
+    target = tmp_path / "extracted"
+    extract_all(result.file, str(target))
+    assert stat.S_IMODE((target / "nodejs" / "bin" / "agent").stat().st_mode) == 0o755
+    config = target / "nodejs" / "private" / "config.json"
+    assert stat.S_IMODE(config.stat().st_mode) == 0o600
+    assert (target / "café.txt").is_file()
+
+
+def test_build_zip_deterministic(tmp_path: Path):
+    source = tmp_path / "source"
+    make_tree(source)
+    first = build_zip(str(source), str(tmp_path / "first.zip"), 1)
+
+    # Same content with other mtimes
+    for name in source.rglob("*"):
+        os.utime(str(name), (time.time() - 3600, time.time() - 3600))
+    second = build_zip(str(source), str(tmp_path / "second.zip"), 4)
+    assert second.code_sha256 == first.code_sha256
+    assert (tmp_path / "first.zip").read_bytes() == (
+        tmp_path / "second.zip"
+    ).read_bytes()
+
+    (source / "nodejs" / "f1.js").chmod(0o755)
+    third = build_zip(str(source), str(tmp_path / "third.zip"), 1)
+    assert third.code_sha256 != first.code_sha256
+
+
+@pytest.mark.parametrize("concurrency", [1, 2])
+def test_build_zip_large_files(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, concurrency: int
+):
+    source = tmp_path / "source"
+    make_tree(source)
+    (source / "big.bin").write_bytes(b"compressible" * 10000)
+    (source / "random.bin").write_bytes(os.urandom(50000))
+    in_memory = build_zip(str(source), str(tmp_path / "memory.zip"), concurrency)
+
+    # Compressed in chunks, to the same bytes
+    monkeypatch.setattr(build, "MAX_BATCH_SIZE", 20000)
+    monkeypatch.setattr(build, "CHUNK_SIZE", 4096)
+    chunked = build_zip(str(source), str(tmp_path / "chunked.zip"), concurrency)
+    assert chunked.code_sha256 == in_memory.code_sha256
+    with ZipFile(chunked.file) as zipfile:
+        assert zipfile.testzip() is None
+        assert zipfile.getinfo("big.bin").compress_type == ZIP_DEFLATED
+        assert zipfile.getinfo("random.bin").compress_type == ZIP_STORED
+
+
+def test_build_zip_into_source(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    make_tree(tmp_path)
+    monkeypatch.chdir(str(tmp_path))
+    first = build_zip(".", "..zip", 1)
+    # The previous zip file is not packed into the next one.
+    second = build_zip(".", "..zip", 1)
+    assert second.code_sha256 == first.code_sha256
+    with ZipFile(second.file) as zipfile:
+        assert "..zip" not in zipfile.namelist()
+
+
+def test_build_zip_symlink(tmp_path: Path):
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "lib.so.1").write_bytes(b"lib")
+    (source / "lib.so").symlink_to("lib.so.1")
+    result = build_zip(str(source), str(tmp_path / "layer.zip"), 1)
+    with ZipFile(result.file) as zipfile:
+        info = zipfile.getinfo("lib.so")
+        assert stat.S_ISLNK(unix_mode(info))
+        assert zipfile.read(info) == b"lib.so.1"
+
+
+def test_build_zip_failure_removes_output(tmp_path: Path):
+    source = tmp_path / "source"
+    make_tree(source)
+    entries = plan_build(str(source))
+    os.remove(entries[-1].source)
+    with pytest.raises(FileNotFoundError):
+        build_zip(str(source), str(tmp_path / "layer.zip"), 2, entries=entries)
+    assert list(tmp_path.iterdir()) == [source]
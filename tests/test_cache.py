@@ -0,0 +1,154 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+from dtawslayertool.cache import (
+    LayerCache,
+    MetadataCache,
+    code_sha256,
+    parse_size,
+    presigned_url_expiry,
+)
+
+ARN = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+
+
+def write_layer(tmp_path: Path, name: str, size: int) -> Path:
+    filepath = tmp_path / name
+    filepath.write_bytes(name.encode("ascii") * (size // len(name)))
+    return filepath
+
+
+def test_parse_size():
+    assert parse_size("123") == 123
+    assert parse_size("4k") == 4096
+    assert parse_size("2G") == 2 * 1024**3
+    assert parse_size("10MiB") == 10 * 1024**2
+    with pytest.raises(ValueError):
+        parse_size("-1")
+
+
+def test_store_and_materialize(tmp_path: Path):
+    cache = LayerCache(str(tmp_path / "cache"))
+    srcpath = write_layer(tmp_path, "a.zip", 1000)
+    codesha256 = code_sha256(srcpath)
+    assert cache.lookup(codesha256) is None
+
+    cache.store(str(srcpath), codesha256)
+    dstpath = tmp_path / "out.zip"
+    assert cache.materialize(codesha256, str(dstpath)) in (
+        "reflink",
+        "hardlink",
+        "copy",
+    )
+    assert dstpath.read_bytes() == srcpath.read_bytes()
+    assert [entry.codesha256 for entry in cache.entries()] == [codesha256]
+
+
+def test_store_is_not_linked_to_source(tmp_path: Path):
+    cache = LayerCache(str(tmp_path / "cache"))
+    srcpath = write_layer(tmp_path, "a.zip", 1000)
+    codesha256 = code_sha256(srcpath)
+    entrypath = cache.store(str(srcpath), codesha256)
+    # Editing the stored file in place leaves the entry intact.
+    with open(str(srcpath), "r+b") as srcfile:
+        srcfile.write(b"edited")
+    assert os.stat(entrypath).st_nlink == 1
+    assert code_sha256(entrypath) == codesha256
+
+
+def test_size_mismatch_is_miss(tmp_path: Path):
+    cache = LayerCache(str(tmp_path / "cache"))
+    srcpath = write_layer(tmp_path, "a.zip", 1000)
+    codesha256 = code_sha256(srcpath)
+    cache.store(str(srcpath), codesha256)
+    assert cache.lookup(codesha256, size=999) is None
+    assert not cache.entries()
+
+
+def test_lru_eviction(tmp_path: Path):
+    cache = LayerCache(str(tmp_path / "cache"), max_size=2500)
+    hashes = []
+    for idx, name in enumerate(("a.zip", "b.zip", "c.zip")):
+        srcpath = write_layer(tmp_path, name, 1000)
+        hashes.append(code_sha256(srcpath))
+        entrypath = cache.store(str(srcpath), hashes[-1])
+        os.utime(entrypath, (idx, idx))
+    # Only two of the 1000 byte layers fit, so the oldest one (a) was evicted.
+    assert [entry.codesha256 for entry in cache.entries()] == hashes[:0:-1]
+
+    cache.lookup(hashes[1])  # Make b most recently used
+    assert not cache.prune(max_size=2500)
+    evicted = cache.prune(max_size=1000)
+    assert [entry.codesha256 for entry in evicted] == [hashes[2]]
+
+
+def test_check_removes_corrupted(tmp_path: Path):
+    cache = LayerCache(str(tmp_path / "cache"))
+    good = write_layer(tmp_path, "good.zip", 100)
+    bad = write_layer(tmp_path, "bad.zip", 100)
+    cache.store(str(good), code_sha256(good))
+    badpath = cache.store(str(bad), code_sha256(bad))
+    Path(badpath).write_bytes(b"garbage")
+
+    corrupted = cache.check()
+    assert [entry.codesha256 for entry in corrupted] == [code_sha256(bad)]
+    assert [entry.codesha256 for entry in cache.entries()] == [code_sha256(good)]
+
+
+def test_presigned_url_expiry():
+    assert (
+        presigned_url_expiry(
+            "https://bucket.s3.amazonaws.com/key?versionId=x"
+            "&X-Amz-Date=20210506T110440Z&X-Amz-Expires=600&X-Amz-Signature=y"
+        )
+        == 1620299080 + 600
+    )
+    assert presigned_url_expiry("https://b.s3.amazonaws.com/k?Expires=1620299680") == (
+        1620299680
+    )
+    assert presigned_url_expiry("https://example.invalid/layer") is None
+
+
+def layerinfo_with_location(location: str) -> dict:
+    return {
+        "ResponseMetadata": {"HTTPStatusCode": 200},
+        "Content": {"Location": location, "CodeSha256": "abc=", "CodeSize": 3},
+        "LayerVersionArn": ARN,
+        "Version": 1,
+    }
+
+
+def test_metadata_cache(tmp_path: Path):
+    cache = MetadataCache(str(tmp_path / "cache"))
+    assert cache.lookup(ARN) is None
+    location = "https://b.s3.amazonaws.com/k?Expires={}".format(int(time.time() + 600))
+    cache.store(ARN, layerinfo_with_location(location))
+    assert cache.lookup(ARN) == {
+        "Content": {"Location": location, "CodeSha256": "abc=", "CodeSize": 3},
+        "LayerVersionArn": ARN,
+        "Version": 1,
+    }
+
+
+def test_metadata_cache_location_expired(tmp_path: Path):
+    cache = MetadataCache(str(tmp_path / "cache"))
+    location = "https://b.s3.amazonaws.com/k?Expires={}".format(int(time.time() + 10))
+    cache.store(ARN, layerinfo_with_location(location))
+    assert cache.lookup(ARN)["Content"] == {"CodeSha256": "abc=", "CodeSize": 3}
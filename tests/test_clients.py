@@ -0,0 +1,51 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import ThreadPoolExecutor
+
+from dtawslayertool.clients import ClientConfig, ClientRegistry
+
+
+def test_clients_are_reused():
+    registry = ClientRegistry()
+    client = registry.client("lambda", "us-east-1")
+    assert registry.client("lambda", "us-east-1") is client
+    assert registry.client("lambda", "eu-west-1") is not client
+    assert registry.client("s3", "us-east-1") is not client
+
+
+def test_concurrent_creation_yields_one_client():
+    registry = ClientRegistry()
+    with ThreadPoolExecutor(8) as executor:
+        clients = list(
+            executor.map(lambda _: registry.client("lambda", "eu-west-1"), range(16))
+        )
+    assert all(client is clients[0] for client in clients)
+
+
+def test_config_applied():
+    registry = ClientRegistry(
+        config=ClientConfig(
+            max_pool_connections=77,
+            retry_mode="adaptive",
+            max_attempts=5,
+            connect_timeout=3,
+            read_timeout=7,
+        )
+    )
+    config = registry.client("lambda", "us-east-1").meta.config
+    assert config.max_pool_connections == 77
+    assert config.retries == dict(mode="adaptive", total_max_attempts=5)
+    assert config.connect_timeout == 3
+    assert config.read_timeout == 7
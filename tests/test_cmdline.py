@@ -25,12 +25,33 @@ from dtawslayertool.app import make_arg_parser
 # the error output of pytest is better for dicts.
 
 
+DOWNLOAD_DEFAULTS = dict(
+    part_size=8 * 1024 * 1024, download_concurrency=8, buffer_size=256 * 1024
+)
+PULL_DEFAULTS = dict(
+    extract_concurrency=8, incremental=False, include=None, exclude=None
+)
+CLONE_DEFAULTS = dict(
+    s3_staging_bucket=None, s3_staging_prefix="dt-awslayertool/", force_publish=False
+)
+
+
 def argdict(args, **kwargs):
     assert isinstance(args.parser, argparse.ArgumentParser)
     result = dict(
         parser=args.parser,
         profile=None,
         debug=None,
+        cache_dir=None,
+        cache_max_size=None,
+        no_cache=False,
+        max_pool_connections=50,
+        retry_mode="standard",
+        max_attempts=None,
+        connect_timeout=None,
+        read_timeout=None,
+        timings=None,
+        timings_format="json",
     )
     result.update(kwargs)
     return result
@@ -76,8 +97,11 @@ def test_howto_clone():
         command="clone",
         profile="default",
         layer_arn="arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
-        target_region="eu-central-1",
+        target_region=["eu-central-1"],
+        publish_concurrency=4,
+        **CLONE_DEFAULTS,
         overwrite=False,
+        **DOWNLOAD_DEFAULTS,
     )
 
 
@@ -90,7 +114,10 @@ def test_clone_overwrite():
         command="clone",
         layer_arn="arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
         target_region=None,
+        publish_concurrency=4,
+        **CLONE_DEFAULTS,
         overwrite=True,
+        **DOWNLOAD_DEFAULTS,
     )
 
 
@@ -105,6 +132,8 @@ def test_howto_pull():
         layer_arn="arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
         overwrite=False,
         extract="DynatraceOneAgentExtension",
+        **DOWNLOAD_DEFAULTS,
+        **PULL_DEFAULTS,
     )
 
 
@@ -122,6 +151,8 @@ def test_pull_positional_in_middle():
         layer_arn="arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
         overwrite=True,
         extract="DynatraceOneAgentExtension",
+        **DOWNLOAD_DEFAULTS,
+        **PULL_DEFAULTS,
     )
 
 
@@ -135,6 +166,8 @@ def test_pull_overwrite_noextract():
         layer_arn="arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
         overwrite=True,
         extract=None,
+        **DOWNLOAD_DEFAULTS,
+        **PULL_DEFAULTS,
     )
 
 
@@ -145,3 +178,205 @@ def test_howto_info():
         command="info",
         layer_arn="arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
     )
+
+
+def test_cache_prune():
+    args = parse_cmdline("--cache-max-size 500M --cache-dir /tmp/c cache prune")
+    assert vars(args) == argdict(
+        args,
+        command="cache",
+        action="prune",
+        cache_dir="/tmp/c",
+        cache_max_size=500 * 1024 * 1024,
+    )
+
+
+def test_cache_bad_action():
+    with pytest.raises(ArgumentError) as excinfo:
+        parse_cmdline("cache purge")
+    assert "invalid choice" in str(excinfo.value)
+
+
+def test_pull_part_size():
+    args = parse_cmdline(
+        "pull --part-size 16M --download-concurrency 4 --buffer-size 1M "
+        "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    )
+    assert vars(args) == argdict(
+        args,
+        command="pull",
+        layer_arn="arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
+        overwrite=False,
+        extract=None,
+        part_size=16 * 1024 * 1024,
+        download_concurrency=4,
+        buffer_size=1024 * 1024,
+        **PULL_DEFAULTS,
+    )
+
+
+def test_clone_multiple_regions():
+    args = parse_cmdline(
+        "clone -t eu-central-1 --target-region us-west-2 --publish-concurrency 2 "
+        "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    )
+    assert vars(args) == argdict(
+        args,
+        command="clone",
+        layer_arn="arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
+        target_region=["eu-central-1", "us-west-2"],
+        publish_concurrency=2,
+        **CLONE_DEFAULTS,
+        overwrite=False,
+        **DOWNLOAD_DEFAULTS,
+    )
+
+
+def test_batch():
+    args = parse_cmdline("--profile x batch -j 8 --output out.jsonl layers.txt")
+    assert vars(args) == argdict(
+        args,
+        profile="x",
+        command="batch",
+        manifest="layers.txt",
+        format=None,
+        default_action="pull",
+        parallelism=8,
+        output="out.jsonl",
+    )
+
+
+def test_pull_include_exclude():
+    args = parse_cmdline(
+        "pull -x out --include 'nodejs/*' --include extensions --exclude '*.map' "
+        "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    )
+    assert args.include == ["nodejs/*", "extensions"]
+    assert args.exclude == ["*.map"]
+
+
+def test_ls():
+    args = parse_cmdline("ls arn:aws:lambda:us-east-1:123456789012:layer:foo:1")
+    assert vars(args) == argdict(
+        args,
+        command="ls",
+        layer_arn="arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
+        include=None,
+        exclude=None,
+    )
+
+
+def test_sync():
+    args = parse_cmdline(
+        "sync -t all -j 3 --state-file state.json "
+        "arn:aws:lambda:us-east-1:123456789012:layer:foo"
+    )
+    assert vars(args) == argdict(
+        args,
+        command="sync",
+        layer_arn="arn:aws:lambda:us-east-1:123456789012:layer:foo",
+        target_region=["all"],
+        s3_staging_bucket=None,
+        s3_staging_prefix="dt-awslayertool/",
+        publish_concurrency=4,
+        parallelism=3,
+        state_file="state.json",
+        **DOWNLOAD_DEFAULTS,
+    )
+
+
+def test_discover():
+    args = parse_cmdline("discover -r all --name 'Dynatrace_*' --runtime python3.8")
+    assert vars(args) == argdict(
+        args,
+        command="discover",
+        layer=[],
+        region=["all"],
+        account_profile=None,
+        name=["Dynatrace_*"],
+        runtime=["python3.8"],
+        all_versions=False,
+        parallelism=8,
+        output=None,
+    )
+
+
+def test_verify():
+    args = parse_cmdline(
+        "verify --no-index arn:aws:lambda:us-east-1:123456789012:layer:foo:1 "
+        "extracted --exclude '*.map' --hash-concurrency 16"
+    )
+    assert vars(args) == argdict(
+        args,
+        command="verify",
+        layer_arn="arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
+        target="extracted",
+        include=None,
+        exclude=["*.map"],
+        index=None,
+        no_index=True,
+        hash_concurrency=16,
+    )
+
+
+def test_diff():
+    args = parse_cmdline(
+        "diff arn:aws:lambda:us-east-1:123456789012:layer:foo:1 "
+        "arn:aws:lambda:us-east-1:123456789012:layer:foo:2 --content nodejs/package.json"
+    )
+    assert vars(args) == argdict(
+        args,
+        command="diff",
+        old="arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
+        new="arn:aws:lambda:us-east-1:123456789012:layer:foo:2",
+        include=None,
+        exclude=None,
+        content=["nodejs/package.json"],
+    )
+
+
+def test_optimize():
+    args = parse_cmdline(
+        "optimize foo-v1.zip --prune '*.map' --prune test --compress-level 9"
+    )
+    assert vars(args) == argdict(
+        args,
+        command="optimize",
+        zipfile="foo-v1.zip",
+        output=None,
+        overwrite=False,
+        prune=["*.map", "test"],
+        prune_rules=None,
+        compress_concurrency=None,
+        compress_level=9,
+    )
+
+
+def test_publish():
+    args = parse_cmdline(
+        "publish arn:aws:lambda:us-east-1:123456789012:layer:foo:1 patched "
+        "-t eu-central-1 --compress-level 9 --compress-concurrency 2"
+    )
+    assert vars(args) == argdict(
+        args,
+        command="publish",
+        layer_arn="arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
+        folder="patched",
+        layer_name=None,
+        output=None,
+        overwrite=False,
+        compress_concurrency=2,
+        compress_level=9,
+        target_region=["eu-central-1"],
+        publish_concurrency=4,
+        **CLONE_DEFAULTS,
+    )
+
+
+def test_publish_bad_level():
+    with pytest.raises(ArgumentError) as excinfo:
+        parse_cmdline(
+            "publish arn:aws:lambda:us-east-1:123456789012:layer:foo:1 patched "
+            "--compress-level 10"
+        )
+    assert "invalid choice" in str(excinfo.value)
@@ -0,0 +1,79 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from zipfile import ZipInfo
+
+from dtawslayertool.diff import DiffResult, EntryDiff, content_diff, diff_entries
+from dtawslayertool.extract import ZIP_UNIX_SYSTEM
+
+
+def entry(name: str, size: int, crc: int, mode: int = 0) -> ZipInfo:
+    info = ZipInfo(name)
+    info.file_size = size
+    info.CRC = crc
+    if mode:
+        info.create_system = ZIP_UNIX_SYSTEM
+        info.external_attr = mode << 16
+    return info
+
+
+def test_diff_entries():
+    old = [
+        entry("nodejs/", 0, 0),
+        entry("nodejs/a.js", 10, 1),
+        entry("nodejs/b.js", 20, 2),
+        entry("nodejs/bin/agent", 5, 3, 0o100644),
+        entry("nodejs/same.js", 7, 4, 0o100644),
+        entry("nodejs/nomode.js", 8, 5),
+    ]
+    new = [
+        entry("nodejs/a.js", 12, 6),
+        entry("nodejs/bin/agent", 5, 3, 0o100755),
+        entry("nodejs/c.js", 3, 7),
+        entry("nodejs/same.js", 7, 4, 0o100644),
+        entry("nodejs/nomode.js", 8, 5, 0o100644),
+    ]
+    changes, unchanged = diff_entries(old, new)
+    assert changes == [
+        EntryDiff("nodejs/a.js", "modified", 10, 12),
+        EntryDiff("nodejs/b.js", "removed", 20, None),
+        EntryDiff("nodejs/bin/agent", "modified", 5, 5, 0o100644, 0o100755),
+        EntryDiff("nodejs/c.js", "added", None, 3),
+    ]
+    assert unchanged == 2  # Modes are only compared if both sides have them
+
+    result = DiffResult("old.zip", "new.zip", changes, unchanged, {})
+    assert result.size_delta == 2 - 20 + 3
+    assert str(result) == "1 added, 1 removed, 2 modified, 2 unchanged (-15 bytes)"
+
+
+def test_content_diff():
+    assert content_diff("a.txt", b"one\ntwo\n", b"one\n2\n").splitlines() == [
+        "--- a/a.txt",
+        "+++ b/a.txt",
+        "@@ -1,2 +1,2 @@",
+        " one",
+        "-two",
+        "+2",
+    ]
+    assert content_diff("new.txt", None, b"new").splitlines() == [
+        "--- /dev/null",
+        "+++ b/new.txt",
+        "@@ -0,0 +1 @@",
+        "+new",
+        "\\ No newline at end of file",
+    ]
+    assert content_diff("lib.so", b"\x7fELF\0", b"\x7fELF\0\1") == (
+        "Binary files a/lib.so and b/lib.so differ\n"
+    )
@@ -0,0 +1,183 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import stat
+import time
+import typing
+import zlib
+from pathlib import Path
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
+
+import pytest
+
+from dtawslayertool.extract import (
+    ExtractError,
+    extract_all,
+    extract_incremental,
+    file_crc32,
+    safe_relpath,
+)
+
+DATE_TIME = (2021, 5, 6, 11, 4, 40)
+
+
+def add_entry(zipfile: ZipFile, name: str, content: bytes = b"", mode: int = 0o644):
+    info = ZipInfo(name, DATE_TIME)
+    info.create_system = 3
+    info.compress_type = ZIP_DEFLATED
+    if name.endswith("/"):
+        mode |= stat.S_IFDIR
+        info.external_attr = 0x10  # MS-DOS directory flag
+    else:
+        mode |= stat.S_IFREG
+    info.external_attr |= mode << 16
+    zipfile.writestr(info, content)
+
+
+def make_zip(path: Path, entries: typing.Iterable[tuple]) -> str:
+    with ZipFile(path, "w") as zipfile:
+        for entry in entries:
+            add_entry(zipfile, *entry)
+    return str(path)
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_extract_all(tmp_path: Path, concurrency: int):
+    entries = [("nodejs/", b"", 0o755), ("nodejs/bin/agent", b"#!/bin/sh\n", 0o755)]
+    entries += [("nodejs/lib/f{}.js".format(i), b"x" * i) for i in range(100)]
+    zipname = make_zip(tmp_path / "layer.zip", entries)
+    target = tmp_path / "out"
+
+    extracted = extract_all(zipname, str(target), concurrency)
+
+    assert len(extracted) == 101
+    assert (target / "nodejs/lib/f42.js").read_bytes() == b"x" * 42
+    agent = target / "nodejs/bin/agent"
+    assert agent.read_bytes() == b"#!/bin/sh\n"
+    assert stat.S_IMODE(agent.stat().st_mode) == 0o755
+    assert stat.S_IMODE((target / "nodejs/lib/f1.js").stat().st_mode) == 0o644
+    expected_mtime = time.mktime(DATE_TIME + (0, 0, -1))
+    assert agent.stat().st_mtime == expected_mtime
+    assert (target / "nodejs").stat().st_mtime == expected_mtime
+
+
+def test_extract_replaces_readonly_file(tmp_path: Path):
+    zipname = make_zip(tmp_path / "layer.zip", [("file", b"new", 0o444)])
+    target = tmp_path / "out"
+    target.mkdir()
+    (target / "file").write_bytes(b"old")
+    (target / "file").chmod(0o444)
+    extract_all(zipname, str(target))
+    assert (target / "file").read_bytes() == b"new"
+
+
+@pytest.mark.parametrize("name", ["../evil", "a/../../evil", "/etc/passwd"])
+def test_extract_rejects_traversal(tmp_path: Path, name: str):
+    zipname = make_zip(tmp_path / "layer.zip", [("good", b"1"), (name, b"2")])
+    with pytest.raises(ExtractError):
+        extract_all(zipname, str(tmp_path / "out"))
+    assert not (tmp_path / "evil").exists()
+    assert not (tmp_path / "out").exists()
+
+
+def test_extract_incremental(tmp_path: Path):
+    old = make_zip(
+        tmp_path / "old.zip",
+        [
+            ("same.txt", b"same"),
+            ("changed.txt", b"old"),
+            ("samesize.txt", b"aaaa"),
+            ("stale/file.txt", b"stale"),
+            ("mode.sh", b"echo", 0o644),
+        ],
+    )
+    new = make_zip(
+        tmp_path / "new.zip",
+        [
+            ("same.txt", b"same"),
+            ("changed.txt", b"new content"),
+            ("samesize.txt", b"bbbb"),
+            ("added/file.txt", b"added"),
+            ("mode.sh", b"echo", 0o755),
+        ],
+    )
+    target = tmp_path / "out"
+    extract_all(old, str(target))
+    (target / "same.txt").chmod(0o644)
+    os.utime(target / "same.txt", (1000, 1000))
+    (target / "local.txt").write_bytes(b"not in layer")
+
+    summary = extract_incremental(new, str(target), concurrency=2)
+
+    assert summary.added == [os.path.join("added", "file.txt")]
+    assert summary.changed == ["changed.txt", "samesize.txt"]
+    assert summary.removed == ["local.txt", os.path.join("stale", "file.txt")]
+    assert summary.unchanged == ["mode.sh", "same.txt"]
+    assert str(summary) == "1 added, 2 changed, 2 removed, 2 unchanged"
+    assert (target / "same.txt").stat().st_mtime == 1000
+    assert (target / "changed.txt").read_bytes() == b"new content"
+    assert (target / "samesize.txt").read_bytes() == b"bbbb"
+    assert stat.S_IMODE((target / "mode.sh").stat().st_mode) == 0o755
+    assert not (target / "stale").exists()
+    assert sorted(p.name for p in target.iterdir()) == [
+        "added",
+        "changed.txt",
+        "mode.sh",
+        "same.txt",
+        "samesize.txt",
+    ]
+
+
+def test_extract_incremental_file_dir_swap(tmp_path: Path):
+    new = make_zip(tmp_path / "new.zip", [("a", b"file now"), ("b/c", b"in dir")])
+    target = tmp_path / "out"
+    (target / "a").mkdir(parents=True)
+    (target / "a" / "old").write_bytes(b"x")
+    (target / "b").write_bytes(b"was a file")
+
+    summary = extract_incremental(new, str(target))
+
+    assert (target / "a").read_bytes() == b"file now"
+    assert (target / "b" / "c").read_bytes() == b"in dir"
+    assert summary.removed == [os.path.join("a", "old"), "b"]
+
+
+def test_extract_incremental_symlinked_target(tmp_path: Path):
+    zipname = make_zip(tmp_path / "layer.zip", [("same.txt", b"same"), ("d/f", b"f")])
+    real = tmp_path / "real"
+    extract_all(zipname, str(real))
+    os.utime(real / "same.txt", (1000, 1000))
+    target = tmp_path / "out"
+    target.symlink_to(real, target_is_directory=True)
+
+    summary = extract_incremental(zipname, str(target))
+
+    assert summary.unchanged == [os.path.join("d", "f"), "same.txt"]
+    assert summary.added == summary.changed == summary.removed == []
+    assert target.is_symlink()
+    assert (real / "same.txt").stat().st_mtime == 1000
+
+
+def test_safe_relpath():
+    assert safe_relpath("./a//b/") == "a/b"
+    assert safe_relpath("a/..b") == "a/..b"
+
+
+def test_file_crc32_chunks(tmp_path: Path):
+    content = bytes(range(256)) * 41
+    filename = tmp_path / "file"
+    filename.write_bytes(content)
+    # Not a divisor of the file size, so that the last chunk is shorter.
+    assert file_crc32(str(filename), bufsize=1000) == zlib.crc32(content)
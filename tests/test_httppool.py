@@ -0,0 +1,95 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from urllib.error import HTTPError
+
+import pytest
+from conftest import LayerServer
+
+from dtawslayertool.httppool import HttpPool
+
+# Pytest fixtures work by matching names, so this pylint warning is annoying:
+# pylint:disable=redefined-outer-name
+
+CONTENT = os.urandom(64 * 1024 + 3)
+
+
+@pytest.fixture
+def pool():
+    pool = HttpPool()
+    yield pool
+    pool.close()
+
+
+def test_keep_alive(pool: HttpPool, layer_server: LayerServer):
+    url = layer_server.add("/layer", CONTENT)
+    for rangeheader in ("bytes=0-99", "bytes=100-199", None):
+        headers = {"Range": rangeheader} if rangeheader else {}
+        with pool.open(url, headers) as response:
+            response.read()
+    buffer = memoryview(bytearray(len(CONTENT)))
+    with pool.open(url) as response:
+        nread = 0
+        while nread < len(CONTENT):
+            nread += response.readinto(buffer[nread:])
+    assert buffer == CONTENT
+    assert len(layer_server.connections) == 1
+    stats = pool.stats()
+    assert (stats.requests, stats.connections, stats.reused) == (4, 1, 3)
+    assert stats.bytes == 200 + 2 * len(CONTENT)
+    assert stats.throughput > 0
+
+
+def test_partial_read_not_reused(pool: HttpPool, layer_server: LayerServer):
+    url = layer_server.add("/layer", CONTENT)
+    with pool.open(url) as response:
+        response.read(100)
+    with pool.open(url) as response:
+        assert response.read() == CONTENT
+    assert len(layer_server.connections) == 2
+
+
+def test_error_status(pool: HttpPool, layer_server: LayerServer):
+    url = layer_server.add("/layer", CONTENT)
+    layer_server.forbidden.add("/layer")
+    with pytest.raises(HTTPError) as excinfo:
+        pool.open(url)
+    assert excinfo.value.code == 403
+    excinfo.value.close()
+    layer_server.forbidden.clear()
+    with pool.open(url) as response:
+        assert response.read() == CONTENT
+    # The error response was read, so its connection was reused.
+    assert len(layer_server.connections) == 1
+
+
+def test_dropped_connection_retried(pool: HttpPool, layer_server: LayerServer):
+    url = layer_server.add("/layer", CONTENT)
+    layer_server.drop_connections = True
+    for _ in range(3):
+        with pool.open(url) as response:
+            assert response.read() == CONTENT
+    assert len(layer_server.connections) == 3
+    assert pool.stats().requests == 3
+
+
+def test_idle_expiry(layer_server: LayerServer):
+    pool = HttpPool(max_idle_seconds=0)
+    url = layer_server.add("/layer", CONTENT)
+    for _ in range(2):
+        with pool.open(url) as response:
+            response.read()
+    assert len(layer_server.connections) == 2
+    assert pool.stats().reused == 0
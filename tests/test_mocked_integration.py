@@ -12,26 +12,39 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import asyncio
 import contextlib
+import copy
 import hashlib
+import json
 import os
 import re
-import shutil
+import time
 import typing
-import urllib.request
-from base64 import b64encode
-from email import message_from_string
-from http.client import HTTPMessage
+from base64 import b64decode, b64encode
 from pathlib import Path
-from typing import Callable, ContextManager, NamedTuple, Optional, Tuple, Union
-from unittest import mock
+from typing import Callable, ContextManager, NamedTuple, Optional, Tuple
 from zipfile import ZipFile
 
 import boto3
 import pytest
-from botocore.stub import Stubber
+from botocore.stub import ANY, Stubber
+from conftest import LayerServer
 
-from dtawslayertool import app
+from dtawslayertool import (
+    CloneError,
+    CloneResult,
+    DiscoverError,
+    LayerClient,
+    TargetExistsError,
+    api,
+    app,
+)
+from dtawslayertool.aio import AsyncLayerClient
+from dtawslayertool.build import build_zip
+from dtawslayertool.cache import CACHE_DIR_ENV, code_sha256
+from dtawslayertool.staging import S3Staging
+from dtawslayertool.transfer import TransferConfig
 
 
 @pytest.fixture
@@ -44,7 +57,15 @@ def tmp_cwd(
     os.chdir(prev_cwd)
 
 
+@pytest.fixture(autouse=True)
+def isolated_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    cachedir = tmp_path / "layercache"
+    monkeypatch.setenv(CACHE_DIR_ENV, str(cachedir))
+    return cachedir
+
+
 MOCK_LOCATION = "https://example.invalid/layer/foo"
+MOCK_URLPATH = "/layer/foo"
 MOCK_ZIPFILESOURCE_FNAME = "serverside-layer.zip"
 MOCK_INNERFILENAME = "dynatrace"
 MOCK_INNERFILECONTENT = b"#!/bin/sh\ntrue\n"
@@ -63,47 +84,13 @@ def write_mock_zip(tmp_path: Path) -> Tuple[Path, str]:
 
 class MockInfo(NamedTuple):
     srczippath: Path
+    server: Optional[LayerServer]
 
-
-def setup_urlretrieve(
-    srcpath: Path, sha256: str, fsize: int, monkeypatch: pytest.MonkeyPatch
-):
-    def mocked_urlretrieve(
-        url: str,
-        filename: Optional[Union[str, os.PathLike]] = None,
-        reporthook: Optional[Callable[[int, int, int], None]] = None,
-        data: Optional[bytes] = None,
-    ) -> Tuple[str, HTTPMessage]:
-        assert url == MOCK_LOCATION
-        assert isinstance(data, bytes) or data is None
-        filename = filename or "retrieved.dat"
-        reporthook(0, fsize // 2, fsize)
-        dstpath = (shutil.copyfile(srcpath, filename),)
-        reporthook(1, fsize // 2, fsize)
-        reporthook(2, fsize // 2, fsize)
-        return (
-            dstpath,
-            message_from_string(
-                f"""x-amz-id-2: o7+2hkEMcor15Ja=
-x-amz-request-id: 7YTCM76R6WJDQVP7
-Date: Thu, 06 May 2021 11:04:40 GMT
-Last-Modified: Fri, 27 Nov 2020 09:40:42 GMT
-ETag: "{sha256}-bla"
-x-amz-server-side-encryption: AES256
-x-amz-version-id: inaUofwd8k5ejWZg2uvNbB4FK.6XLm9F
-Accept-Ranges: bytes
-Content-Type: application/zip
-Content-Length: {fsize}
-Server: AmazonS3
-Connection: close""",
-                HTTPMessage,
-            ),
+    def count_downloads(self) -> int:
+        return sum(
+            method == "GET" for method, _range in self.server.get_requests(MOCK_URLPATH)
         )
 
-    urlretrieve_mock = mock.Mock(side_effect=mocked_urlretrieve)
-    monkeypatch.setattr(urllib.request, "urlretrieve", urlretrieve_mock)
-    monkeypatch.setattr(app, "urlretrieve", urlretrieve_mock)
-
 
 # Pytest fixtures work by matching names, so this pylint warning is annoying:
 # pylint:disable=redefined-outer-name
@@ -114,12 +101,14 @@ def setup_mocks(
     tmp_path: Path,
     monkeypatch: pytest.MonkeyPatch,
     configure_stubber: Callable[[Stubber, dict], None],
-    allow_retrieve: bool,
+    layer_server: Optional[LayerServer] = None,
 ) -> ContextManager[MockInfo]:
+    """Stubs the Lambda API. Downloads are only possible if layer_server is given."""
     srcpath, sha256 = write_mock_zip(tmp_path)
     fsize = srcpath.stat().st_size
-    if allow_retrieve:
-        setup_urlretrieve(srcpath, sha256, fsize, monkeypatch)
+    location = MOCK_LOCATION
+    if layer_server:
+        location = layer_server.add(MOCK_URLPATH, srcpath.read_bytes())
 
     original_client = boto3.Session.client
 
@@ -137,7 +126,7 @@ def setup_mocks(
             "RetryAttempts": 0,
         },
         "Content": {
-            "Location": MOCK_LOCATION,
+            "Location": location,
             "CodeSha256": sha256,
             "CodeSize": fsize,
         },
@@ -153,7 +142,7 @@ def setup_mocks(
     stubbers = []  # type: typing.List[Stubber]
 
     def wrap_client(self: boto3.Session, service_name: str, *args, **kwargs):
-        assert service_name == "lambda"
+        assert service_name in ("lambda", "s3")
         client = original_client(self, service_name, *args, **kwargs)
         stubber = Stubber(client)
         configure_stubber(stubber, layerinfo)
@@ -162,7 +151,7 @@ def setup_mocks(
         return client
 
     monkeypatch.setattr(boto3.Session, "client", wrap_client)
-    yield MockInfo(srcpath)
+    yield MockInfo(srcpath, layer_server)
     for stubber in stubbers:
         stubber.assert_no_pending_responses()
 
@@ -171,9 +160,15 @@ def setup_info_stubber(stubber: Stubber, layerinfo: dict):
     stubber.add_response("get_layer_version_by_arn", layerinfo)
 
 
-def test_pull(tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch):
+def add_no_versions_response(stubber: Stubber):
+    stubber.add_response("list_layer_versions", {"LayerVersions": []})
+
+
+def test_pull(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch, layer_server: LayerServer
+):
     with setup_mocks(
-        tmp_cwd, monkeypatch, setup_info_stubber, allow_retrieve=True
+        tmp_cwd, monkeypatch, setup_info_stubber, layer_server
     ) as mockinfo:
         app.main(
             (
@@ -194,10 +189,189 @@ def test_pull(tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch):
         assert innerfilepath.read_bytes() == MOCK_INNERFILECONTENT
 
 
+def test_pull_timings(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch, layer_server: LayerServer
+):
+    with setup_mocks(tmp_cwd, monkeypatch, setup_info_stubber, layer_server):
+        app.main(
+            (
+                "--timings",
+                "timings.json",
+                "pull",
+                "arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
+                "-x",
+                "extracted",
+            )
+        )
+    document = json.loads((tmp_cwd / "timings.json").read_text("utf-8"))
+    assert document["labels"] == dict(command="pull")
+    phases = {phase["name"]: phase for phase in document["phases"]}
+    assert list(phases) == [
+        "total",
+        "metadata",
+        "cache",
+        "download",
+        "cache-store",
+        "extract",
+    ]
+    zipsize = (tmp_cwd / "foo-v1.zip").stat().st_size
+    assert phases["download"]["bytes"] == zipsize
+    assert phases["download"]["throughput"] > 0
+    assert phases["extract"]["bytes"] == len(MOCK_INNERFILECONTENT)
+    assert phases["total"]["seconds"] >= phases["download"]["seconds"]
+    assert document["stats"]["http"]["requests"] >= 1
+
+
+def test_pull_cached(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch, layer_server: LayerServer
+):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    with setup_mocks(
+        tmp_cwd, monkeypatch, setup_info_stubber, layer_server
+    ) as mockinfo:
+        app.main(("pull", arn))
+        assert mockinfo.count_downloads() == 1
+        app.main(("pull", arn, "--overwrite"))
+        assert mockinfo.count_downloads() == 1
+
+        dlpath = tmp_cwd / "foo-v1.zip"
+        assert mockinfo.srczippath.read_bytes() == dlpath.read_bytes()
+
+        app.main(("--no-cache", "pull", arn, "--overwrite"))
+        assert mockinfo.count_downloads() == 2
+
+
+def test_pull_incremental(
+    tmp_cwd: Path,
+    capsys: pytest.CaptureFixture,
+    monkeypatch: pytest.MonkeyPatch,
+    layer_server: LayerServer,
+):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    with setup_mocks(tmp_cwd, monkeypatch, setup_info_stubber, layer_server):
+        app.main(("pull", arn, "-x", "extracted"))
+        (tmp_cwd / "extracted" / "stale.txt").write_bytes(b"stale")
+        app.main(("pull", arn, "-x", "extracted", "--overwrite", "--incremental"))
+
+    assert "0 added, 0 changed, 1 removed, 1 unchanged" in capsys.readouterr().err
+    extractpath = tmp_cwd / "extracted"
+    assert tuple(p.name for p in extractpath.iterdir()) == (MOCK_INNERFILENAME,)
+
+
+def test_pull_include(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch, layer_server: LayerServer
+):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    with setup_mocks(
+        tmp_cwd, monkeypatch, setup_info_stubber, layer_server
+    ) as mockinfo:
+        app.main(("pull", arn, "-x", "extracted", "--include", "dyna*"))
+        # Only range requests, no layer file
+        assert all(rng for _method, rng in layer_server.get_requests(MOCK_URLPATH))
+        assert mockinfo.count_downloads() >= 1
+        assert not (tmp_cwd / "foo-v1.zip").exists()
+        innerfilepath = tmp_cwd / "extracted" / MOCK_INNERFILENAME
+        assert innerfilepath.read_bytes() == MOCK_INNERFILECONTENT
+
+
+def test_pull_include_without_ranges(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch, layer_server: LayerServer
+):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    with setup_mocks(tmp_cwd, monkeypatch, setup_info_stubber, layer_server):
+        layer_server.support_ranges = False
+        app.main(("pull", arn, "-x", "extracted", "--exclude", "dyna*"))
+        assert (tmp_cwd / "foo-v1.zip").is_file()
+        assert list((tmp_cwd / "extracted").iterdir()) == []
+
+
+def test_ls(
+    tmp_cwd: Path,
+    capsys: pytest.CaptureFixture,
+    monkeypatch: pytest.MonkeyPatch,
+    layer_server: LayerServer,
+):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    with setup_mocks(tmp_cwd, monkeypatch, setup_info_stubber, layer_server):
+        app.main(("ls", arn))
+        out = capsys.readouterr().out.splitlines()
+        assert len(out) == 1
+        assert out[0].split()[-1] == MOCK_INNERFILENAME
+        assert out[0].split()[-4] == str(len(MOCK_INNERFILECONTENT))
+        assert not (tmp_cwd / "foo-v1.zip").exists()
+
+
+def test_verify(
+    tmp_cwd: Path,
+    capsys: pytest.CaptureFixture,
+    monkeypatch: pytest.MonkeyPatch,
+    layer_server: LayerServer,
+):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    with setup_mocks(tmp_cwd, monkeypatch, setup_info_stubber, layer_server):
+        app.main(("--no-cache", "pull", arn, "-x", "extracted"))
+        app.main(("--no-cache", "verify", arn, "foo-v1.zip"))
+        app.main(("--no-cache", "verify", arn, "extracted"))
+        # Only the central directory is read
+        assert all(rng for _method, rng in layer_server.get_requests(MOCK_URLPATH)[1:])
+        assert (tmp_cwd / "foo-v1.zip.hashes.json").is_file()
+        assert (tmp_cwd / "extracted.hashes.json").is_file()
+        assert capsys.readouterr().out == ""
+
+        (tmp_cwd / "extracted" / MOCK_INNERFILENAME).write_bytes(b"changed")
+        (tmp_cwd / "extracted" / "extra.txt").write_bytes(b"")
+        with pytest.raises(SystemExit) as excinfo:
+            app.main(("--no-cache", "verify", arn, "extracted", "--no-index"))
+        assert str(excinfo.value) == "extracted does not match " + arn
+        assert capsys.readouterr().out.splitlines() == [
+            "changed  " + MOCK_INNERFILENAME,
+            "extra    extra.txt",
+        ]
+
+
+def test_api_verify_zip_mismatch(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch, layer_server: LayerServer
+):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    with ZipFile(tmp_cwd / "local.zip", "w") as zipf:
+        zipf.writestr(MOCK_INNERFILENAME, MOCK_INNERFILECONTENT)
+        zipf.writestr("extra.txt", b"")
+    with setup_mocks(tmp_cwd, monkeypatch, setup_info_stubber, layer_server):
+        result = LayerClient().verify(arn, "local.zip")
+    assert not result.ok
+    assert result.sha256_match is False
+    assert (result.missing, result.changed, result.extra) == ([], [], ["extra.txt"])
+    assert result.verified == 1
+
+
+def test_diff(
+    tmp_cwd: Path,
+    capsys: pytest.CaptureFixture,
+    monkeypatch: pytest.MonkeyPatch,
+    layer_server: LayerServer,
+):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    with ZipFile(tmp_cwd / "new.zip", "w") as zipf:
+        zipf.writestr(MOCK_INNERFILENAME, b"#!/bin/sh\nfalse\n")
+        zipf.writestr("added.txt", b"1234")
+    with setup_mocks(tmp_cwd, monkeypatch, setup_info_stubber, layer_server):
+        app.main(("--no-cache", "diff", arn, "new.zip"))
+        # Only the central directory is read
+        assert all(rng for _method, rng in layer_server.get_requests(MOCK_URLPATH))
+        assert capsys.readouterr().out.splitlines() == [
+            "added            +4 added.txt",
+            "modified         +1 " + MOCK_INNERFILENAME,
+        ]
+        result = LayerClient().diff(arn, "new.zip", content=[MOCK_INNERFILENAME])
+    assert str(result) == "1 added, 0 removed, 1 modified, 0 unchanged (+5 bytes)"
+    assert result.contents[MOCK_INNERFILENAME].splitlines()[-2:] == ["-true", "+false"]
+    assert list(result.contents) == [MOCK_INNERFILENAME]
+
+
 def test_info(
     tmp_cwd: Path, capsys: pytest.CaptureFixture, monkeypatch: pytest.MonkeyPatch
 ):
-    with setup_mocks(tmp_cwd, monkeypatch, setup_info_stubber, allow_retrieve=False):
+    with setup_mocks(tmp_cwd, monkeypatch, setup_info_stubber):
         app.main(
             (
                 "info",
@@ -211,23 +385,24 @@ def test_info(
         )
 
 
-def test_clone(tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch):
+def test_clone(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch, layer_server: LayerServer
+):
     def setup_pub_stubber(stubber: Stubber, layerinfo: dict):
         layerinfo["ResponseMetadata"]["HTTPStatusCode"] = 201
         layerinfo["LayerArn"] = layerinfo["LayerArn"].replace("123456", "012345")
         layerinfo["LayerVersionArn"] = layerinfo["LayerVersionArn"].replace(
             "123456", "012345"
         )
+        add_no_versions_response(stubber)
         stubber.add_response("publish_layer_version", layerinfo)
 
-    stubbers = iter((setup_info_stubber, setup_pub_stubber))
-
     def setup_stubbers(stubber: Stubber, layerinfo: dict):
-        return next(stubbers)(stubber, layerinfo)
+        # Source and target region are the same, so the client is reused.
+        setup_info_stubber(stubber, layerinfo)
+        setup_pub_stubber(stubber, copy.deepcopy(layerinfo))
 
-    with setup_mocks(
-        tmp_cwd, monkeypatch, setup_stubbers, allow_retrieve=True
-    ) as mockinfo:
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers, layer_server) as mockinfo:
         app.main(
             (
                 "clone",
@@ -239,3 +414,862 @@ def test_clone(tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch):
 
         assert dlpath.is_file()
         assert mockinfo.srczippath.read_bytes() == dlpath.read_bytes()
+
+
+def test_clone_existing_version(
+    tmp_cwd: Path,
+    capsys: pytest.CaptureFixture,
+    monkeypatch: pytest.MonkeyPatch,
+    layer_server: LayerServer,
+):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    targetarn = "arn:aws:lambda:eu-west-1:123456789012:layer:foo:"
+
+    def setup_target_stubber(stubber: Stubber, layerinfo: dict):
+        otherinfo = copy.deepcopy(layerinfo)
+        otherinfo["Content"]["CodeSha256"] = "other"
+        stubber.add_response(
+            "list_layer_versions",
+            {
+                "LayerVersions": [{"LayerVersionArn": targetarn + "3"}],
+                "NextMarker": "page2",
+            },
+            dict(LayerName="foo"),
+        )
+        stubber.add_response(
+            "get_layer_version_by_arn", otherinfo, dict(Arn=targetarn + "3")
+        )
+        stubber.add_response(
+            "list_layer_versions",
+            {"LayerVersions": [{"LayerVersionArn": targetarn + "2"}]},
+            dict(LayerName="foo", Marker="page2"),
+        )
+        stubber.add_response(
+            "get_layer_version_by_arn", layerinfo, dict(Arn=targetarn + "2")
+        )
+
+    def setup_rerun_stubber(stubber: Stubber, _layerinfo: dict):
+        # Versions are immutable, so the rerun only lists them.
+        stubber.add_response(
+            "list_layer_versions",
+            {"LayerVersions": [{"LayerVersionArn": targetarn + "2"}]},
+            dict(LayerName="foo"),
+        )
+
+    stubbers = iter(
+        (
+            setup_info_stubber,
+            setup_target_stubber,
+            setup_info_stubber,
+            setup_rerun_stubber,
+        )
+    )
+
+    def setup_stubbers(stubber: Stubber, layerinfo: dict):
+        return next(stubbers)(stubber, layerinfo)
+
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers, layer_server) as mockinfo:
+        for _ in range(2):
+            app.main(("clone", arn, "-t", "eu-west-1"))
+            assert "found existing " + targetarn + "2" in capsys.readouterr().err
+        assert mockinfo.count_downloads() == 0
+        assert not (tmp_cwd / "foo-v1.zip").exists()
+
+
+def test_clone_force_publish(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch, layer_server: LayerServer
+):
+    def setup_stubbers(stubber: Stubber, layerinfo: dict):
+        setup_info_stubber(stubber, layerinfo)
+        stubber.add_response("publish_layer_version", copy.deepcopy(layerinfo))
+
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers, layer_server) as mockinfo:
+        app.main(
+            (
+                "clone",
+                "arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
+                "--force-publish",
+            )
+        )
+        assert mockinfo.count_downloads() == 1
+
+
+def test_publish(tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    newarn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:2"
+    (tmp_cwd / "patched" / "bin").mkdir(parents=True)
+    (tmp_cwd / "patched" / "bin" / MOCK_INNERFILENAME).write_bytes(b"patched")
+    expected = build_zip(str(tmp_cwd / "patched"), str(tmp_cwd / "expected.zip"))
+    runs = []
+
+    def setup_stubbers(stubber: Stubber, layerinfo: dict):
+        newinfo = copy.deepcopy(layerinfo)
+        newinfo["LayerVersionArn"] = newarn
+        newinfo["Version"] = 2
+        newinfo["Content"]["CodeSha256"] = expected.code_sha256
+        newinfo["Content"]["CodeSize"] = expected.code_size
+        runs.append(newinfo)
+        if len(runs) == 1:
+            setup_info_stubber(stubber, layerinfo)
+            add_no_versions_response(stubber)
+            stubber.add_response(
+                "publish_layer_version",
+                newinfo,
+                dict(
+                    LayerName="foo",
+                    Content=dict(ZipFile=ANY),
+                    Description=layerinfo["Description"],
+                    CompatibleRuntimes=layerinfo["CompatibleRuntimes"],
+                    LicenseInfo=layerinfo["LicenseInfo"],
+                ),
+            )
+        else:
+            # The same folder gives the same zip, which exists now.
+            setup_info_stubber(stubber, layerinfo)
+            stubber.add_response(
+                "list_layer_versions", {"LayerVersions": [{"LayerVersionArn": newarn}]}
+            )
+            stubber.add_response("get_layer_version_by_arn", newinfo, dict(Arn=newarn))
+
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers):
+        app.main(("publish", arn, "patched"))
+        assert (tmp_cwd / "patched.zip").read_bytes() == (
+            tmp_cwd / "expected.zip"
+        ).read_bytes()
+        with pytest.raises(SystemExit) as excinfo:
+            app.main(("publish", arn, "patched"))
+        assert "patched.zip already exists" in str(excinfo.value)
+        built, (cloneresult,) = LayerClient().publish(arn, "patched", overwrite=True)
+    assert built.code_sha256 == expected.code_sha256
+    assert cloneresult.existing
+    assert cloneresult.layer_version_arn == newarn
+
+
+def test_optimize_and_publish(
+    tmp_cwd: Path, capsys: pytest.CaptureFixture, monkeypatch: pytest.MonkeyPatch
+):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    newarn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:2"
+    with ZipFile(tmp_cwd / "foo-v1.zip", "w") as zipf:
+        zipf.writestr(MOCK_INNERFILENAME, MOCK_INNERFILECONTENT * 100)
+        zipf.writestr("agent.js.map", b"{}")
+        zipf.writestr("test/agent.test.js", b"")
+    (tmp_cwd / "rules.txt").write_text("# Not needed at runtime\n*.map\n\ntest\n")
+    app.main(("optimize", "foo-v1.zip", "--prune-rules", "rules.txt"))
+    out = capsys.readouterr().out.splitlines()
+    assert out[:2] == ["pruned   agent.js.map", "pruned   test/agent.test.js"]
+    assert out[5].split() == ["files", "3", "1", "-66.7%"]
+    with ZipFile(tmp_cwd / "foo-v1-optimized.zip") as zipf:
+        assert zipf.namelist() == [MOCK_INNERFILENAME]
+    optimized = tmp_cwd / "foo-v1-optimized.zip"
+
+    def setup_stubbers(stubber: Stubber, layerinfo: dict):
+        newinfo = dict(
+            layerinfo,
+            LayerVersionArn=newarn,
+            Version=2,
+            Content=dict(
+                CodeSha256=code_sha256(str(optimized)),
+                CodeSize=optimized.stat().st_size,
+            ),
+        )
+        setup_info_stubber(stubber, layerinfo)
+        add_no_versions_response(stubber)
+        stubber.add_response(
+            "publish_layer_version",
+            newinfo,
+            dict(
+                LayerName="foo",
+                Content=dict(ZipFile=optimized.read_bytes()),
+                Description=layerinfo["Description"],
+                CompatibleRuntimes=layerinfo["CompatibleRuntimes"],
+                LicenseInfo=layerinfo["LicenseInfo"],
+            ),
+        )
+
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers):
+        app.main(("publish", arn, "foo-v1-optimized.zip"))
+
+
+def test_sync(
+    tmp_cwd: Path,
+    capsys: pytest.CaptureFixture,
+    monkeypatch: pytest.MonkeyPatch,
+    layer_server: LayerServer,
+    isolated_cache: Path,
+):
+    layerarn = "arn:aws:lambda:us-east-1:123456789012:layer:foo"
+    targetarn = "arn:aws:lambda:eu-west-1:123456789012:layer:foo:"
+
+    def versions(*arns: str) -> dict:
+        return {"LayerVersions": [{"LayerVersionArn": arn} for arn in arns]}
+
+    def otherinfo(layerinfo: dict) -> dict:
+        result = copy.deepcopy(layerinfo)
+        result["Content"]["CodeSha256"] = "other"
+        return result
+
+    def setup_source_stubber(stubber: Stubber, layerinfo: dict):
+        stubber.add_response(
+            "list_layer_versions",
+            versions(layerarn + ":2", layerarn + ":1"),
+            dict(LayerName=layerarn),
+        )
+        stubber.add_response(
+            "get_layer_version_by_arn", otherinfo(layerinfo), dict(Arn=layerarn + ":1")
+        )
+        stubber.add_response(
+            "get_layer_version_by_arn", layerinfo, dict(Arn=layerarn + ":2")
+        )
+        # The cached info lacks the download location.
+        stubber.add_response(
+            "get_layer_version_by_arn", layerinfo, dict(Arn=layerarn + ":2")
+        )
+
+    def setup_target_stubber(stubber: Stubber, layerinfo: dict):
+        stubber.add_response(
+            "list_layer_versions", versions(targetarn + "1"), dict(LayerName="foo")
+        )
+        stubber.add_response(
+            "get_layer_version_by_arn",
+            otherinfo(layerinfo),
+            dict(Arn=targetarn + "1"),
+        )
+        published = copy.deepcopy(layerinfo)
+        published["LayerVersionArn"] = targetarn + "2"
+        stubber.add_response("publish_layer_version", published)
+
+    def setup_rerun_source_stubber(stubber: Stubber, _layerinfo: dict):
+        stubber.add_response(
+            "list_layer_versions", versions(layerarn + ":2", layerarn + ":1")
+        )
+
+    def setup_rerun_target_stubber(stubber: Stubber, _layerinfo: dict):
+        stubber.add_response(
+            "list_layer_versions", versions(targetarn + "2", targetarn + "1")
+        )
+
+    stubbers = iter(
+        (
+            setup_source_stubber,
+            setup_target_stubber,
+            setup_rerun_source_stubber,
+            setup_rerun_target_stubber,
+        )
+    )
+
+    def setup_stubbers(stubber: Stubber, layerinfo: dict):
+        return next(stubbers)(stubber, layerinfo)
+
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers, layer_server) as mockinfo:
+        app.main(("sync", layerarn, "-t", "eu-west-1"))
+        out, err = capsys.readouterr()
+        assert "created " + targetarn + "2" in err
+        assert out.splitlines()[1].split() == ["eu-west-1", "0", "1", "1", "0"]
+        assert mockinfo.count_downloads() == 1
+        assert list(tmp_cwd.glob("*.zip")) == [mockinfo.srczippath]
+
+        state = json.loads(
+            next((isolated_cache / "sync").glob("*.json")).read_text("utf-8")
+        )
+        assert state["Versions"] == {
+            layerarn + ":1": {"eu-west-1": targetarn + "1"},
+            layerarn + ":2": {"eu-west-1": targetarn + "2"},
+        }
+
+        # Only lists versions, as the state file tells what is mirrored.
+        app.main(("sync", layerarn + ":2", "-t", "eu-west-1"))
+        out = capsys.readouterr().out
+        assert out.splitlines()[1].split() == ["eu-west-1", "2", "0", "0", "0"]
+        assert mockinfo.count_downloads() == 1
+
+
+def test_discover(
+    tmp_cwd: Path, capsys: pytest.CaptureFixture, monkeypatch: pytest.MonkeyPatch
+):
+    def setup_stubbers(stubber: Stubber, layerinfo: dict):
+        region = stubber.client.meta.region_name
+        if region == "eu-west-1":
+            stubber.add_client_error("list_layers", "AccessDeniedException")
+            return
+        version = dict(
+            LayerVersionArn=layerinfo["LayerVersionArn"],
+            Version=1,
+            CompatibleRuntimes=layerinfo["CompatibleRuntimes"],
+        )
+        stubber.add_response(
+            "list_layers",
+            {
+                "Layers": [
+                    {
+                        "LayerName": "foo",
+                        "LayerArn": layerinfo["LayerArn"],
+                        "LatestMatchingVersion": version,
+                    },
+                    {
+                        "LayerName": "bar",
+                        "LayerArn": layerinfo["LayerArn"][:-3] + "bar",
+                    },
+                ]
+            },
+        )
+
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers):
+        app.main(("discover", "-r", "us-east-1", "-r", "eu-west-1", "--name", "f*"))
+    out, err = capsys.readouterr()
+    records = [json.loads(line) for line in out.splitlines()]
+    assert records == [
+        dict(
+            profile=None,
+            region="us-east-1",
+            account_id="123456789012",
+            layer_name="foo",
+            version=1,
+            arn="arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
+            description=None,
+            compatible_runtimes=["nodejs10.x", "nodejs12.x"],
+            compatible_architectures=[],
+            license_info=None,
+            created_date=None,
+        )
+    ]
+    assert "failed searching eu-west-1" in err
+    assert "found 1 layer versions in 1 of 2 searched regions" in err
+
+
+def test_discover_versions(
+    tmp_cwd: Path, capsys: pytest.CaptureFixture, monkeypatch: pytest.MonkeyPatch
+):
+    def setup_stubbers(stubber: Stubber, _layerinfo: dict):
+        layerarn = "arn:aws:lambda:eu-west-1:123456789012:layer:foo"
+        stubber.add_response(
+            "list_layer_versions",
+            {
+                "LayerVersions": [
+                    dict(
+                        LayerVersionArn=layerarn + ":3",
+                        Version=3,
+                        CompatibleRuntimes=["nodejs14.x"],
+                    ),
+                    dict(
+                        LayerVersionArn=layerarn + ":2",
+                        Version=2,
+                        CompatibleRuntimes=["python3.8", "python3.9"],
+                    ),
+                    dict(
+                        LayerVersionArn=layerarn + ":1",
+                        Version=1,
+                        CompatibleRuntimes=["python3.7"],
+                    ),
+                ]
+            },
+            dict(LayerName=layerarn),
+        )
+
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers):
+        app.main(
+            (
+                "discover",
+                "arn:aws:lambda:us-east-1:123456789012:layer:foo:7",
+                "-r",
+                "eu-west-1",
+                "--runtime",
+                "python3.*",
+                "--all-versions",
+            )
+        )
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [record["version"] for record in records] == [2, 1]
+
+
+def test_pull_corrupted(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch, layer_server: LayerServer
+):
+    with setup_mocks(tmp_cwd, monkeypatch, setup_info_stubber, layer_server):
+        content = bytearray(layer_server.files[MOCK_URLPATH])
+        content[-1] ^= 0xFF
+        layer_server.files[MOCK_URLPATH] = bytes(content)
+        with pytest.raises(SystemExit) as excinfo:
+            app.main(("pull", "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"))
+        assert "expected SHA256" in str(excinfo.value)
+        assert not (tmp_cwd / "foo-v1.zip").exists()
+
+
+def test_pull_size_mismatch(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch, layer_server: LayerServer
+):
+    with setup_mocks(tmp_cwd, monkeypatch, setup_info_stubber, layer_server):
+        layer_server.files[MOCK_URLPATH] += b"trailing garbage"
+        with pytest.raises(SystemExit) as excinfo:
+            app.main(("pull", "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"))
+        assert "bytes, but have" in str(excinfo.value)
+        assert not (tmp_cwd / "foo-v1.zip").exists()
+
+
+def test_pull_refresh_location_changed_content(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch, layer_server: LayerServer
+):
+    def setup_stubber(stubber: Stubber, layerinfo: dict):
+        stubber.add_response("get_layer_version_by_arn", layerinfo)
+        changedinfo = copy.deepcopy(layerinfo)
+        changedinfo["Content"]["CodeSha256"] = "changed"
+        stubber.add_response("get_layer_version_by_arn", changedinfo)
+
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubber, layer_server):
+        layer_server.forbidden.add(MOCK_URLPATH)
+        with pytest.raises(SystemExit) as excinfo:
+            app.main(("pull", "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"))
+        assert "Layer content changed" in str(excinfo.value)
+
+
+def test_clone_multiple_regions(
+    tmp_cwd: Path,
+    capsys: pytest.CaptureFixture,
+    monkeypatch: pytest.MonkeyPatch,
+    layer_server: LayerServer,
+):
+    def setup_pub_stubber(stubber: Stubber, layerinfo: dict):
+        region = stubber.client.meta.region_name
+        newlayerinfo = copy.deepcopy(layerinfo)
+        newlayerinfo["LayerVersionArn"] = layerinfo["LayerVersionArn"].replace(
+            "us-east-1", region
+        )
+        add_no_versions_response(stubber)
+        stubber.add_response("publish_layer_version", newlayerinfo)
+
+    def setup_fail_stubber(stubber: Stubber, _layerinfo: dict):
+        add_no_versions_response(stubber)
+        stubber.add_client_error(
+            "publish_layer_version", "AccessDeniedException", "not allowed"
+        )
+
+    stubbers = iter(
+        (setup_info_stubber, setup_pub_stubber, setup_fail_stubber, setup_pub_stubber)
+    )
+
+    def setup_stubbers(stubber: Stubber, layerinfo: dict):
+        return next(stubbers)(stubber, layerinfo)
+
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers, layer_server) as mockinfo:
+        with pytest.raises(SystemExit) as excinfo:
+            app.main(
+                (
+                    "clone",
+                    "arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
+                    "-t",
+                    "eu-central-1",
+                    "-t",
+                    "eu-west-1",
+                    "-t",
+                    "us-west-2",
+                )
+            )
+        assert str(excinfo.value) == "cloning failed for 1 of 3 regions: eu-west-1"
+        assert mockinfo.count_downloads() == 1
+        out = capsys.readouterr().out.splitlines()
+        assert out[0].split() == ["REGION", "SECONDS", "SHA256", "RESULT"]
+        assert out[1].split()[0::2] == [
+            "eu-central-1",
+            "match",
+        ]
+        assert out[1].endswith("arn:aws:lambda:eu-central-1:123456789012:layer:foo:1")
+        assert out[2].split()[0] == "eu-west-1"
+        assert "AccessDeniedException" in out[2]
+        assert out[3].split()[0] == "us-west-2"
+
+
+def test_clone_s3_staging(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch, layer_server: LayerServer
+):
+    bucket = "staging-eu-central-1"
+
+    def setup_pub_stubber(stubber: Stubber, layerinfo: dict):
+        add_no_versions_response(stubber)
+        stubber.add_response(
+            "publish_layer_version",
+            layerinfo,
+            dict(
+                LayerName="foo",
+                Description=layerinfo["Description"],
+                CompatibleRuntimes=layerinfo["CompatibleRuntimes"],
+                LicenseInfo=layerinfo["LicenseInfo"],
+                Content=dict(S3Bucket=bucket, S3Key=ANY),
+            ),
+        )
+
+    def setup_s3_stubber(stubber: Stubber, _layerinfo: dict):
+        stubber.add_client_error("head_bucket", "404", http_status_code=404)
+        stubber.add_response(
+            "create_bucket",
+            {},
+            dict(
+                Bucket=bucket,
+                CreateBucketConfiguration=dict(LocationConstraint="eu-central-1"),
+            ),
+        )
+        stubber.add_response("put_object", {})
+        stubber.add_response("delete_object", {}, dict(Bucket=bucket, Key=ANY))
+
+    stubbers = iter((setup_info_stubber, setup_pub_stubber, setup_s3_stubber))
+
+    def setup_stubbers(stubber: Stubber, layerinfo: dict):
+        return next(stubbers)(stubber, layerinfo)
+
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers, layer_server):
+        app.main(
+            (
+                "clone",
+                "arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
+                "--target-region=eu-central-1",
+                "--s3-staging-bucket=staging-{region}",
+            )
+        )
+
+
+def test_s3_staging_keys_unique(tmp_cwd: Path):
+    srcpath, sha256 = write_mock_zip(tmp_cwd)
+    keys = {
+        S3Staging("bucket", "prefix/", str(srcpath), "foo", sha256, 0, 1).key
+        for _ in range(2)
+    }
+    assert len(keys) == 2
+    for key in keys:
+        assert key.startswith("prefix/foo/" + b64decode(sha256).hex() + "-")
+        assert key.endswith(".zip")
+
+
+def test_batch(
+    tmp_cwd: Path,
+    capsys: pytest.CaptureFixture,
+    monkeypatch: pytest.MonkeyPatch,
+    layer_server: LayerServer,
+):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    manifest = tmp_cwd / "layers.txt"
+    # The second pull fails because the file already exists.
+    manifest.write_text("info {0}\n{0}\npull {0}\n".format(arn))
+
+    def setup_stubbers(stubber: Stubber, layerinfo: dict):
+        # All items share one client, the failing pull makes no API call.
+        setup_info_stubber(stubber, layerinfo)
+        setup_info_stubber(stubber, layerinfo)
+
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers, layer_server):
+        with pytest.raises(SystemExit) as excinfo:
+            app.main(("batch", "--parallelism=1", str(manifest)))
+        assert str(excinfo.value) == "1 of 3 batch items failed"
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [(rec["index"], rec["action"], rec["status"]) for rec in records] == [
+        (0, "info", "ok"),
+        (1, "pull", "ok"),
+        (2, "pull", "failed"),
+    ]
+    assert records[0]["result"]["Version"] == 1
+    assert records[1]["result"] == dict(file="foo-v1.zip", extracted=None)
+    assert "already exists" in records[2]["error"]
+    assert (tmp_cwd / "foo-v1.zip").is_file()
+
+
+def test_batch_item_error(tmp_cwd: Path, capsys: pytest.CaptureFixture):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    manifest = tmp_cwd / "layers.txt"
+    manifest.write_text("pull {} --include *.js\n".format(arn))
+
+    with pytest.raises(SystemExit) as excinfo:
+        app.main(("batch", str(manifest)))
+    assert str(excinfo.value) == "1 of 1 batch items failed"
+
+    (record,) = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert record["status"] == "failed"
+    assert record["error"] == "--include and --exclude require --extract"
+
+
+def test_batch_same_layer_parallel(
+    tmp_cwd: Path,
+    capsys: pytest.CaptureFixture,
+    monkeypatch: pytest.MonkeyPatch,
+    layer_server: LayerServer,
+):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    manifest = tmp_cwd / "layers.txt"
+    manifest.write_text("pull {0}\npull {0}\n".format(arn))
+    original_download = LayerClient.download
+    running = []
+    overlapped = []
+
+    def slow_download(self, *args, **kwargs):
+        running.append(True)
+        overlapped.append(len(running) > 1)
+        time.sleep(0.2)
+        try:
+            return original_download(self, *args, **kwargs)
+        finally:
+            running.pop()
+
+    monkeypatch.setattr(LayerClient, "download", slow_download)
+    with setup_mocks(tmp_cwd, monkeypatch, setup_info_stubber, layer_server) as mock:
+        with pytest.raises(SystemExit):
+            app.main(("--no-cache", "batch", "--parallelism=2", str(manifest)))
+        assert mock.count_downloads() == 1
+    # The items write the same file, so they do not run at the same time.
+    assert overlapped == [False, False]
+
+    records = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert sorted(record["status"] for record in records) == ["failed", "ok"]
+    assert (tmp_cwd / "foo-v1.zip").is_file()
+
+
+def test_batch_invalid_items(tmp_cwd: Path, capsys: pytest.CaptureFixture):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    manifest = tmp_cwd / "layers.json"
+    manifest.write_text(
+        json.dumps(
+            [
+                dict(action="ls", arn=arn),
+                dict(action="pull", arn=arn, unknown_option=True),
+            ]
+        )
+    )
+
+    with pytest.raises(SystemExit) as excinfo:
+        app.main(("batch", str(manifest)))
+    assert str(excinfo.value) == "2 of 2 batch items failed"
+
+    records = sorted(
+        (json.loads(line) for line in capsys.readouterr().out.splitlines()),
+        key=lambda record: record["index"],
+    )
+    assert [record["status"] for record in records] == ["failed", "failed"]
+    assert records[0]["error"] == "unsupported action ls"
+    assert records[1]["error"].startswith("invalid item pull --unknown-option")
+    assert "unrecognized arguments: --unknown-option" in records[1]["error"]
+
+
+def test_info_cached(
+    tmp_cwd: Path, capsys: pytest.CaptureFixture, monkeypatch: pytest.MonkeyPatch
+):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    # The second info is answered from the cache, without creating a client.
+    stubbers = iter((setup_info_stubber, setup_info_stubber))
+
+    def setup_stubbers(stubber: Stubber, layerinfo: dict):
+        next(stubbers)(stubber, layerinfo)
+
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers):
+        app.main(("info", arn))
+        app.main(("info", arn))  # No API call
+        app.main(("--no-cache", "info", arn))
+        out = capsys.readouterr().out
+        assert out.count("Dynatrace OneAgent for Node.js runtime.") == 3
+
+
+def test_api_pull(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch, layer_server: LayerServer
+):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+    messages = []
+    transfers = []
+    with setup_mocks(
+        tmp_cwd, monkeypatch, setup_info_stubber, layer_server
+    ) as mockinfo:
+        layerclient = LayerClient(
+            on_message=messages.append,
+            on_transfer=lambda *progress: transfers.append(progress),
+        )
+        result = layerclient.pull(arn, extract="extracted")
+    assert result.file == "foo-v1.zip"
+    assert result.extracted == "extracted"
+    assert result.changes is None
+    assert result.layer.arn == arn
+    assert result.layer.version == 1
+    assert result.layer.code_size == mockinfo.srczippath.stat().st_size
+    assert result.layer.compatible_runtimes == ["nodejs10.x", "nodejs12.x"]
+    assert (tmp_cwd / "extracted" / MOCK_INNERFILENAME).is_file()
+    assert messages[0] == "querying layer version meta information for " + arn
+    assert messages[-1] == 'extracting layer contents to "extracted"'
+    assert transfers[0][0] == 0
+
+
+def test_api_pull_exists(tmp_cwd: Path):
+    (tmp_cwd / "foo-v1.zip").write_bytes(b"")
+    with pytest.raises(TargetExistsError) as excinfo:
+        LayerClient().pull("arn:aws:lambda:us-east-1:123456789012:layer:foo:1")
+    assert excinfo.value.target == "foo-v1.zip"
+
+
+def test_api_clone_error(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch, layer_server: LayerServer
+):
+    def setup_stubbers(stubber: Stubber, layerinfo: dict):
+        setup_info_stubber(stubber, layerinfo)
+        add_no_versions_response(stubber)
+        stubber.add_client_error(
+            "publish_layer_version", "AccessDeniedException", "not allowed"
+        )
+
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers, layer_server):
+        with pytest.raises(CloneError) as excinfo:
+            LayerClient().clone("arn:aws:lambda:us-east-1:123456789012:layer:foo:1")
+    (result,) = excinfo.value.results
+    assert result.region == "us-east-1"
+    assert result.layer_version_arn is None
+    assert "AccessDeniedException" in result.error
+    assert str(excinfo.value) == result.error
+
+
+def test_api_find_layer_version_without_cache(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch
+):
+    targetarn = "arn:aws:lambda:eu-west-1:123456789012:layer:foo:"
+    versions = {
+        "LayerVersions": [
+            {"LayerVersionArn": targetarn + "3"},
+            {"LayerVersionArn": targetarn + "2"},
+        ]
+    }
+
+    def setup_stubbers(stubber: Stubber, layerinfo: dict):
+        otherinfo = copy.deepcopy(layerinfo)
+        otherinfo["Content"]["CodeSha256"] = "other"
+        stubber.add_response("list_layer_versions", versions, dict(LayerName="foo"))
+        stubber.add_response(
+            "get_layer_version_by_arn", otherinfo, dict(Arn=targetarn + "3")
+        )
+        stubber.add_response(
+            "get_layer_version_by_arn", layerinfo, dict(Arn=targetarn + "2")
+        )
+        # Each version is only queried once per client, also without cache.
+        stubber.add_response("list_layer_versions", versions, dict(LayerName="foo"))
+
+    messages = []
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers) as mockinfo:
+        layerclient = LayerClient(on_message=messages.append)
+        client = layerclient.clients.client("lambda", "eu-west-1")
+        codesha256 = code_sha256(mockinfo.srczippath)
+        for _ in range(2):
+            found = layerclient.find_layer_version(client, "foo", codesha256)
+            assert found == targetarn + "2"
+    assert messages == []
+
+
+def test_api_find_layer_version_limited(tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr(api, "MAX_HASH_QUERIES", 2)
+    targetarn = "arn:aws:lambda:eu-west-1:123456789012:layer:foo:"
+    versions = {
+        "LayerVersions": [
+            {"LayerVersionArn": targetarn + str(version)} for version in range(5, 0, -1)
+        ]
+    }
+
+    def setup_stubbers(stubber: Stubber, layerinfo: dict):
+        otherinfo = copy.deepcopy(layerinfo)
+        otherinfo["Content"]["CodeSha256"] = "other"
+        stubber.add_response("list_layer_versions", versions, dict(LayerName="foo"))
+        for version in (5, 4):
+            stubber.add_response(
+                "get_layer_version_by_arn",
+                otherinfo,
+                dict(Arn=targetarn + str(version)),
+            )
+
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers) as mockinfo:
+        layerclient = LayerClient()
+        client = layerclient.clients.client("lambda", "eu-west-1")
+        codesha256 = code_sha256(mockinfo.srczippath)
+        assert layerclient.find_layer_version(client, "foo", codesha256) is None
+        # A published version is indexed without querying it.
+        layerclient.remember_published(
+            "foo",
+            {"Content": {"CodeSha256": codesha256}},
+            CloneResult("eu-west-1", targetarn + "6", 1.0, True, None),
+        )
+        assert layerclient.hash_index("eu-west-1", "foo").newest == {
+            "other": targetarn + "5",
+            codesha256: targetarn + "6",
+        }
+
+
+def test_api_discover_error(tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch):
+    def setup_stubbers(stubber: Stubber, _layerinfo: dict):
+        stubber.add_client_error("list_layers", "AccessDeniedException")
+
+    messages = []
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers):
+        with pytest.raises(DiscoverError, match="searching failed in all regions"):
+            LayerClient(on_message=messages.append).discover(regions=["eu-west-1"])
+    assert messages[-2].startswith("failed searching eu-west-1: ")
+    assert messages[-1] == "found 0 layer versions in 0 of 1 searched regions"
+
+
+def run_async(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_aio_clone_multiple_regions(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch, layer_server: LayerServer
+):
+    arn = "arn:aws:lambda:us-east-1:123456789012:layer:foo:1"
+
+    def setup_stubbers(stubber: Stubber, layerinfo: dict):
+        region = stubber.client.meta.region_name
+        if region == "us-east-1":
+            setup_info_stubber(stubber, layerinfo)
+            return
+        newlayerinfo = copy.deepcopy(layerinfo)
+        newlayerinfo["LayerVersionArn"] = arn.replace("us-east-1", region)
+        add_no_versions_response(stubber)
+        stubber.add_response("publish_layer_version", newlayerinfo)
+
+    async def clone() -> typing.List[CloneResult]:
+        async with AsyncLayerClient(region_concurrency=1) as layerclient:
+            return await layerclient.clone(arn, ["us-west-2", "eu-central-1"])
+
+    with setup_mocks(tmp_cwd, monkeypatch, setup_stubbers, layer_server) as mockinfo:
+        results = run_async(clone())
+        assert mockinfo.count_downloads() == 1
+    assert [(result.region, result.layer_version_arn) for result in results] == [
+        ("eu-central-1", arn.replace("us-east-1", "eu-central-1")),
+        ("us-west-2", arn.replace("us-east-1", "us-west-2")),
+    ]
+    assert all(result.hash_match for result in results)
+
+
+def test_aio_pull_cancelled(
+    tmp_cwd: Path, monkeypatch: pytest.MonkeyPatch, layer_server: LayerServer
+):
+    async def pull_and_cancel():
+        loop = asyncio.get_event_loop()
+        task = None
+
+        def on_transfer(block_count: int, _block_size: int, _total_size: int):
+            if block_count == 0:
+                loop.call_soon_threadsafe(task.cancel)
+                time.sleep(0.5)  # Until the cancellation reached the operation
+
+        # Downloaded in parts, which are otherwise kept for resuming
+        layerclient = LayerClient(
+            transferconfig=TransferConfig(part_size=64), on_transfer=on_transfer
+        )
+        async with AsyncLayerClient(layerclient) as client:
+            task = asyncio.ensure_future(
+                client.pull(
+                    "arn:aws:lambda:us-east-1:123456789012:layer:foo:1",
+                    extract="extracted",
+                )
+            )
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    with setup_mocks(tmp_cwd, monkeypatch, setup_info_stubber, layer_server):
+        run_async(pull_and_cancel())
+    # Neither the partial download (and its sidecar) nor the extraction remain
+    assert not [
+        child.name
+        for child in tmp_cwd.iterdir()
+        if child.name.startswith("foo-v1") or child.name == "extracted"
+    ]
@@ -0,0 +1,71 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import stat
+from pathlib import Path
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+import pytest
+
+from dtawslayertool import LayerClient, TargetExistsError
+from dtawslayertool.build import FIXED_DATE_TIME
+from dtawslayertool.extract import ZIP_UNIX_SYSTEM, unix_mode
+from dtawslayertool.optimize import read_prune_rules
+
+
+def make_vendor_zip(path: Path) -> str:
+    with ZipFile(path, "w") as zipfile:
+        zipfile.writestr("nodejs/", b"")
+        agent = ZipInfo("nodejs/bin/agent", (2021, 5, 6, 11, 4, 40))
+        agent.create_system = ZIP_UNIX_SYSTEM
+        agent.external_attr = (stat.S_IFREG | 0o755) << 16
+        zipfile.writestr(agent, b"#!/bin/sh\ntrue\n" * 100, ZIP_STORED)
+        zipfile.writestr("nodejs/index.js", b"module.exports = 1;\n" * 100)
+        zipfile.writestr("nodejs/index.js.map", b"{}" * 100)
+        zipfile.writestr("nodejs/test/index.test.js", b"test\n" * 100)
+    return str(path)
+
+
+def test_read_prune_rules(tmp_path: Path):
+    (tmp_path / "rules.txt").write_text("# Source maps\n*.map\n\n  */test  \n")
+    assert read_prune_rules(str(tmp_path / "rules.txt")) == ["*.map", "*/test"]
+
+
+@pytest.mark.parametrize("concurrency", [1, 2])
+def test_optimize(tmp_path: Path, concurrency: int):
+    zipname = make_vendor_zip(tmp_path / "layer.zip")
+    result = LayerClient().optimize(
+        zipname, prune=["*.map", "*/test"], compress_concurrency=concurrency
+    )
+    assert result.file == str(tmp_path / "layer-optimized.zip")
+    assert result.pruned == ["nodejs/index.js.map", "nodejs/test/index.test.js"]
+    assert (result.before.files, result.after.files) == (4, 2)
+    assert result.after.zip_size < result.before.zip_size
+    assert result.after.extract_seconds < result.before.extract_seconds
+
+    with ZipFile(result.file) as zipfile:
+        assert zipfile.testzip() is None
+        infos = {info.filename: info for info in zipfile.infolist()}
+        assert zipfile.read("nodejs/bin/agent") == b"#!/bin/sh\ntrue\n" * 100
+    assert list(infos) == ["nodejs/", "nodejs/bin/agent", "nodejs/index.js"]
+    assert infos["nodejs/bin/agent"].compress_type == ZIP_DEFLATED
+    assert stat.S_IMODE(unix_mode(infos["nodejs/bin/agent"])) == 0o755
+    assert {info.date_time for info in infos.values()} == {FIXED_DATE_TIME}
+
+    with pytest.raises(TargetExistsError):
+        LayerClient().optimize(zipname)
+    again = LayerClient().optimize(
+        zipname, prune=["*.map", "*/test"], overwrite=True, compress_concurrency=1
+    )
+    assert again.code_sha256 == result.code_sha256
@@ -0,0 +1,125 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+from pathlib import Path
+from zipfile import ZIP_DEFLATED, ZipFile, ZipInfo
+
+import pytest
+from conftest import LayerServer
+
+from dtawslayertool.extract import extract_all
+from dtawslayertool.remotezip import (
+    TAIL_SIZE,
+    RangesNotSupported,
+    RemoteZip,
+    select_entries,
+)
+from dtawslayertool.transfer import UrlSource
+
+# Pytest fixtures work by matching names, so this pylint warning is annoying:
+# pylint:disable=redefined-outer-name
+
+
+def make_zip(force_zip64: bool = False) -> bytes:
+    buffer = io.BytesIO()
+    with ZipFile(buffer, "w", ZIP_DEFLATED) as zipfile:
+        for runtime in ("nodejs", "python", "java"):
+            for i in range(50):
+                name = "{}/lib/file{}.bin".format(runtime, i)
+                with zipfile.open(name, "w", force_zip64=force_zip64) as outfile:
+                    # Incompressible, so that entries have a relevant size.
+                    outfile.write(os.urandom(4096))
+        zipfile.writestr("extensions/dynatrace", b"#!/bin/sh\n")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def remote_layer(layer_server: LayerServer):
+    content = make_zip()
+    url = layer_server.add("/layer.zip", content)
+    return content, url
+
+
+def test_list(layer_server: LayerServer, remote_layer):
+    content, url = remote_layer
+    remote = RemoteZip(UrlSource(url, None), len(content))
+    names = [info.filename for info in remote.infolist()]
+    assert names == [info.filename for info in ZipFile(io.BytesIO(content)).infolist()]
+    requests = layer_server.get_requests("/layer.zip")
+    # The small central directory is part of the tail, no full download
+    assert requests == [
+        ("GET", "bytes={}-{}".format(len(content) - TAIL_SIZE, len(content) - 1))
+    ]
+
+
+def test_extract_selected(tmp_path: Path, layer_server: LayerServer, remote_layer):
+    content, url = remote_layer
+    remote = RemoteZip(UrlSource(url, None), len(content), concurrency=3)
+    entries = select_entries(remote.infolist(), ["nodejs", "extensions/*"])
+    assert len(entries) == 51
+    remote.prefetch(entries)
+    nrequests = len(layer_server.get_requests("/layer.zip"))
+
+    extract_all(remote.open_zipfile, str(tmp_path), concurrency=4, entries=entries)
+
+    # Reading the prefetched entries does not fetch anything
+    assert len(layer_server.get_requests("/layer.zip")) == nrequests
+    with ZipFile(io.BytesIO(content)) as zipfile:
+        for name in ("nodejs/lib/file7.bin", "extensions/dynatrace"):
+            assert (tmp_path / name).read_bytes() == zipfile.read(name)
+    assert not (tmp_path / "python").exists()
+
+
+def test_entry_ranges_coalesced(remote_layer):
+    content, url = remote_layer
+    remote = RemoteZip(UrlSource(url, None), len(content), max_range_size=1 << 30)
+    entries = select_entries(remote.infolist(), ["python"])
+    # The python files are adjacent in the zip file
+    ranges = remote.entry_ranges(entries)
+    assert len(ranges) == 1
+    start, length = ranges[0]
+    assert start == entries[0].header_offset
+    assert start + length == remote.infolist()[100].header_offset
+
+
+def test_zip64(tmp_path: Path, layer_server: LayerServer):
+    content = make_zip(force_zip64=True)
+    url = layer_server.add("/layer64.zip", content)
+    remote = RemoteZip(UrlSource(url, None), len(content))
+    entries = select_entries(remote.infolist(), ["java/lib/file1.bin"])
+    assert [info.filename for info in entries] == ["java/lib/file1.bin"]
+    extract_all(remote.open_zipfile, str(tmp_path), entries=entries)
+    assert (tmp_path / "java/lib/file1.bin").stat().st_size == 4096
+
+
+def test_no_range_support(layer_server: LayerServer, remote_layer):
+    content, url = remote_layer
+    layer_server.support_ranges = False
+    with pytest.raises(RangesNotSupported):
+        RemoteZip(UrlSource(url, None), len(content))
+
+
+def test_select_entries():
+    infos = [ZipInfo(name) for name in ("a/", "a/b.txt", "a/c.js", "d.txt")]
+
+    def names(*args):
+        return [info.filename for info in select_entries(infos, *args)]
+
+    assert names() == ["a/", "a/b.txt", "a/c.js", "d.txt"]
+    assert names(["a"]) == ["a/", "a/b.txt", "a/c.js"]
+    assert names(["*.txt"]) == ["a/b.txt", "d.txt"]
+    assert names(["a/"], ["*.js"]) == ["a/", "a/b.txt"]
+    assert names(None, ["a"]) == ["d.txt"]
@@ -0,0 +1,91 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Guards the CLI startup time against regressions.
+
+The startup paths must not import boto3 or botocore, nor http.client and ssl
+(only needed for downloads) or multiprocessing (only needed for building
+layers). The time of importing the CLI and printing its help must stay below
+a budget in milliseconds. Wall clock times depend on the machine and its load,
+so the default budget is generous (about ten times the usual time) and the
+best of a few runs counts; set DT_AWSLAYERTOOL_STARTUP_BUDGET_MS to tighten it.
+"""
+
+import os
+import subprocess
+import sys
+
+STARTUP_BUDGET_MS = float(os.environ.get("DT_AWSLAYERTOOL_STARTUP_BUDGET_MS", 1500))
+STARTUP_RUNS = 3
+
+NOT_IMPORTED = (
+    "import sys\n"
+    "assert 'boto3' not in sys.modules, 'boto3 imported'\n"
+    "assert 'botocore' not in sys.modules, 'botocore imported'\n"
+    "assert 'http.client' not in sys.modules, 'http.client imported'\n"
+    "assert 'ssl' not in sys.modules, 'ssl imported'\n"
+    "assert 'multiprocessing' not in sys.modules, 'multiprocessing imported'\n"
+)
+
+
+def run_python(code: str) -> str:
+    """Runs code in a new interpreter and returns its stdout."""
+    proc = subprocess.run(
+        [sys.executable, "-c", code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert proc.returncode == 0, proc.stderr
+    return proc.stdout
+
+
+def run_main(*args: str) -> str:
+    return (
+        "from dtawslayertool.app import main\n"
+        "try:\n"
+        "    main({!r})\n"
+        "except SystemExit:\n"
+        "    pass\n".format(list(args))
+    )
+
+
+def test_parser_does_not_import_boto3():
+    run_python(
+        "from dtawslayertool.app import make_arg_parser\n"
+        "make_arg_parser()\n" + NOT_IMPORTED
+    )
+
+
+def test_help_does_not_import_boto3():
+    run_python(run_main("clone", "--help") + NOT_IMPORTED)
+
+
+def test_cache_command_does_not_import_boto3(tmp_path):
+    run_python(run_main("--cache-dir", str(tmp_path), "cache", "list") + NOT_IMPORTED)
+
+
+def startup_ms() -> float:
+    output = run_python(
+        "import time\n"
+        "start = time.perf_counter()\n"
+        + run_main("--help")
+        + "print((time.perf_counter() - start) * 1000)\n"
+    )
+    return float(output.splitlines()[-1])
+
+
+def test_startup_time_budget():
+    best = min(startup_ms() for _ in range(STARTUP_RUNS))
+    assert best < STARTUP_BUDGET_MS
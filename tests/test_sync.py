@@ -0,0 +1,51 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pathlib import Path
+
+from dtawslayertool.sync import SyncState, default_state_file, plan_sync
+
+SOURCE = "arn:aws:lambda:us-east-1:123456789012:layer:foo"
+TARGET = "arn:aws:lambda:eu-west-1:123456789012:layer:foo"
+
+
+def test_state_roundtrip(tmp_path: Path):
+    filename = default_state_file(str(tmp_path), SOURCE)
+    state = SyncState(filename, SOURCE).load()
+    assert state.target(SOURCE + ":1", "eu-west-1") is None
+    state.record(SOURCE + ":1", "eu-west-1", TARGET + ":7")
+
+    loaded = SyncState(filename, SOURCE).load()
+    assert loaded.target(SOURCE + ":1", "eu-west-1") == TARGET + ":7"
+    assert SyncState(filename, SOURCE + "2").load().versions == {}
+
+
+def test_unreadable_state_is_ignored(tmp_path: Path):
+    filename = tmp_path / "state.json"
+    filename.write_text("{", "utf-8")
+    assert SyncState(str(filename), SOURCE).load().versions == {}
+
+
+def test_plan_sync(tmp_path: Path):
+    state = SyncState(str(tmp_path / "state.json"), SOURCE)
+    state.record(SOURCE + ":1", "eu-west-1", TARGET + ":1")
+    state.record(SOURCE + ":2", "eu-west-1", TARGET + ":2")  # Deleted since
+    sources = [SOURCE + ":10", SOURCE + ":2", SOURCE + ":1"]
+
+    assert plan_sync(
+        sources, {"eu-west-1": [TARGET + ":1"], "us-west-2": []}, state
+    ) == {
+        "eu-west-1": [SOURCE + ":2", SOURCE + ":10"],
+        "us-west-2": [SOURCE + ":1", SOURCE + ":2", SOURCE + ":10"],
+    }
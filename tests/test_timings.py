@@ -0,0 +1,115 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from dtawslayertool import timings
+
+
+def test_phases_recorded():
+    with timings.recording(dict(command="pull")) as recorder:
+        with timings.phase("download", 1000, arn="x"):
+            pass
+        with timings.phase("extract") as extractphase:
+            extractphase.nbytes = 5
+        with pytest.raises(ValueError), timings.phase("failing"):
+            raise ValueError()
+
+    phases = recorder.to_json()["phases"]
+    assert [phase["name"] for phase in phases] == ["download", "extract", "failing"]
+    assert phases[0]["bytes"] == 1000
+    assert phases[0]["labels"] == dict(arn="x")
+    assert phases[1]["bytes"] == 5
+    assert phases[2]["error"] == "ValueError"
+    assert all(phase["seconds"] >= 0 for phase in phases)
+    with timings.phase("not-recorded"):
+        pass
+    assert len(recorder.phases) == 3
+
+
+@pytest.mark.skipif(timings.resource is None, reason="needs the resource module")
+def test_peak_rss_increase():
+    with timings.recording() as recorder:
+        with timings.phase("allocate"):
+            data = bytearray(64 * 1024 * 1024)
+            data[::4096] = b"x" * len(data[::4096])  # Touch every page
+        del data
+        with timings.phase("small"):
+            pass
+
+    allocate, small = recorder.to_json()["phases"]
+    assert allocate["peak_rss_increase"] >= 32 * 1024 * 1024
+    # The process peak stays, but the later phase did not raise it.
+    assert small["process_peak_rss"] >= allocate["process_peak_rss"]
+    assert small["peak_rss_increase"] < 1024 * 1024
+
+
+def test_phases_from_threads_recorded():
+    def publish(region: str):
+        with timings.phase("publish", 10, region=region):
+            pass
+
+    with timings.recording() as recorder:
+        with ThreadPoolExecutor(2) as executor:
+            list(executor.map(publish, ["eu-west-1", "us-west-2"]))
+    assert sorted(phase.labels["region"] for phase in recorder.phases) == [
+        "eu-west-1",
+        "us-west-2",
+    ]
+
+
+def test_openmetrics():
+    with timings.recording(dict(command="clone")) as recorder:
+        for _ in range(2):
+            with timings.phase("publish", 10, region='eu"west'):
+                pass
+    recorder.add_stats("http", dict(requests=3, throughput=None))
+    text = recorder.to_openmetrics()
+    assert text.endswith("# EOF\n")
+    assert "# UNIT dt_awslayertool_phase_seconds seconds" in text
+    assert (
+        'dt_awslayertool_phase_count{command="clone",phase="publish",region="eu\\"west"} 2'
+        in text.splitlines()
+    )
+    assert (
+        'dt_awslayertool_phase_bytes{command="clone",phase="publish",region="eu\\"west"} 20'
+        in text.splitlines()
+    )
+    assert 'dt_awslayertool_http_requests{command="clone"} 3' in text.splitlines()
+    assert "throughput" not in text.split("dt_awslayertool_http_requests")[1]
+
+
+def test_hooks():
+    events = []
+
+    @contextlib.contextmanager
+    def hook(phase: timings.Phase):
+        events.append(("start", phase.name))
+        try:
+            yield
+        finally:
+            events.append(("end", phase.name, phase.nbytes, phase.seconds is not None))
+
+    timings.add_hook(hook)
+    try:
+        with timings.phase("download", 3):
+            pass
+    finally:
+        timings.remove_hook(hook)
+    with timings.phase("extract"):
+        pass
+    assert events == [("start", "download"), ("end", "download", 3, True)]
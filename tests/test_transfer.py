@@ -0,0 +1,213 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+from base64 import b64encode
+from pathlib import Path
+from urllib.error import HTTPError
+
+import pytest
+from conftest import LayerServer
+
+from dtawslayertool.httppool import DEFAULT_POOL
+from dtawslayertool.transfer import (
+    PART_SUFFIX,
+    SIDECAR_SUFFIX,
+    TransferConfig,
+    TransferError,
+    VerificationError,
+    download_verified,
+)
+
+# Pytest fixtures work by matching names, so this pylint warning is annoying:
+# pylint:disable=redefined-outer-name
+
+CONTENT = os.urandom(100 * 1024 + 17)
+CONTENT_SHA256 = b64encode(hashlib.sha256(CONTENT).digest()).decode("ascii")
+SMALL_PARTS = TransferConfig(part_size=16 * 1024, concurrency=3, bufsize=4096)
+
+
+def test_single_stream(tmp_path: Path, layer_server: LayerServer):
+    url = layer_server.add("/layer", CONTENT)
+    outpath = tmp_path / "layer.zip"
+    download_verified(url, str(outpath), len(CONTENT), CONTENT_SHA256)
+    assert outpath.read_bytes() == CONTENT
+    assert layer_server.get_requests("/layer") == [("GET", None)]
+
+
+def test_ranged(tmp_path: Path, layer_server: LayerServer):
+    url = layer_server.add("/layer", CONTENT)
+    outpath = tmp_path / "layer.zip"
+    reports = []
+    download_verified(
+        url,
+        str(outpath),
+        len(CONTENT),
+        CONTENT_SHA256,
+        reporthook=lambda *args: reports.append(args),
+        config=SMALL_PARTS,
+    )
+    assert outpath.read_bytes() == CONTENT
+    ranges = sorted(
+        rangeheader for _method, rangeheader in layer_server.get_requests("/layer")
+    )
+    assert len(ranges) == 7
+    assert "bytes=98304-102416" in ranges
+    assert reports[0] == (0, SMALL_PARTS.part_size, len(CONTENT))
+    assert reports[-1][0] == 7
+
+
+def test_ranged_pooled_connections(tmp_path: Path, layer_server: LayerServer):
+    url = layer_server.add("/layer", CONTENT)
+    config = SMALL_PARTS._replace(part_size=32 * 1024, concurrency=1)
+    before = DEFAULT_POOL.stats()
+    download_verified(
+        url, str(tmp_path / "layer.zip"), len(CONTENT), CONTENT_SHA256, config=config
+    )
+    after = DEFAULT_POOL.stats()
+    # The Range probe is one of the 4 parts, its connection is reused too.
+    assert after.requests - before.requests == 4
+    assert after.connections - before.connections == 1
+    assert after.reused - before.reused == 3
+    assert after.bytes - before.bytes == len(CONTENT)
+
+
+def test_ranged_fallback(tmp_path: Path, layer_server: LayerServer):
+    layer_server.support_ranges = False
+    url = layer_server.add("/layer", CONTENT)
+    outpath = tmp_path / "layer.zip"
+    download_verified(
+        url, str(outpath), len(CONTENT), CONTENT_SHA256, config=SMALL_PARTS
+    )
+    assert outpath.read_bytes() == CONTENT
+    assert len(layer_server.get_requests("/layer")) == 1
+
+
+@pytest.mark.parametrize("config", [TransferConfig(), SMALL_PARTS])
+def test_corrupted_removed(
+    tmp_path: Path, layer_server: LayerServer, config: TransferConfig
+):
+    url = layer_server.add("/layer", CONTENT[:-1] + b"x")
+    outpath = tmp_path / "layer.zip"
+    with pytest.raises(VerificationError, match="expected SHA256"):
+        download_verified(
+            url, str(outpath), len(CONTENT), CONTENT_SHA256, config=config
+        )
+    assert not outpath.exists()
+
+
+@pytest.mark.parametrize("config", [TransferConfig(), SMALL_PARTS])
+def test_size_mismatch_stops_early(
+    tmp_path: Path, layer_server: LayerServer, config: TransferConfig
+):
+    url = layer_server.add("/layer", CONTENT + b"x")
+    outpath = tmp_path / "layer.zip"
+    with pytest.raises(VerificationError, match="bytes, but have"):
+        download_verified(
+            url, str(outpath), len(CONTENT), CONTENT_SHA256, config=config
+        )
+    assert not outpath.exists()
+    assert len(layer_server.get_requests("/layer")) == 1
+
+
+def test_resume(tmp_path: Path, layer_server: LayerServer):
+    url = layer_server.add("/layer", CONTENT)
+    outpath = tmp_path / "layer.zip"
+    partpath = tmp_path / ("layer.zip" + PART_SUFFIX)
+    sidecarpath = tmp_path / ("layer.zip" + PART_SUFFIX + SIDECAR_SUFFIX)
+    layer_server.range_errors["bytes=32768-49151"] = 500
+    with pytest.raises(HTTPError):
+        download_verified(
+            url, str(outpath), len(CONTENT), CONTENT_SHA256, config=SMALL_PARTS
+        )
+    assert not outpath.exists()
+    assert partpath.exists()
+    assert sidecarpath.exists()
+
+    layer_server.range_errors.clear()
+    layer_server.requests.clear()
+    download_verified(
+        url, str(outpath), len(CONTENT), CONTENT_SHA256, config=SMALL_PARTS
+    )
+    assert outpath.read_bytes() == CONTENT
+    assert not partpath.exists()
+    assert not sidecarpath.exists()
+    ranges = [
+        rangeheader for _method, rangeheader in layer_server.get_requests("/layer")
+    ]
+    assert "bytes=32768-49151" in ranges
+    assert "bytes=0-16383" not in ranges
+
+
+def test_resume_damaged_part(tmp_path: Path, layer_server: LayerServer):
+    url = layer_server.add("/layer", CONTENT)
+    outpath = tmp_path / "layer.zip"
+    partpath = tmp_path / ("layer.zip" + PART_SUFFIX)
+    layer_server.range_errors["bytes=98304-102416"] = 500
+    with pytest.raises(HTTPError):
+        download_verified(
+            url, str(outpath), len(CONTENT), CONTENT_SHA256, config=SMALL_PARTS
+        )
+    with open(partpath, "r+b") as partfile:
+        partfile.write(b"damaged")
+
+    layer_server.range_errors.clear()
+    layer_server.requests.clear()
+    download_verified(
+        url, str(outpath), len(CONTENT), CONTENT_SHA256, config=SMALL_PARTS
+    )
+    assert outpath.read_bytes() == CONTENT
+    ranges = sorted(
+        rangeheader for _method, rangeheader in layer_server.get_requests("/layer")
+    )
+    assert ranges == ["bytes=0-16383", "bytes=98304-102416"]
+
+
+def test_refresh_url(tmp_path: Path, layer_server: LayerServer):
+    expiredurl = layer_server.add("/expired", CONTENT)
+    layer_server.forbidden.add("/expired")
+    freshurl = layer_server.add("/fresh", CONTENT)
+    refreshes = []
+
+    def refresh_url():
+        refreshes.append(freshurl)
+        return freshurl
+
+    outpath = tmp_path / "layer.zip"
+    download_verified(
+        expiredurl,
+        str(outpath),
+        len(CONTENT),
+        CONTENT_SHA256,
+        config=SMALL_PARTS,
+        refresh_url=refresh_url,
+    )
+    assert outpath.read_bytes() == CONTENT
+    assert len(refreshes) == 1
+
+
+def test_refresh_url_gives_up(tmp_path: Path, layer_server: LayerServer):
+    url = layer_server.add("/expired", CONTENT)
+    layer_server.forbidden.add("/expired")
+    outpath = tmp_path / "layer.zip"
+    with pytest.raises(TransferError, match="still denied"):
+        download_verified(
+            url,
+            str(outpath),
+            len(CONTENT),
+            CONTENT_SHA256,
+            refresh_url=lambda: url,
+        )
+    assert not (tmp_path / ("layer.zip" + PART_SUFFIX)).exists()
@@ -0,0 +1,183 @@
+# Copyright 2021 Dynatrace LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import time
+from pathlib import Path
+from zipfile import ZipFile
+
+import pytest
+
+from dtawslayertool.cache import code_sha256
+from dtawslayertool.extract import extract_all
+from dtawslayertool.verify import (
+    HashIndex,
+    compare_entries,
+    default_index_file,
+    verify_tree,
+    zip_matches,
+)
+
+ENTRIES = {"nodejs/": b"", "nodejs/a.js": b"a" * 100, "nodejs/b.js": b"b" * 10}
+
+
+def make_zip(path: Path, entries: dict) -> str:
+    with ZipFile(path, "w") as zipfile:
+        for name, content in entries.items():
+            zipfile.writestr(name, content)
+    return str(path)
+
+
+def age_files(root: Path):
+    """Moves the mtimes out of the racy window, so that hashes are recorded."""
+    old = time.time() - 60
+    for name in root.rglob("*"):
+        os.utime(str(name), (old, old))
+
+
+def infolist(zipname: str):
+    with ZipFile(zipname) as zipfile:
+        return zipfile.infolist()
+
+
+def index_for(target: Path, algorithm: str = "crc32") -> HashIndex:
+    index = HashIndex(default_index_file(str(target)), algorithm)
+    index.load()
+    return index
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_verify_tree(tmp_path: Path, concurrency: int):
+    zipname = make_zip(tmp_path / "layer.zip", ENTRIES)
+    target = tmp_path / "out"
+    extract_all(zipname, str(target))
+    age_files(target)
+
+    result = verify_tree(str(target), infolist(zipname), index_for(target), concurrency)
+    assert result.ok
+    assert (result.verified, result.hashed) == (2, 2)
+
+    # Unchanged files are not hashed again
+    result = verify_tree(str(target), infolist(zipname), index_for(target), concurrency)
+    assert result.ok
+    assert (result.verified, result.hashed) == (2, 0)
+
+
+def test_verify_tree_differences(tmp_path: Path):
+    zipname = make_zip(tmp_path / "layer.zip", ENTRIES)
+    target = tmp_path / "out"
+    extract_all(zipname, str(target))
+    (target / "nodejs" / "a.js").write_bytes(b"x" * 100)  # Same size
+    (target / "nodejs" / "b.js").unlink()
+    (target / "extra.txt").write_bytes(b"extra")
+
+    result = verify_tree(str(target), infolist(zipname), index_for(target))
+    assert not result.ok
+    assert result.changed == [os.path.join("nodejs", "a.js")]
+    assert result.missing == [os.path.join("nodejs", "b.js")]
+    assert result.extra == ["extra.txt"]
+    assert result.verified == 0
+    assert str(result) == "0 verified, 1 changed, 1 missing, 1 extra (1 hashed)"
+
+
+def test_verify_tree_selection(tmp_path: Path):
+    zipname = make_zip(
+        tmp_path / "layer.zip", dict(ENTRIES, **{"python/c.py": b"c", "d.txt": b"d"})
+    )
+    target = tmp_path / "out"
+    extract_all(zipname, str(target))
+    (target / "python" / "c.py").write_bytes(b"changed")  # Not selected
+
+    result = verify_tree(
+        str(target), infolist(zipname), index_for(target), include=["nodejs/*"]
+    )
+    assert result.ok
+    assert (result.verified, result.extra, result.changed) == (2, [], [])
+
+    result = verify_tree(
+        str(target), infolist(zipname), index_for(target), exclude=["python"]
+    )
+    assert result.ok
+    assert result.verified == 3
+
+
+def test_index_detects_changes(tmp_path: Path):
+    zipname = make_zip(tmp_path / "layer.zip", ENTRIES)
+    target = tmp_path / "out"
+    extract_all(zipname, str(target))
+    age_files(target)
+    assert verify_tree(str(target), infolist(zipname), index_for(target)).ok
+
+    # Rewritten with the same size and mtime, but a new inode
+    changed = target / "nodejs" / "a.js"
+    stat = changed.stat()
+    changed.unlink()
+    (target / "placeholder").write_bytes(b"")  # Keeps the inode from being reused
+    changed.write_bytes(b"x" * 100)
+    os.utime(str(changed), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    (target / "placeholder").unlink()
+
+    result = verify_tree(str(target), infolist(zipname), index_for(target))
+    assert result.changed == [os.path.join("nodejs", "a.js")]
+    assert result.hashed == 1
+
+
+def test_index_skips_racy_files(tmp_path: Path):
+    zipname = make_zip(tmp_path / "layer.zip", {"a.js": b"a"})
+    target = tmp_path / "out"
+    extract_all(zipname, str(target))
+    os.utime(str(target / "a.js"))  # Just modified
+
+    verify_tree(str(target), infolist(zipname), index_for(target))
+    saved = json.loads(Path(default_index_file(str(target))).read_text("utf-8"))
+    assert saved == dict(Algorithm="crc32", Files={})
+
+
+def test_index_inside_target_is_ignored(tmp_path: Path):
+    zipname = make_zip(tmp_path / "layer.zip", ENTRIES)
+    target = tmp_path / "out"
+    extract_all(zipname, str(target))
+    index = HashIndex(str(target / "hashes.json"), "crc32")
+    assert verify_tree(str(target), infolist(zipname), index).ok
+    assert verify_tree(str(target), infolist(zipname), index).ok
+
+
+def test_zip_matches(tmp_path: Path):
+    zipname = make_zip(tmp_path / "layer.zip", ENTRIES)
+    age_files(tmp_path)
+    codesha256 = code_sha256(zipname)
+    size = os.path.getsize(zipname)
+
+    index = index_for(Path(zipname), "sha256")
+    assert zip_matches(zipname, codesha256, size, index)
+    assert index.misses == 1
+    index = index_for(Path(zipname), "sha256")
+    assert zip_matches(zipname, codesha256, size, index)
+    assert index.misses == 0
+    assert not zip_matches(zipname, codesha256, size + 1, index)
+
+
+def test_compare_entries(tmp_path: Path):
+    expected = make_zip(tmp_path / "a.zip", ENTRIES)
+    actual = make_zip(
+        tmp_path / "b.zip",
+        {"nodejs/a.js": b"a" * 100, "nodejs/b.js": b"c" * 10, "new.js": b""},
+    )
+    assert compare_entries(infolist(expected), infolist(actual)) == (
+        [],
+        ["nodejs/b.js"],
+        ["new.js"],
+        1,
+    )